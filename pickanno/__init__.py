@@ -15,6 +15,9 @@ def create_app():
     from . import db
     db.init(app)
 
+    from . import profiling
+    profiling.init(app)
+
     from . import view
     app.register_blueprint(view.bp)
 
@@ -22,4 +25,7 @@ def create_app():
     def root_redirect():
         return redirect('pickanno')
 
+    from . import warmup
+    warmup.init(app)
+
     return app
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+"""Inter-annotator agreement between two annotation sets.
+
+Counts exact and overlapping span matches and type agreement per
+annotation type for each document of a collection, treating the first
+set as reference. Per-document counts are cached with the state of
+the annotation files and only recomputed for documents that changed.
+"""
+
+import sys
+import os
+import json
+
+from collections import Counter, OrderedDict, defaultdict
+from tempfile import mkstemp
+
+from .standoff import load_standoff
+
+
+# Per-type count fields, in order
+COUNT_FIELDS = (
+    'count_a',       # annotations in the first set
+    'count_b',       # annotations in the second set
+    'exact',         # same span and type
+    'overlap',       # overlapping span and same type, one-to-one
+    'same_span',     # same span, any type (by type of first)
+    'same_type',     # same span and same type
+)
+
+# Increment when computation or the cache format changes
+CACHE_VERSION = 1
+
+
+def _spans(annset):
+    return sorted((a.start, a.end, a.type) for a in annset)
+
+
+def _overlap_matches(a, b):
+    """Greedy one-to-one matching of overlapping spans with the same
+    type by sweep over start-sorted (start, end, type) lists. Return
+    Counter of matches by type."""
+    matches = Counter()
+    matched = [False] * len(b)
+    active, j = [], 0
+    for start, end, type_ in a:
+        while j < len(b) and b[j][0] < end:
+            active.append(j)
+            j += 1
+        # spans ending before start cannot overlap later spans either
+        active = [k for k in active if b[k][1] > start and not matched[k]]
+        for k in active:
+            if b[k][2] == type_ and b[k][0] < end:
+                matched[k] = True
+                matches[type_] += 1
+                break
+    return matches
+
+
+def compare_annsets(annset_a, annset_b):
+    """Return { type: counts } for two annotation sets."""
+    a, b = _spans(annset_a), _spans(annset_b)
+    count_a = Counter(t for _, _, t in a)
+    count_b = Counter(t for _, _, t in b)
+    exact_matches = Counter(a) & Counter(b)
+    exact = Counter()
+    for (_, _, t), n in exact_matches.items():
+        exact[t] += n
+    overlap = _overlap_matches(a, b)
+    types_b_by_span = defaultdict(list)
+    for start, end, t in b:
+        types_b_by_span[(start, end)].append(t)
+    same_span, same_type = Counter(), Counter()
+    for start, end, t in a:
+        types_b = types_b_by_span.get((start, end))
+        if types_b:
+            same_span[t] += 1
+            if t in types_b:
+                types_b.remove(t)
+                same_type[t] += 1
+            else:
+                types_b.pop()
+    values = (count_a, count_b, exact, overlap, same_span, same_type)
+    return {
+        t: [v[t] for v in values]
+        for t in sorted(set(count_a) | set(count_b))
+    }
+
+
+def document_agreement(path_a, path_b):
+    """Return { type: counts } for two annotation files."""
+    return compare_annsets(load_standoff(path_a), load_standoff(path_b))
+
+
+def add_counts(total, counts):
+    for t, values in counts.items():
+        if t not in total:
+            total[t] = [0] * len(COUNT_FIELDS)
+        total[t] = [x+y for x, y in zip(total[t], values)]
+    return total
+
+
+def _f1(matches, count_a, count_b):
+    return 2*matches/(count_a+count_b) if count_a+count_b else None
+
+
+def summarize(counts):
+    """Return list of (type, metrics) rows for { type: counts }, with
+    a final row for all types (type None)."""
+    rows = []
+    overall = [0] * len(COUNT_FIELDS)
+    for t, values in sorted(counts.items()):
+        rows.append((t, _metrics(values)))
+        overall = [x+y for x, y in zip(overall, values)]
+    rows.append((None, _metrics(overall)))
+    return rows
+
+
+def _metrics(values):
+    c = dict(zip(COUNT_FIELDS, values))
+    c['exact_f1'] = _f1(c['exact'], c['count_a'], c['count_b'])
+    c['overlap_f1'] = _f1(c['overlap'], c['count_a'], c['count_b'])
+    if c['same_span']:
+        c['type_agreement'] = c['same_type'] / c['same_span']
+    else:
+        c['type_agreement'] = None
+    return c
+
+
+def _file_stamp(paths):
+    stamp = []
+    for path in paths:
+        st = os.stat(path)
+        stamp.append([st.st_mtime_ns, st.st_size])
+    return stamp
+
+
+def _load_cache(cache_path, sets):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION or cache.get('sets') != sets:
+        return {}
+    return cache.get('documents', {})
+
+
+def _save_cache(cache_path, sets, documents):
+    dirname = os.path.dirname(cache_path) or '.'
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmppath = mkstemp(prefix='.', suffix='.tmp', dir=dirname)
+    try:
+        with open(fd, 'w') as f:
+            json.dump({
+                'version': CACHE_VERSION,
+                'sets': sets,
+                'documents': documents,
+            }, f)
+        os.replace(tmppath, cache_path)
+    except:
+        os.remove(tmppath)
+        raise
+
+
+def collection_agreement(collection_dir, sets=('ann1', 'ann2'),
+                         cache_path=None, executor=None):
+    """Return (documents, total) where documents is OrderedDict
+    { document: { type: counts } } and total sums over documents.
+    Documents without both sets are skipped. If executor is given,
+    changed documents are compared in its worker processes."""
+    sets = list(sets)
+    names = set(os.listdir(collection_dir))
+    roots = sorted(n[:-len('.txt')] for n in names if n.endswith('.txt'))
+    roots = [r for r in roots if all(r+'.'+s in names for s in sets)]
+
+    cached = _load_cache(cache_path, sets) if cache_path else {}
+    stamps, results, changed = {}, {}, []
+    for root in roots:
+        paths = [os.path.join(collection_dir, root+'.'+s) for s in sets]
+        stamps[root] = _file_stamp(paths)
+        entry = cached.get(root)
+        if entry is not None and entry['stamp'] == stamps[root]:
+            results[root] = entry['counts']
+        else:
+            changed.append((root, paths))
+
+    if changed:
+        paths_a = [paths[0] for _, paths in changed]
+        paths_b = [paths[1] for _, paths in changed]
+        if executor is None:
+            computed = map(document_agreement, paths_a, paths_b)
+        else:
+            computed = executor.map(document_agreement, paths_a, paths_b,
+                                    chunksize=64)
+        for (root, _), counts in zip(changed, computed):
+            results[root] = counts
+        if cache_path:
+            _save_cache(cache_path, sets, {
+                r: { 'stamp': stamps[r], 'counts': results[r] } for r in roots
+            })
+
+    documents, total = OrderedDict(), {}
+    for root in roots:
+        documents[root] = results[root]
+        add_counts(total, results[root])
+    return documents, total
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    elif isinstance(value, float):
+        return '{:.4f}'.format(value)
+    else:
+        return str(value)
+
+
+def print_summary(counts, label, out=sys.stdout):
+    fields = COUNT_FIELDS + ('exact_f1', 'overlap_f1', 'type_agreement')
+    for t, metrics in summarize(counts):
+        t = 'ALL' if t is None else t
+        values = [_format(metrics[f]) for f in fields]
+        print('\t'.join([label, t] + values), file=out)
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Agreement between annotation sets.')
+    ap.add_argument('-c', '--cache', default=None,
+                    help='cache file for per-document results')
+    ap.add_argument('-d', '--documents', default=False, action='store_true',
+                    help='output per-document results')
+    ap.add_argument('-j', '--jobs', default=None, type=int,
+                    help='number of worker processes')
+    ap.add_argument('-s', '--sets', default='ann1,ann2',
+                    help='annotation sets to compare (default ann1,ann2)')
+    ap.add_argument('collection', nargs='+', help='collection directories')
+    return ap
+
+
+def main(argv):
+    from concurrent.futures import ProcessPoolExecutor
+    args = argparser().parse_args(argv[1:])
+    sets = args.sets.split(',')
+    if len(sets) != 2:
+        print('error: --sets requires two sets', file=sys.stderr)
+        return 1
+    fields = COUNT_FIELDS + ('exact_f1', 'overlap_f1', 'type_agreement')
+    print('\t'.join(['document', 'type'] + list(fields)))
+    with ProcessPoolExecutor(args.jobs) as executor:
+        for collection_dir in args.collection:
+            if args.cache and len(args.collection) > 1:
+                name = os.path.basename(os.path.normpath(collection_dir))
+                cache_path = '{}.{}'.format(args.cache, name)
+            else:
+                cache_path = args.cache
+            documents, total = collection_agreement(
+                collection_dir, sets, cache_path, executor)
+            if args.documents:
+                for document, counts in documents.items():
+                    print_summary(counts, document)
+            print_summary(total, collection_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
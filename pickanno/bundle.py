@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""Binary bundles of document text and parsed annotations.
+
+A bundle holds the text of a document and its annotation sets in a
+form that loads with one read and no text parsing: a fixed header,
+a table of (name, offset, length) sections and the sections
+
+    INFO  JSON with the annotation set keys and the stamp of the
+          source files (see validate.document_stamp())
+    TEXT  document text, UTF-8
+    STRS  string table: count, end offsets and UTF-8 data of the ids,
+          types, texts and norms of annotations
+    ANNS  for each annotation set in order, count of annotations and
+          for each (id, type, start, end, text, norm), with strings
+          as indices to the table (-1 for None)
+
+Integers are little-endian 32-bit. Metadata (picks) is not included
+and is always read from the document .json. A bundle is only used if
+its stamp matches the current source files, and otherwise rebuilt.
+"""
+
+import sys
+import os
+import json
+import struct
+
+from array import array
+from collections import OrderedDict
+from tempfile import mkstemp
+from multiprocessing import Pool
+
+from .standoff import AnnotationSet, Textbound, load_standoff
+from .validate import document_stamp, document_extensions
+
+
+MAGIC = b'PABN'
+
+# Increment when the format changes
+BUNDLE_VERSION = 1
+
+HEADER = struct.Struct('<4sHH')          # magic, version, section count
+SECTION = struct.Struct('<4sII')         # name, offset, length
+
+ANNOTATION_FIELDS = 6
+
+
+def _int_array(values=()):
+    a = array('i', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+def _load_int_array(data):
+    a = array('i')
+    a.frombytes(data)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+def pack_bundle(stamp, text, annsets):
+    """Return bundle for text and { key: AnnotationSet } as bytes."""
+    strings, string_index = [], {}
+
+    def index(s):
+        if s is None:
+            return -1
+        i = string_index.get(s)
+        if i is None:
+            i = string_index[s] = len(strings)
+            strings.append(s.encode('utf-8'))
+        return i
+
+    anns = _int_array()
+    for annset in annsets.values():
+        anns.append(len(annset))
+        for a in annset:
+            anns.extend((index(a.id), index(a.type), a.start, a.end,
+                         index(a.text), index(a.norm)))
+    ends, end = _int_array(), 0
+    for s in strings:
+        end += len(s)
+        ends.append(end)
+    info = { 'annsets': list(annsets), 'stamp': stamp }
+    sections = [
+        (b'INFO', json.dumps(info).encode('utf-8')),
+        (b'TEXT', text.encode('utf-8')),
+        (b'STRS', (_int_array([len(strings)]).tobytes() + ends.tobytes() +
+                   b''.join(strings))),
+        (b'ANNS', anns.tobytes()),
+    ]
+    offset = HEADER.size + SECTION.size * len(sections)
+    parts = [HEADER.pack(MAGIC, BUNDLE_VERSION, len(sections))]
+    for name, data in sections:
+        parts.append(SECTION.pack(name, offset, len(data)))
+        offset += len(data)
+    parts.extend(data for _, data in sections)
+    return b''.join(parts)
+
+
+def unpack_bundle(data, stamp=None):
+    """Return (text, OrderedDict of AnnotationSets) from bundle bytes,
+    or None if the bundle is of another version or, if stamp is given,
+    for other source files."""
+    data = memoryview(data)
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != BUNDLE_VERSION:
+        return None
+    sections = {}
+    for i in range(count):
+        name, offset, length = SECTION.unpack_from(
+            data, HEADER.size + i * SECTION.size)
+        sections[name] = data[offset:offset+length]
+    info = json.loads(bytes(sections[b'INFO']).decode('utf-8'))
+    if stamp is not None and info['stamp'] != stamp:
+        return None
+    text = bytes(sections[b'TEXT']).decode('utf-8')
+    strs = sections[b'STRS']
+    string_count = _load_int_array(strs[:4])[0]
+    ends = _load_int_array(strs[4:4+4*string_count])
+    blob = bytes(strs[4+4*string_count:])
+    strings, start = [], 0
+    for end in ends:
+        strings.append(blob[start:end].decode('utf-8'))
+        start = end
+    strings.append(None)    # index -1
+    anns = _load_int_array(sections[b'ANNS'])
+    annsets, i = OrderedDict(), 0
+    for key in info['annsets']:
+        count, i = anns[i], i+1
+        annotations = []
+        for j in range(i, i+count*ANNOTATION_FIELDS, ANNOTATION_FIELDS):
+            id_, type_, start, end, text_, norm = anns[j:j+ANNOTATION_FIELDS]
+            t = Textbound(strings[id_], strings[type_], start, end,
+                          strings[text_])
+            t.norm = strings[norm]
+            annotations.append(t)
+        i += count*ANNOTATION_FIELDS
+        annsets[key] = AnnotationSet(annotations)
+    return text, annsets
+
+
+def bundle_path(bundle_dir, document):
+    return os.path.join(bundle_dir, document+'.bundle')
+
+
+def read_bundle(path, stamp):
+    """Return (text, annsets) from bundle file if it exists and
+    matches stamp, None otherwise."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        return unpack_bundle(data, stamp)
+    except (struct.error, ValueError, KeyError, IndexError):
+        return None    # truncated or corrupt, rebuilt by caller
+
+
+def write_bundle(path, stamp, text, annsets):
+    """Atomically write bundle file."""
+    data = pack_bundle(stamp, text, annsets)
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmpfn = mkstemp(prefix='.', suffix='.tmp', dir=dirname)
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmpfn, path)
+    except:
+        os.remove(tmpfn)
+        raise
+
+
+def source_paths(collection_dir, document, annset_keys):
+    """Return paths of the source files of a bundle."""
+    root = os.path.join(collection_dir, document)
+    return [root+'.txt'] + ['{}.{}'.format(root, k) for k in annset_keys]
+
+
+def compile_document(collection_dir, bundle_dir, document, extensions):
+    """Write bundle for document with files with the given extensions
+    unless current, return True if written."""
+    from .db import get_annset_keys
+    root = os.path.join(collection_dir, document)
+    with open(root+'.json', encoding='utf-8') as f:
+        metadata = json.load(f)
+    annset_keys = get_annset_keys(extensions, metadata)
+    paths = source_paths(collection_dir, document, annset_keys)
+    stamp = document_stamp(paths)
+    path = bundle_path(bundle_dir, document)
+    if read_bundle(path, stamp) is not None:
+        return False
+    with open(root+'.txt', encoding='utf-8') as f:
+        text = f.read()
+    annsets = OrderedDict((k, load_standoff(p))
+                          for k, p in zip(annset_keys, paths[1:]))
+    write_bundle(path, stamp, text, annsets)
+    return True
+
+
+def _compile(args):
+    try:
+        return args[2], compile_document(*args), None
+    except Exception as e:
+        return args[2], False, e
+
+
+def compile_collection(collection_dir, bundle_dir, jobs=None):
+    """Compile bundles for documents in collection, return (written,
+    current, errors) counts."""
+    extensions = document_extensions(collection_dir)
+    written = current = errors = 0
+    with Pool(jobs) as pool:
+        for document, was_written, error in pool.imap_unordered(
+                _compile, [(collection_dir, bundle_dir, d, e)
+                           for d, e in sorted(extensions.items())],
+                chunksize=16):
+            if error is not None:
+                print('{}: {}'.format(document, error), file=sys.stderr)
+                errors += 1
+            elif was_written:
+                written += 1
+            else:
+                current += 1
+    return written, current, errors
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Compile document bundles.')
+    ap.add_argument('-j', '--jobs', default=None, type=int,
+                    help='number of worker processes')
+    ap.add_argument('datadir', help='data directory')
+    ap.add_argument('cachedir', help='cache directory (CACHEDIR)')
+    ap.add_argument('collection', help='collection to compile')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    collection_dir = os.path.join(args.datadir, args.collection)
+    bundle_dir = os.path.join(args.cachedir, 'bundles', args.collection)
+    written, current, errors = compile_collection(collection_dir,
+                                                  bundle_dir, args.jobs)
+    print('{} written, {} current, {} errors'.format(written, current,
+                                                     errors),
+          file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
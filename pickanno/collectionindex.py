@@ -0,0 +1,140 @@
+"""Data derived from collections, kept current incrementally.
+
+A CollectionIndex holds data derived from the documents of one
+collection (see workqueue and stats). It is built from the files on
+first use and updated for each document on picks and change events
+instead of reading the collection again. Changes not seen from events
+(see watch) are found from the picks of all processes (see picklog),
+the modification time of the directory and, after picks or recent
+changes, a scan of its entries; changes not accounted for by the picks
+rebuild the index. Indexes are kept in one registry per
+process, which subscribes to picks and change events for all of them.
+"""
+
+import os
+import threading
+
+from pickanno import picklog
+from .db import FilesystemData, add_pick_listener
+from .watch import get_watcher, subscribe
+
+
+class CollectionIndex(object):
+    """Data derived from one collection. Subclasses implement _build(),
+    _update_document() and _update_pick() and call _check_current()
+    with the lock held before use."""
+    def __init__(self, root_dir, collection):
+        self.db = FilesystemData(root_dir)
+        self.collection = collection
+        self.collection_dir = os.path.join(root_dir, collection)
+        self.lock = threading.Lock()
+        self.dir_mtime = None
+        self.log_position = None    # in picklog, at dir_mtime
+        self.entries = None         # picklog.scan() at dir_mtime
+        self.racy = False           # dir_mtime recent when recorded
+        self.stale = True
+        self.watched = False    # changes seen from events, not mtime
+
+    def _build(self):
+        """Build from the files of the collection."""
+        raise NotImplementedError
+
+    def _update_document(self, document):
+        """Update for change to document, or set stale."""
+        raise NotImplementedError
+
+    def _update_pick(self, document, candidate, candidate_data):
+        """Update for pick written to document."""
+        raise NotImplementedError
+
+    def _rebuild(self):
+        self.stale = False
+        self.log_position = picklog.current_position(self.collection_dir)
+        self.dir_mtime = picklog.dir_mtime(self.collection_dir)
+        self.entries = picklog.scan(self.collection_dir)
+        self.racy = picklog.is_racy(self.dir_mtime)
+        self._build()
+
+    def _check_current(self):
+        if self.stale:
+            self._rebuild()
+        elif not self.watched:
+            # picks by any process are logged, other changes rebuild
+            documents, position, mtime = picklog.changes_since(
+                self.collection_dir, self.log_position, self.dir_mtime)
+            if documents is None:
+                self._rebuild()
+                return
+            if documents or self.racy:
+                # changes in the same timestamp tick as a pick or the
+                # last check don't show in the modification time
+                entries = picklog.scan(self.collection_dir)
+                if picklog.unlogged_changes(self.entries, entries,
+                                            documents):
+                    self._rebuild()
+                    return
+                self.entries = entries
+                self.racy = picklog.is_racy(mtime)
+            self.log_position, self.dir_mtime = position, mtime
+            for document in documents:
+                self._update_document(document)
+            if self.stale:
+                self._rebuild()
+
+    def invalidate(self, document):
+        """Update for change to document, or rebuild on next use if
+        document is None."""
+        with self.lock:
+            if self.stale:
+                return
+            if document is None:
+                self.stale = True
+                return
+            self._update_document(document)
+
+    def update(self, document, candidate, candidate_data):
+        """Update for pick of candidate in document."""
+        with self.lock:
+            if self.stale:
+                return    # rebuilt on next use
+            self._update_pick(document, candidate, candidate_data)
+
+
+_indexes = {}    # { (class, collection_dir): index }
+_indexes_lock = threading.Lock()
+
+
+def get_index(cls, root_dir, collection):
+    """Return CollectionIndex subclass cls instance for collection,
+    shared by this process."""
+    key = (cls, os.path.join(root_dir, collection))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = cls(root_dir, collection)
+        index.watched = get_watcher(root_dir) is not None
+        return index
+
+
+def _find_indexes(root_dir, collection):
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    if collection is None:
+        return [i for i in indexes if i.db.root_dir == root_dir]
+    collection_dir = os.path.join(root_dir, collection)
+    return [i for i in indexes if i.collection_dir == collection_dir]
+
+
+def _update_indexes(root_dir, collection, document, candidate,
+                    candidate_data):
+    for index in _find_indexes(root_dir, collection):
+        index.update(document, candidate, candidate_data)
+
+
+def _invalidate_indexes(root_dir, collection, document):
+    for index in _find_indexes(root_dir, collection):
+        index.invalidate(None if collection is None else document)
+
+
+add_pick_listener(_update_indexes)
+subscribe(_invalidate_indexes)
@@ -1,14 +1,60 @@
+import os
+
 from flask import current_app as app
 
 
 DATADIR_KEY = 'DATADIR'
 
+CACHEDIR_KEY = 'CACHEDIR'
+
 FONT_SIZE_KEY = 'FONT_SIZE'
 
 FONT_FILE_KEY = 'FONT_FILE'
 
 LINE_WIDTH_KEY = 'LINE_WIDTH'
 
+CONTEXT_WINDOW_KEY = 'CONTEXT_WINDOW'
+
+CONTEXT_WINDOW_UNIT_KEY = 'CONTEXT_WINDOW_UNIT'
+
+CONTEXT_CHUNK_SIZE_KEY = 'CONTEXT_CHUNK_SIZE'
+
+DOCUMENT_CACHE_SIZE_KEY = 'DOCUMENT_CACHE_SIZE'
+
+PARALLEL_WORKERS_KEY = 'PARALLEL_WORKERS'
+
+SEARCH_UPDATE_INTERVAL_KEY = 'SEARCH_UPDATE_INTERVAL'
+
+PARALLEL_MIN_ANNSETS_KEY = 'PARALLEL_MIN_ANNSETS'
+
+PARALLEL_MIN_PARSE_BYTES_KEY = 'PARALLEL_MIN_PARSE_BYTES'
+
+PARALLEL_MIN_RENDER_ANNOTATIONS_KEY = 'PARALLEL_MIN_RENDER_ANNOTATIONS'
+
+WORKQUEUE_LEASE_SECONDS_KEY = 'WORKQUEUE_LEASE_SECONDS'
+
+WATCH_MODE_KEY = 'WATCH_MODE'
+
+SHARED_CACHE_SIZE_KEY = 'SHARED_CACHE_SIZE'
+
+LISTING_PAGE_SIZE_KEY = 'LISTING_PAGE_SIZE'
+
+WATCH_POLL_INTERVAL_KEY = 'WATCH_POLL_INTERVAL'
+
+DOCUMENT_BUNDLES_KEY = 'DOCUMENT_BUNDLES'
+
+CLIENT_RENDERING_KEY = 'CLIENT_RENDERING'
+
+PROFILE_TOKEN_KEY = 'PROFILE_TOKEN'
+
+PROFILE_SAMPLE_RATE_KEY = 'PROFILE_SAMPLE_RATE'
+
+PROFILE_DIR_KEY = 'PROFILE_DIR'
+
+WARMUP_KEY = 'WARMUP'
+
+WARMUP_DOCUMENTS_KEY = 'WARMUP_DOCUMENTS'
+
 
 class ConfigError(Exception):
     pass
@@ -21,6 +67,15 @@ def get_datadir():
         raise ConfigError('missing {} in config'.format(DATADIR_KEY))
 
 
+def get_cachedir():
+    try:
+        cachedir = app.config[CACHEDIR_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(CACHEDIR_KEY))
+    # relative to the instance folder, not the working directory
+    return os.path.join(app.instance_path, cachedir)
+
+
 def get_font_size():
     try:
         return app.config[FONT_SIZE_KEY]
@@ -40,3 +95,172 @@ def get_line_width():
         return app.config[LINE_WIDTH_KEY]
     except KeyError:
         raise ConfigError('missing {} in config'.format(LINE_WIDTH_KEY))
+
+
+def get_context_window():
+    try:
+        return app.config[CONTEXT_WINDOW_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(CONTEXT_WINDOW_KEY))
+
+
+def get_context_window_unit():
+    try:
+        unit = app.config[CONTEXT_WINDOW_UNIT_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            CONTEXT_WINDOW_UNIT_KEY))
+    if unit not in ('lines', 'chars'):
+        raise ConfigError('invalid {} {}'.format(
+            CONTEXT_WINDOW_UNIT_KEY, unit))
+    return unit
+
+
+def get_context_chunk_size():
+    try:
+        return app.config[CONTEXT_CHUNK_SIZE_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            CONTEXT_CHUNK_SIZE_KEY))
+
+
+def get_document_cache_size():
+    try:
+        return app.config[DOCUMENT_CACHE_SIZE_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            DOCUMENT_CACHE_SIZE_KEY))
+
+
+def get_parallel_workers():
+    try:
+        return app.config[PARALLEL_WORKERS_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(PARALLEL_WORKERS_KEY))
+
+
+def get_parallel_min_annsets():
+    try:
+        return app.config[PARALLEL_MIN_ANNSETS_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            PARALLEL_MIN_ANNSETS_KEY))
+
+
+def get_parallel_min_parse_bytes():
+    try:
+        return app.config[PARALLEL_MIN_PARSE_BYTES_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            PARALLEL_MIN_PARSE_BYTES_KEY))
+
+
+def get_parallel_min_render_annotations():
+    try:
+        return app.config[PARALLEL_MIN_RENDER_ANNOTATIONS_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            PARALLEL_MIN_RENDER_ANNOTATIONS_KEY))
+
+
+def get_search_update_interval():
+    try:
+        return app.config[SEARCH_UPDATE_INTERVAL_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            SEARCH_UPDATE_INTERVAL_KEY))
+
+
+def get_workqueue_lease_seconds():
+    try:
+        return app.config[WORKQUEUE_LEASE_SECONDS_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            WORKQUEUE_LEASE_SECONDS_KEY))
+
+
+def get_watch_mode():
+    try:
+        mode = app.config[WATCH_MODE_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(WATCH_MODE_KEY))
+    if mode not in (None, 'auto', 'inotify', 'poll', 'manual'):
+        raise ConfigError('invalid {} {}'.format(WATCH_MODE_KEY, mode))
+    return mode
+
+
+def get_watch_poll_interval():
+    try:
+        return app.config[WATCH_POLL_INTERVAL_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            WATCH_POLL_INTERVAL_KEY))
+
+
+def get_shared_cache_size():
+    try:
+        return app.config[SHARED_CACHE_SIZE_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            SHARED_CACHE_SIZE_KEY))
+
+
+def get_listing_page_size():
+    try:
+        return app.config[LISTING_PAGE_SIZE_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            LISTING_PAGE_SIZE_KEY))
+
+
+def get_document_bundles():
+    try:
+        return app.config[DOCUMENT_BUNDLES_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            DOCUMENT_BUNDLES_KEY))
+
+
+def get_client_rendering():
+    try:
+        return app.config[CLIENT_RENDERING_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            CLIENT_RENDERING_KEY))
+
+
+def get_profile_token():
+    try:
+        return app.config[PROFILE_TOKEN_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(PROFILE_TOKEN_KEY))
+
+
+def get_profile_sample_rate():
+    try:
+        return app.config[PROFILE_SAMPLE_RATE_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            PROFILE_SAMPLE_RATE_KEY))
+
+
+def get_profile_dir():
+    try:
+        return app.config[PROFILE_DIR_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(PROFILE_DIR_KEY))
+
+
+def get_warmup():
+    try:
+        return app.config[WARMUP_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(WARMUP_KEY))
+
+
+def get_warmup_documents():
+    try:
+        return app.config[WARMUP_DOCUMENTS_KEY]
+    except KeyError:
+        raise ConfigError('missing {} in config'.format(
+            WARMUP_DOCUMENTS_KEY))
@@ -3,6 +3,11 @@ from pickanno.protocol import *
 
 DATADIR = 'data'
 
+# Directory for caches and indexes derived from DATADIR, relative paths
+# are relative to the instance folder (app.instance_path)
+
+CACHEDIR = 'cache'
+
 # Visualization configuration
 
 FONT_SIZE = 16    # pixels
@@ -14,10 +19,88 @@ LINE_WIDTH = 800    # pixels, for visualizations
 
 ANNOTATION_TYPE_SUBSCRIPT = False # True
 
+# Render the candidate view in the browser from document data (text,
+# annotation offsets and layout) instead of sending HTML, and prefetch
+# the data of the next document
+
+CLIENT_RENDERING = False
+
 # Highlight context mentions of candidate annotations
 
 HIGHLIGHT_CONTEXT_MENTIONS = True
 
+# Context rendered with the candidate view, as the number of lines
+# ('lines') or characters ('chars') above and below the candidate
+# line, or None for the whole document. The rest of the document is
+# fetched in chunks of CONTEXT_CHUNK_SIZE as the user scrolls.
+
+CONTEXT_WINDOW = 10
+CONTEXT_WINDOW_UNIT = 'lines'
+CONTEXT_CHUNK_SIZE = 50
+
+# Documents per page in collection listings
+
+LISTING_PAGE_SIZE = 100
+
+# Maximum size in bytes of parsed documents to keep in memory (per
+# process), as estimated from text length and number of annotations
+
+DOCUMENT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Maximum size in bytes of the cache of parsed documents and rendered
+# HTML shared by the processes on a host (in CACHEDIR), None to disable
+
+SHARED_CACHE_SIZE = 256 * 1024 * 1024
+
+# Keep text and parsed annotations of each document in a binary bundle
+# (in CACHEDIR) that loads without parsing. Bundles are rebuilt when
+# their source files change and can be compiled ahead of time with
+# python -m pickanno.bundle. If enabled, bundles take the place of the
+# shared cache for parsed documents (rendered HTML is still shared).
+
+DOCUMENT_BUNDLES = False
+
+# Watching DATADIR for changes lets caches skip checking files on each
+# request: 'auto' (inotify if available and DATADIR is not on a network
+# filesystem, else polling), 'inotify', 'poll' (directory modification
+# times every WATCH_POLL_INTERVAL seconds; as in-place modifications
+# don't show in these, cached documents are checked against their files
+# at most once per interval), 'manual' (for tests) or None to check
+# files on each request instead.
+
+WATCH_MODE = 'auto'
+WATCH_POLL_INTERVAL = 2
+
+# Worker processes for parsing and rendering many annotation sets
+# (None for number of CPUs, 0 to disable) and the minimum number of
+# sets and size of input for using them
+
+PARALLEL_WORKERS = None
+PARALLEL_MIN_ANNSETS = 3
+PARALLEL_MIN_PARSE_BYTES = 1000000
+PARALLEL_MIN_RENDER_ANNOTATIONS = 10000
+
+# Seconds that a document given to an annotator as the next unjudged
+# one is withheld from other annotators
+
+WORKQUEUE_LEASE_SECONDS = 300
+
+# Warm up caches in the background on the first request to each process
+# (font metrics, listings and the WARMUP_DOCUMENTS most recently picked
+# documents); /ready answers 503 until done, for load balancers
+
+WARMUP = False
+WARMUP_DOCUMENTS = 100
+
+# Profiling of single requests (see profiling.py): requests with
+# PROFILE_TOKEN in the X-Profile header or the profile parameter (None
+# to disable) and one in PROFILE_SAMPLE_RATE requests (None to
+# disable) are profiled and the profiles written to PROFILE_DIR
+
+PROFILE_TOKEN = None
+PROFILE_SAMPLE_RATE = None
+PROFILE_DIR = 'profiles'
+
 # Key binding configuration
 
 HOTKEYS = {
@@ -28,6 +111,9 @@ HOTKEYS = {
     'z': CLEAR_PICKS,         # clear accept/reject
 }
 
+# pick n:th candidate with number keys
+HOTKEYS.update({ str(i): PICK_NTH + str(i) for i in range(1, 10) })
+
 # Search links to add for candidate annotation strings
 
 SEARCH_CONFIG = [
@@ -35,6 +121,11 @@ SEARCH_CONFIG = [
     ('Wikipedia', 'http://en.wikipedia.org/wiki/Special:Search?search=')
 ]
 
+# Minimum seconds between checks of all files for search index updates
+# (changes that add or remove files are picked up immediately)
+
+SEARCH_UPDATE_INTERVAL = 60
+
 # Document status constants (TODO: maybe not the right place for these)
 
 STATUS_COMPLETE = 'complete'
@@ -1,44 +1,104 @@
 import os
+import re
+import sys
 import json
-
-from collections import OrderedDict, defaultdict
+import fcntl
+import time
+import threading
+
+from copy import copy
+from types import MappingProxyType
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict, namedtuple
 from glob import iglob
+from itertools import islice
 from tempfile import mkstemp
 
 from flask import current_app as app
 
 from pickanno import conf
-from .standoff import parse_standoff
+from pickanno import watch
+from pickanno import picklog
+from .watch import get_watcher
+from .standoff import parse_standoff, load_standoff, AnnotationSet
+from .parallel import parallel_enabled, starmap
+from .parallel import get_worker_count, get_executor
+from .agreement import collection_agreement
+from .sharedcache import get_shared_cache, cache_key
+from .validate import get_invalid, known_errors, report_stamp
+from .validate import InvalidDocument
+from .bundle import bundle_path, read_bundle, write_bundle
 
 
 class DocumentData(object):
     """Text with alternative annotation sets, designated candidate
-    annotation, and possible judgments."""
-    def __init__(self, text, annsets, metadata):
+    annotations, and possible judgments.
+
+    Metadata either identifies a single candidate with top-level
+    candidate_set and candidate_id keys, or lists several under
+    candidates, each with its own candidate_set, candidate_id,
+    accepted and rejected. One candidate is selected at a time.
+
+    If given, stamp identifies the state of the text and annotation
+    files, for caching data derived from them.
+
+    Documents are not modified after creation, so that the parsed text
+    and annotations can be shared between requests and threads; views
+    such as filtered_to_candidate() are new objects sharing them.
+    """
+    def __init__(self, text, annsets, metadata, candidate_index=0,
+                 stamp=None):
         self.text = text
-        self.annsets = annsets
+        self.annsets = MappingProxyType(annsets)
         self.metadata = metadata
+        self.candidates = get_candidates(metadata)
+        if not -len(self.candidates) <= candidate_index < len(self.candidates):
+            raise NoSuchCandidate(candidate_index, len(self.candidates))
+        # normalize e.g. -1 to index of last candidate
+        self.candidate_index = range(len(self.candidates))[candidate_index]
         self.candidate = self.get_annotation(self.candidate_annset,
                                              self.candidate_id)
+        self.stamp = stamp
+        self.filtered = False
+        self._filtered_view = None
+
+    @property
+    def version(self):
+        return get_version(self.candidate_metadata)
+
+    @property
+    def candidate_metadata(self):
+        return self.candidates[self.candidate_index]
 
     def accepted_annsets(self):
-        return self.metadata.get('accepted', [])
+        return get_picks(self.candidate_metadata, 'accepted')
 
     def rejected_annsets(self):
-        return self.metadata.get('rejected', [])
+        return get_picks(self.candidate_metadata, 'rejected')
 
     def judgment_complete(self):
-        judged = set(self.accepted_annsets()) | set(self.rejected_annsets())
-        return not any (a for a in self.annsets if not a in judged)
-
-    def filter_to_candidate(self):
-        """Filter annsets to annotations overlapping candidate."""
-        filtered = { k: [] for k in self.annsets }
-        for key, annset in self.annsets.items():
-            for a in annset:
-                if a.overlaps(self.candidate):
-                    filtered[key].append(a)
-        self.annsets = filtered
+        return candidate_judged(self.candidate_metadata, self.annsets)
+
+    def candidates_judged(self):
+        """Return list of judgment completion status for each candidate."""
+        return [candidate_judged(c, self.annsets) for c in self.candidates]
+
+    def filtered_to_candidate(self):
+        """Return view of document with annsets filtered to annotations
+        overlapping candidate. Annotations are shared, not copied."""
+        if self.filtered:
+            return self
+        if self._filtered_view is None:
+            start, end = self.candidate.start, self.candidate.end
+            filtered = OrderedDict()
+            for key, annset in self.annsets.items():
+                filtered[key] = AnnotationSet(annset.overlapping(start, end))
+            view = copy(self)
+            view.annsets = MappingProxyType(filtered)
+            view.filtered = True
+            # set last, other threads may use the view once it is visible
+            self._filtered_view = view
+        return self._filtered_view
 
     def annotated_strings(self, unique=True, include_empty=False):
         flattened = [a for anns in self.annsets.values() for a in anns]
@@ -51,21 +111,93 @@ class DocumentData(object):
 
     @property
     def candidate_annset(self):
-        return self.annsets[self.metadata['candidate_set']]
+        return self.annsets[self.candidate_metadata['candidate_set']]
 
     @property
     def candidate_id(self):
-        return self.metadata['candidate_id']
+        return self.candidate_metadata['candidate_id']
 
     @staticmethod
     def get_annotation(annset, id_):
         """Return identified annotation."""
-        matching = [t for t in annset if t.id == id_]
-        if not matching:
-            raise KeyError('annotation {} not found'.format(id_))
-        if len(matching) > 1:
-            raise ValueError('duplicate annoation id {}'.format(id_))
-        return matching[0]
+        return annset.get(id_)
+
+
+def get_candidates(metadata):
+    """Return list of candidates in document metadata."""
+    if 'candidates' in metadata:
+        return metadata['candidates']
+    else:
+        return [metadata]    # single-candidate format
+
+
+def get_picks(candidate, key):
+    """Return annotation set keys listed under key ('accepted' or
+    'rejected') for candidate, ignoring anything but strings so that
+    malformed picks count as not judged."""
+    picks = candidate.get(key, [])
+    if not isinstance(picks, list):
+        return []
+    return [p for p in picks if isinstance(p, str)]
+
+
+def candidate_judged(candidate, annset_keys):
+    """Return True if all annotation sets are judged for candidate."""
+    judged = (set(get_picks(candidate, 'accepted')) |
+              set(get_picks(candidate, 'rejected')))
+    return all(k in judged for k in annset_keys)
+
+
+def get_version(candidate):
+    """Return version of the picks of candidate, incremented on each
+    pick. In the single-candidate format this is the version of the
+    document metadata."""
+    return candidate.get('version', 0)
+
+
+class NoSuchCandidate(IndexError):
+    """Candidate index outside the candidates of a document."""
+    def __init__(self, index, count):
+        super().__init__('no candidate {} in document with {}'.format(
+            index, count))
+
+
+class VersionConflict(Exception):
+    """Picks of candidate changed since the version a pick was based on."""
+    def __init__(self, candidate):
+        super().__init__('version conflict, current version {}'.format(
+            get_version(candidate)))
+        self.candidate = candidate
+
+
+# File extensions of annotation sets found without declaration
+ANNSET_EXTENSION_RE = re.compile(r'^ann(\d+)$')
+
+
+def get_annset_keys(extensions, metadata):
+    """Return annotation set keys declared in metadata (key "annsets")
+    or, if not declared, found among the given file extensions."""
+    if 'annsets' in metadata:
+        return list(metadata['annsets'])
+    matches = (ANNSET_EXTENSION_RE.match(e) for e in extensions)
+    matches = sorted((int(m.group(1)), m.group(0)) for m in matches if m)
+    return [key for _, key in matches]
+
+
+DocumentStatus = namedtuple('DocumentStatus', 'status judged candidates')
+
+
+def get_document_status(annset_keys, metadata):
+    """Return DocumentStatus for document entry (see iter_documents())."""
+    if metadata is None:
+        return DocumentStatus(app.config['STATUS_ERROR'], 0, 0)
+    judged = [candidate_judged(c, annset_keys)
+              for c in get_candidates(metadata)]
+    if all(judged):
+        status = app.config['STATUS_COMPLETE']
+    else:
+        status = app.config['STATUS_INCOMPLETE']
+    return DocumentStatus(status, sum(judged), len(judged))
 
 
 class FilesystemData(object):
@@ -84,33 +216,140 @@ class FilesystemData(object):
         """Get collection contents organized by file extension."""
         contents_by_ext = defaultdict(list)
         collection_dir = os.path.join(self.root_dir, collection)
-        for name in sorted(os.listdir(collection_dir)):
-            path = os.path.join(collection_dir, name)
-            if os.path.isfile(path):
-                root, ext = os.path.splitext(name)
-                contents_by_ext[ext].append(root)
+        # scandir() entries know their type without stat() on most
+        # filesystems, which matters for large collections
+        with os.scandir(collection_dir) as it:
+            names = sorted(e.name for e in it if e.is_file())
+        for name in names:
+            root, ext = os.path.splitext(name)
+            contents_by_ext[ext].append(root)
         return contents_by_ext
 
-    def get_documents(self, collection, include_status=False):
+    def get_annset_extensions(self, collection):
+        """Return sorted extensions of annotation files in collection."""
+        contents_by_ext = self._get_contents_by_ext(collection)
+        return sorted(
+            ext[1:] for ext, roots in contents_by_ext.items()
+            if ext not in ('', '.txt', '.json') and
+            any(not r.startswith('.') for r in roots)
+        )
+
+    def _get_document_extensions(self, collection):
+        """Return { document: extensions } in collection order."""
         contents_by_ext = self._get_contents_by_ext(collection)
-        documents = contents_by_ext['.txt']
+        extensions_by_root = defaultdict(set)
+        for ext, roots in contents_by_ext.items():
+            for root in roots:
+                extensions_by_root[root].add(ext[1:])
+        return OrderedDict((root, extensions_by_root[root])
+                           for root in contents_by_ext['.txt'])
+
+    def get_documents(self, collection, include_status=False):
         if not include_status:
             # simple listing
-            return documents
+            contents_by_ext = self._get_contents_by_ext(collection)
+            return contents_by_ext['.txt']
         else:
-            statuses = []
-            for root in documents:
-                try:
-                    document_data = self.get_document_data(collection, root)
-                    if document_data.judgment_complete():
-                        status = app.config['STATUS_COMPLETE']
-                    else:
-                        status = app.config['STATUS_INCOMPLETE']
-                except:
-                    status = app.config['STATUS_ERROR']
+            documents, statuses = [], []
+            for document, status in self.iter_document_statuses(collection):
+                documents.append(document)
                 statuses.append(status)
             return documents, statuses
 
+    def iter_document_statuses(self, collection, prefix=None, status=None):
+        """Generate (document, DocumentStatus) for documents in
+        collection, optionally only those starting with prefix and
+        those with the given status."""
+        if get_watcher(self.root_dir) is None:
+            entries = self.iter_documents(collection, prefix)
+        else:
+            entries = _listing_cache.get(self, collection)
+            if prefix:
+                entries = (e for e in entries if e[0].startswith(prefix))
+        for document, annset_keys, metadata in entries:
+            document_status = get_document_status(annset_keys, metadata)
+            if status is None or document_status.status == status:
+                yield document, document_status
+
+    def get_document_page(self, collection, prefix=None, status=None,
+                          offset=0, limit=100):
+        """Return (rows, more, total) for a page of documents matching
+        prefix and status as iter_document_statuses(), where rows are
+        (document, DocumentStatus), more is True if there are further
+        matches, and total is the number of matches if known without
+        reading metadata of all documents, None otherwise."""
+        if status is None and get_watcher(self.root_dir) is None:
+            # only metadata of documents on page is needed
+            extensions = self._get_document_extensions(collection)
+            documents = [d for d in extensions
+                         if not prefix or d.startswith(prefix)]
+            invalid = get_invalid(os.path.join(self.root_dir, collection))
+            rows = []
+            for document in documents[offset:offset+limit]:
+                _, annset_keys, metadata = self._document_entry(
+                    collection, document, extensions[document], invalid)
+                rows.append((document,
+                             get_document_status(annset_keys, metadata)))
+            return rows, len(documents) > offset+limit, len(documents)
+        matches = self.iter_document_statuses(collection, prefix, status)
+        if get_watcher(self.root_dir) is not None:
+            # all metadata is cached, count is cheap
+            matches = list(matches)
+            rows = matches[offset:offset+limit]
+            return rows, len(matches) > offset+limit, len(matches)
+        rows = list(islice(matches, offset, offset+limit+1))
+        return rows[:limit], len(rows) > limit, None
+
+    def iter_documents(self, collection, prefix=None):
+        """Generate (document, annset_keys, metadata) for documents in
+        collection from metadata and file listing, without parsing.
+        annset_keys and metadata are None for documents with errors.
+        If prefix is given, only documents starting with it are read."""
+        extensions = self._get_document_extensions(collection)
+        invalid = get_invalid(os.path.join(self.root_dir, collection))
+        for root, root_extensions in extensions.items():
+            if not prefix or root.startswith(prefix):
+                yield self._document_entry(collection, root, root_extensions,
+                                           invalid)
+
+    def get_document_entry(self, collection, document):
+        """Return (document, annset_keys, metadata) as iter_documents()
+        for one document, or None if there is no such document."""
+        root_path = self.get_document_path(collection, document)
+        extensions = set(os.path.splitext(p)[1][1:]
+                         for p in iglob(root_path + '.*'))
+        if 'txt' not in extensions:
+            return None
+        invalid = get_invalid(os.path.join(self.root_dir, collection))
+        return self._document_entry(collection, document, extensions,
+                                    invalid)
+
+    def _document_entry(self, collection, document, extensions, invalid):
+        try:
+            # documents found invalid by validate stay so until changed
+            collection_dir = os.path.join(self.root_dir, collection)
+            errors = known_errors(invalid, collection_dir, document,
+                                  extensions)
+            if errors is not None:
+                raise InvalidDocument(document, errors)
+            if 'json' not in extensions:
+                raise KeyError('missing json for {}'.format(document))
+            metadata = self.get_document_metadata(collection, document)
+            annset_keys = get_annset_keys(extensions, metadata)
+            if not annset_keys or any(k not in extensions
+                                      for k in annset_keys):
+                raise KeyError('missing annsets for {}'.format(document))
+            for candidate in get_candidates(metadata):
+                if ('candidate_set' not in candidate or
+                    'candidate_id' not in candidate):
+                    raise KeyError('missing candidate for {}'.format(
+                        document))
+                candidate_judged(candidate, annset_keys)
+        except Exception:
+            return document, None, None
+        else:
+            return document, annset_keys, metadata
+
     def get_neighbouring_documents(self, collection, document):
         documents = self.get_documents(collection)
         doc_idx = documents.index(document)
@@ -118,6 +357,10 @@ class FilesystemData(object):
         next_doc = None if doc_idx == len(documents)-1 else documents[doc_idx+1]
         return prev_doc, next_doc
 
+    def get_document_path(self, collection, document):
+        """Return path of document files without extension."""
+        return os.path.join(self.root_dir, collection, document)
+
     def get_document_text(self, collection, document):
         path = os.path.join(self.root_dir, collection, document+'.txt')
         with open(path, encoding='utf-8') as f:
@@ -138,48 +381,246 @@ class FilesystemData(object):
         with open(path, encoding='utf-8') as f:
             return json.load(f)
 
-    def get_document_data(self, collection, document):
-        root_path = os.path.join(self.root_dir, collection, document)
+    def get_document_data(self, collection, document, candidate=0):
+        root_path = self.get_document_path(collection, document)
         glob_path = root_path + '.*'
 
-        extensions = set()
+        # When watching for changes, cached entries are dropped on
+        # changes and can be used without looking at the files, except
+        # for in-place modifications not seen by polling, for which
+        # entries are checked again after the poll interval
+        watcher = get_watcher(self.root_dir)
+        max_age = None
+        if watcher is None:
+            generation = None
+        else:
+            generation = _document_cache.generation
+            if not watcher.sees_modifications:
+                max_age = conf.get_watch_poll_interval()
+            cached = _document_cache.get(root_path, max_age=max_age)
+            if cached is not None:
+                text, annsets, metadata, content_stamp = cached
+                return DocumentData(text, annsets, metadata,
+                                    candidate, content_stamp)
+
+        extensions = {}
         for path in iglob(glob_path):
             root, ext = os.path.splitext(os.path.basename(path))
             assert ext[0] == '.'
             ext = ext[1:]
-            extensions.add(ext)
-        app.logger.info('Found {} for {}'.format(extensions, glob_path))
+            extensions[ext] = path
+        app.logger.info('Found {} for {}'.format(set(extensions), glob_path))
 
-        for ext in ('txt', 'ann1', 'ann2', 'json'):
+        for ext in ('txt', 'json'):
             if ext not in extensions:
                 raise KeyError('missing {}.{}'.format(root_path, ext))
 
-        text = self.get_document_text(collection, document)
-        metadata = self.get_document_metadata(collection, document)
-        annsets = OrderedDict()
-        for key in ('ann1', 'ann2'):
-            annsets[key] = self.get_document_annotation(
-                collection, document, key, parse=True)
-
-        return DocumentData(text, annsets, metadata)
+        # Don't parse documents known to be invalid (see validate)
+        collection_dir = os.path.join(self.root_dir, collection)
+        errors = known_errors(get_invalid(collection_dir), collection_dir,
+                              document, extensions)
+        if errors is not None:
+            raise InvalidDocument(document, errors)
+
+        # Reuse earlier parse if none of the files have changed
+        stamp = file_stamp(extensions.values())
+        if generation is None or max_age is not None:
+            cached = _document_cache.get(root_path, stamp)
+            if cached is not None:
+                text, annsets, metadata, content_stamp = cached
+                return DocumentData(text, annsets, metadata,
+                                    candidate, content_stamp)
 
-    def set_document_picks(self, collection, document, accepted, rejected):
-        data = self.get_document_metadata(collection, document)
-        data['accepted'] = accepted
-        data['rejected'] = rejected
-        path = os.path.join(self.root_dir, collection, document+'.json')
-        self.safe_write_file(path, json.dumps(data, indent=4, sort_keys=True))
+        metadata = self.get_document_metadata(collection, document)
+        annset_keys = get_annset_keys(extensions, metadata)
+        if not annset_keys:
+            raise KeyError('no annotation sets for {}'.format(root_path))
+        for key in annset_keys:
+            if key not in extensions:
+                raise KeyError('missing {}.{}'.format(root_path, key))
+
+        # Text and annotations may have been parsed by another process,
+        # valid if their files (but not necessarily metadata) are same.
+        # Parses are shared in bundles if enabled, otherwise in the
+        # shared cache, never both.
+        paths = [extensions[key] for key in annset_keys]
+        content_paths = set(paths + [extensions['txt']])
+        content_stamp = tuple(s for s in stamp if s[0] in content_paths)
+        bundles = conf.get_document_bundles()
+        shared = None if bundles else get_shared_cache()
+        shared_key = cache_key(root_path, 'document', *annset_keys)
+        cached = None
+        if bundles:
+            cached = self._read_bundle(collection, document, annset_keys,
+                                       content_stamp)
+        elif shared is not None:
+            cached = shared.get(shared_key, content_stamp)
+        if cached is not None:
+            text, annsets = cached
+        else:
+            text = self.get_document_text(collection, document)
+            # Fan out parsing of many large annotation sets
+            parallel = (parallel_enabled(len(paths)) and
+                        sum(os.path.getsize(p) for p in paths) >=
+                        conf.get_parallel_min_parse_bytes())
+            parsed = starmap(load_standoff, [(p,) for p in paths], parallel)
+            annsets = OrderedDict(zip(annset_keys, parsed))
+            if bundles:
+                self._write_bundle(collection, document, content_stamp,
+                                   text, annsets)
+            elif shared is not None:
+                shared.put(shared_key, content_stamp, (text, annsets))
+
+        _document_cache.put(root_path, stamp,
+                            (text, annsets, metadata, content_stamp),
+                            estimate_size(text, annsets), generation)
+        return DocumentData(text, annsets, metadata, candidate,
+                            content_stamp)
+
+    def _bundle_path(self, collection, document):
+        return bundle_path(os.path.join(conf.get_cachedir(), 'bundles',
+                                        collection), document)
+
+    def _read_bundle(self, collection, document, annset_keys, content_stamp):
+        # content_stamp is file_stamp() of the bundle sources
+        stamp = [[os.path.basename(s[0])] + list(s[1:])
+                 for s in content_stamp]
+        bundle = read_bundle(self._bundle_path(collection, document), stamp)
+        if bundle is None or list(bundle[1]) != annset_keys:
+            return None
+        return bundle
+
+    def _write_bundle(self, collection, document, content_stamp, text,
+                      annsets):
+        stamp = [[os.path.basename(s[0])] + list(s[1:])
+                 for s in content_stamp]
+        try:
+            write_bundle(self._bundle_path(collection, document), stamp,
+                         text, annsets)
+        except OSError as e:
+            app.logger.warning('failed to write bundle for {}: {}'.format(
+                document, e))
+
+    def set_document_picks(self, collection, document, accepted, rejected,
+                           candidate=0, version=None):
+        """Set picks for candidate and return (candidate_data, version)
+        as written. If version is given and the picks of the candidate
+        have another version, raise VersionConflict without writing.
+        Picks of other candidates of the document don't conflict."""
+        collection_dir = os.path.join(self.root_dir, collection)
+        path = os.path.join(collection_dir, document+'.json')
+        with self.collection_lock(collection):
+            data = self.get_document_metadata(collection, document)
+            candidate_data = get_candidates(data)[candidate]
+            if version is not None and version != get_version(candidate_data):
+                raise VersionConflict(candidate_data)
+            candidate_data['accepted'] = accepted
+            candidate_data['rejected'] = rejected
+            candidate_data['version'] = get_version(candidate_data) + 1
+            dir_mtime = picklog.dir_mtime(collection_dir)
+            self.safe_write_file(path, json.dumps(data, indent=4,
+                                                  sort_keys=True))
+            picklog.append(collection_dir, document, candidate, dir_mtime)
+        # don't wait for the watcher to see our own change
+        invalidate(self.root_dir, collection, document)
+        for listener in _pick_listeners:
+            listener(self.root_dir, collection, document, candidate,
+                     candidate_data)
+        return candidate_data, candidate_data['version']
+
+    def write_documents(self, collection, documents):
+        """Write documents given as (document, { extension: data })
+        into collection, replacing existing files."""
+        collection_dir = os.path.join(self.root_dir, collection)
+        written = []
+        try:
+            for document, files in documents:
+                for ext, data in files.items():
+                    fd, tmpfn = mkstemp(prefix='.', suffix='.tmp',
+                                        dir=collection_dir)
+                    written.append((tmpfn, os.path.join(
+                        collection_dir, '{}.{}'.format(document, ext))))
+                    with open(fd, 'wt', encoding='utf-8') as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+            with self.collection_lock(collection):
+                for tmpfn, fn in written:
+                    os.replace(tmpfn, fn)
+                written = []
+                fd = os.open(collection_dir, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        finally:
+            for tmpfn, _ in written:
+                try:
+                    os.remove(tmpfn)
+                except OSError:
+                    pass
+        invalidate(self.root_dir, collection, None)
+
+    @contextmanager
+    def collection_lock(self, collection):
+        """Exclusive lock on collection directory, for read-modify-write
+        of metadata by concurrent processes."""
+        fd = os.open(os.path.join(self.root_dir, collection), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)    # releases lock
+
+    def get_agreement(self, collection, sets):
+        """Return agreement between two annotation sets, see
+        agreement.collection_agreement()."""
+        if len(sets) != 2:
+            raise ValueError('agreement requires two sets, got {}'.format(
+                sets))
+        collection_dir = os.path.join(self.root_dir, collection)
+        cache_name = '{}.{}.json'.format(collection, '-'.join(sets))
+        cache_path = os.path.join(conf.get_cachedir(), 'agreement', cache_name)
+        if get_worker_count() < 2:
+            executor = None
+        else:
+            executor = get_executor()
+        return collection_agreement(collection_dir, sets, cache_path,
+                                    executor)
+
+    def search(self, collection, query, field=None, type_=None, annset=None,
+               page=1, per_page=20):
+        """Search collection, see search.SearchIndex.search(). The
+        index is updated in the background; raise IndexNotReady if it
+        has not been built yet."""
+        from .search import SearchIndex, IndexNotReady, start_update
+        collection_dir = os.path.join(self.root_dir, collection)
+        index_path = os.path.join(conf.get_cachedir(), 'search',
+                                  collection+'.sqlite')
+        index = SearchIndex(collection_dir, index_path)
+        try:
+            interval = conf.get_search_update_interval()
+            if not index.built or index.needs_update(interval):
+                start_update(collection_dir, index_path, interval)
+            if not index.built:
+                raise IndexNotReady(collection_dir)
+            return index.search(query, field, type_, annset, page, per_page)
+        finally:
+            index.close()
 
     @staticmethod
     def safe_write_file(fn, text):
-        """Atomic write using os.rename()."""
-        fd, tmpfn = mkstemp()
+        """Atomic write using os.replace()."""
+        # temporary file in the same directory, rename is not atomic
+        # (or possible) across filesystems
+        fd, tmpfn = mkstemp(prefix='.', suffix='.tmp',
+                            dir=os.path.dirname(fn))
         with open(fd, 'wt') as f:
             f.write(text)
             # https://stackoverflow.com/a/2333979
             f.flush()
             os.fsync(f.fileno())
-        os.rename(tmpfn, fn)
+        os.replace(tmpfn, fn)
 
     @staticmethod
     def read_ann(path, parse=True):
@@ -191,6 +632,197 @@ class FilesystemData(object):
             return parse_standoff(data, path)
 
 
+def _cache_path(root_dir, collection, document):
+    return os.path.join(root_dir, *(p for p in (collection, document)
+                                    if p is not None))
+
+
+def _in_path(key, path):
+    return key == path or key.startswith(path + os.sep)
+
+
+# Estimated memory use of a parsed annotation with its share of the
+# id map and interval index, and of other per-document data, in bytes
+ANNOTATION_SIZE = 550
+DOCUMENT_OVERHEAD = 2000
+
+
+def estimate_size(text, annsets):
+    """Return estimated memory use of parsed document in bytes."""
+    return (sys.getsizeof(text) + DOCUMENT_OVERHEAD +
+            ANNOTATION_SIZE * sum(len(a) for a in annsets.values()))
+
+
+class DocumentCache(object):
+    """LRU cache of parsed documents within a budget of estimated
+    bytes, validated by file stamps or invalidated on changes."""
+    def __init__(self):
+        # { key: (stamp, value, size, time stamp last checked) }
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0    # incremented on invalidation
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, stamp=None, max_age=None):
+        """Return cached value, checking stamp if given. If max_age is
+        given, return None if the stamp was last checked longer than
+        max_age seconds ago."""
+        with self.lock:
+            try:
+                cached_stamp, value, size, checked = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if stamp is not None:
+                if cached_stamp != stamp:
+                    self._remove(key)
+                    self.misses += 1
+                    return None
+                self.entries[key] = (cached_stamp, value, size, time.time())
+            elif max_age is not None and time.time() - checked > max_age:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, stamp, value, size, generation=None):
+        """Cache value of estimated size. If generation is given, only
+        cache if nothing was invalidated since it was read, as the value
+        may be stale."""
+        max_size = conf.get_document_cache_size()
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            if size > max_size:
+                return
+            self.entries[key] = (stamp, value, size, time.time())
+            self.size += size
+            while self.size > max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def invalidate(self, root_dir, collection, document):
+        path = _cache_path(root_dir, collection, document)
+        with self.lock:
+            self.generation += 1
+            for key in [k for k in self.entries if _in_path(k, path)]:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': conf.get_document_cache_size(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+_document_cache = DocumentCache()
+
+
+def document_cache_stats():
+    return _document_cache.stats()
+
+
+class ListingCache(object):
+    """Per-collection document entries (see iter_documents()), used
+    while watching for changes. Changed documents are reread on next
+    use, other changes to the collection cause a full reread."""
+    def __init__(self):
+        self.entries = {}    # { collection path: { document: entry } }
+        self.changed = {}    # { collection path: set of documents }
+        self.generations = defaultdict(int)    # full invalidations
+        self.reports = {}    # { collection path: validation report stamp }
+        self.lock = threading.Lock()
+
+    def get(self, db, collection):
+        key = _cache_path(db.root_dir, collection, None)
+        # the watcher ignores the (hidden) validation report
+        report = report_stamp(key)
+        with self.lock:
+            if self.reports.get(key) != report:
+                self._drop(key)
+                self.reports[key] = report
+            entries = self.entries.get(key)
+            changed = self.changed.pop(key, set())
+            generation = self.generations[key]
+        if entries is not None:
+            updated = [db.get_document_entry(collection, d) for d in changed]
+            with self.lock:
+                if None in updated:
+                    self._drop(key)    # document removed
+                elif self.generations[key] == generation:
+                    for entry in updated:
+                        entries[entry[0]] = entry
+                    return list(entries.values())
+                generation = self.generations[key]
+        entries = OrderedDict((e[0], e) for e in db.iter_documents(collection))
+        with self.lock:
+            # not cached if anything changed while reading
+            if self.generations[key] == generation:
+                self.entries[key] = entries
+        return list(entries.values())
+
+    def _drop(self, key):
+        self.entries.pop(key, None)
+        self.changed.pop(key, None)
+        self.generations[key] += 1
+
+    def invalidate(self, root_dir, collection, document):
+        with self.lock:
+            if collection is None:
+                for key in [k for k in self.entries if _in_path(k, root_dir)]:
+                    self._drop(key)
+                return
+            key = _cache_path(root_dir, collection, None)
+            entries = self.entries.get(key)
+            if entries is None or document is None or document not in entries:
+                self._drop(key)
+            else:
+                self.changed.setdefault(key, set()).add(document)
+
+
+_listing_cache = ListingCache()
+
+
+def invalidate(root_dir, collection, document):
+    """Drop cached data for changed document or collection."""
+    _document_cache.invalidate(root_dir, collection, document)
+    _listing_cache.invalidate(root_dir, collection, document)
+
+
+watch.subscribe(invalidate)
+
+
+# Functions called with (root_dir, collection, document, candidate,
+# candidate_data) after picks are written
+_pick_listeners = []
+
+
+def add_pick_listener(func):
+    _pick_listeners.append(func)
+
+
+def file_stamp(paths):
+    """Return value identifying the current state of the given files."""
+    stamp = []
+    for path in sorted(paths):
+        st = os.stat(path)
+        stamp.append((path, st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
+
+
 def get_db():
     data_dir = conf.get_datadir()
     return FilesystemData(data_dir)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Precomputed font metrics for estimating rendered text width.
+
+Metrics are read from a JSON file stored next to the font file
+(e.g. OpenSans-Regular.ttf.metrics.json). The file records the
+digest of the font it was generated from and is regenerated when
+missing or when the font changes. fontTools is only imported for
+regeneration.
+"""
+
+import sys
+import os
+import json
+import hashlib
+
+from logging import warning
+
+
+# Increment when the format of the metrics file changes
+METRICS_VERSION = 1
+
+METRICS_SUFFIX = '.metrics.json'
+
+
+class FontMetrics(object):
+    """Advance widths of characters in a font."""
+    def __init__(self, units_per_em, default_width, widths):
+        self.units_per_em = units_per_em
+        self.default_width = default_width
+        self.widths = widths
+
+    def text_width(self, text, point_size):
+        """Return width of text in given point size."""
+        get, default = self.widths.get, self.default_width
+        total = sum(get(ord(c), default) for c in text)
+        return total * point_size / self.units_per_em
+
+    @classmethod
+    def from_dict(cls, data):
+        widths = { int(k): v for k, v in data['widths'].items() }
+        return cls(data['units_per_em'], data['default_width'], widths)
+
+
+def metrics_path(font_path):
+    return font_path + METRICS_SUFFIX
+
+
+def font_digest(font_path):
+    with open(font_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def generate_metrics(font_path, digest=None):
+    """Return metrics dictionary for given font file."""
+    try:
+        from fontTools.ttLib import TTFont
+    except ImportError:
+        print('Failed `import fontTools`, try `pip3 install fonttools`',
+              file=sys.stderr)
+        raise
+    if digest is None:
+        digest = font_digest(font_path)
+    ttfont = TTFont(font_path)
+    # Following https://stackoverflow.com/a/48357457
+    tcmap = ttfont['cmap'].getcmap(3,1).cmap
+    glyphset = ttfont.getGlyphSet()
+    widths = {}
+    for codepoint, glyph in sorted(tcmap.items()):
+        if glyph in glyphset:
+            widths[str(codepoint)] = glyphset[glyph].width
+    return {
+        'version': METRICS_VERSION,
+        'font': os.path.basename(font_path),
+        'sha1': digest,
+        'units_per_em': ttfont['head'].unitsPerEm,
+        'default_width': glyphset['.notdef'].width,
+        'widths': widths,
+    }
+
+
+def write_metrics(metrics, path):
+    """Atomic write of metrics to path."""
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmppath, 'wt') as f:
+        json.dump(metrics, f, sort_keys=True)
+    os.replace(tmppath, path)
+
+
+def read_metrics(path, digest):
+    """Return metrics stored in path if current, None otherwise."""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != METRICS_VERSION or data.get('sha1') != digest:
+        return None
+    return data
+
+
+def load_font_metrics(font_path):
+    """Return FontMetrics for font, regenerating metrics file if needed."""
+    path = metrics_path(font_path)
+    digest = font_digest(font_path)
+    data = read_metrics(path, digest)
+    if data is None:
+        warning('regenerating font metrics {}'.format(path))
+        data = generate_metrics(font_path, digest)
+        try:
+            write_metrics(data, path)
+        except OSError as e:
+            warning('failed to write {}: {}'.format(path, e))
+    return FontMetrics.from_dict(data)
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Generate font metrics files.')
+    ap.add_argument('font', nargs='+', help='font files (TTF)')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    for fn in args.font:
+        write_metrics(generate_metrics(fn), metrics_path(fn))
+        print('wrote {}'.format(metrics_path(fn)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
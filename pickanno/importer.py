@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""Import documents into a collection from tar or JSONL dumps.
+
+Tar archives contain document files named as in collections
+(e.g. doc1.txt, doc1.ann1, doc1.ann2 and doc1.json, directories are
+ignored). JSONL files contain one document per line as
+
+    {"document": "doc1", "text": "...", "metadata": { ... },
+     "annsets": { "ann1": "<standoff>", "ann2": "<standoff>" }}
+
+Input is read as a stream. Documents are checked in worker processes
+as by validate and written in batches. Imported documents are
+recorded in a log in the collection directory, so an interrupted
+import can be resumed with --resume.
+"""
+
+import sys
+import os
+import json
+import time
+import tarfile
+
+from collections import OrderedDict
+from multiprocessing import Pool
+from logging import warning
+
+from .db import FilesystemData
+from .validate import check_document, split_warnings, format_error
+
+
+# Log of imported documents in collection directory
+IMPORT_LOG = '.import.log'
+
+# Extensions not available to annotation sets in JSONL ("error" marks
+# unreadable input, see _check())
+RESERVED_EXTENSIONS = ('txt', 'json', 'error')
+
+
+def read_jsonl(path):
+    """Generate (document, { extension: data }) from JSONL file."""
+    with open(path, encoding='utf-8') as f:
+        for ln, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                files = { 'txt': record['text'] }
+                files['json'] = json.dumps(record.get('metadata', {}),
+                                           indent=4, sort_keys=True)
+                annsets = record.get('annsets', {})
+                reserved = [k for k in annsets if k in RESERVED_EXTENSIONS]
+                if reserved:
+                    raise ValueError('reserved annset name {}'.format(
+                        reserved[0]))
+                files.update(annsets)
+                if not isinstance(record['document'], str) or not all(
+                        isinstance(d, str) for d in files.values()):
+                    raise TypeError('document name and data must be strings')
+                yield record['document'], files
+            except (ValueError, KeyError, TypeError) as e:
+                yield '{}:{}'.format(path, ln), { 'error': str(e) }
+
+
+def read_tar(path):
+    """Generate (document, { extension: data }) from tar file. Each
+    document is output after the last of its files, which is known
+    while the archive is sorted by name (tar --sort=name). Files of
+    unsorted archives are held in memory until the end."""
+    pending = OrderedDict()
+    previous, ordered = None, True
+    output = set()
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            root, ext = os.path.splitext(name)
+            if not ext or name.startswith('.'):
+                continue
+            if previous is not None and root != previous and ordered:
+                if root < previous:
+                    warning('{} not sorted by name, reading all of it '
+                            'before import'.format(path))
+                    ordered = False
+                else:
+                    output.add(previous)
+                    yield previous, pending.pop(previous)
+            data = tar.extractfile(member).read().decode('utf-8')
+            pending.setdefault(root, {})[ext[1:]] = data
+            previous = root
+    for document, files in pending.items():
+        if document in output:
+            # part of the document was output before order was lost
+            files = { 'error': 'files not adjacent in {}'.format(path) }
+        yield document, files
+
+
+def read_input(path):
+    if path.endswith('.jsonl'):
+        return read_jsonl(path)
+    else:
+        return read_tar(path)
+
+
+def check_names(document, extensions):
+    """Return errors in document name and file extensions that would
+    place files outside the collection or hide them."""
+    errors = []
+    for name in [document] + list(extensions):
+        if (not isinstance(name, str) or not name or name.startswith('.')
+            or '/' in name or os.sep in name or '..' in name or
+            '\0' in name):
+            errors.append('invalid name {!r}'.format(name))
+    errors.extend('invalid extension {!r}'.format(e)
+                  for e in extensions if isinstance(e, str) and '.' in e)
+    return errors
+
+
+def _check(item):
+    document, files = item
+    if 'error' in files:
+        return document, files, [files['error']]
+    errors = check_names(document, files)
+    if errors:
+        return document, files, errors
+    # malformed picks are imported, they count as not judged
+    errors, _ = split_warnings(check_document(files))
+    errors = [format_error(e) for e in errors]
+    return document, files, errors
+
+
+def read_log(collection_dir):
+    try:
+        with open(os.path.join(collection_dir, IMPORT_LOG)) as f:
+            return set(line.rstrip('\n') for line in f)
+    except FileNotFoundError:
+        return set()
+
+
+class Importer(object):
+    """Writes checked documents into a collection in batches."""
+    def __init__(self, db, collection, batch_size=100, overwrite=False,
+                 done=()):
+        self.db = db
+        self.collection = collection
+        self.collection_dir = os.path.join(db.root_dir, collection)
+        self.batch_size = batch_size
+        self.overwrite = overwrite
+        self.done = set(done)
+        self.existing = set(db.get_documents(collection))
+        self.batch = []
+        self.log = open(os.path.join(self.collection_dir, IMPORT_LOG), 'a')
+        self.imported = self.skipped = self.invalid = self.bytes = 0
+
+    def skip(self, document):
+        """Return True if document need not be checked."""
+        if document in self.done:
+            return True
+        return document in self.existing and not self.overwrite
+
+    def add(self, document, files, errors):
+        if errors:
+            self.invalid += 1
+            for error in errors:
+                print('{}: {}'.format(document, error), file=sys.stderr)
+            return
+        if self.skip(document):
+            self.skipped += 1
+            return
+        self.batch.append((document, files))
+        self.bytes += sum(len(d) for d in files.values())
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        self.db.write_documents(self.collection, self.batch)
+        # logged only after the batch is on disk
+        for document, _ in self.batch:
+            print(document, file=self.log)
+            self.done.add(document)
+        self.log.flush()
+        self.imported += len(self.batch)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.log.close()
+
+
+def _report(importer, start, out=sys.stderr):
+    elapsed = max(time.time() - start, 1e-6)
+    print('{} imported, {} skipped, {} invalid in {:.1f}s '
+          '({:.0f} docs/s, {:.1f} MB/s)'.format(
+              importer.imported, importer.skipped, importer.invalid,
+              elapsed, importer.imported/elapsed,
+              importer.bytes/elapsed/2**20), file=out)
+
+
+def import_documents(db, collection, inputs, jobs=None, batch_size=100,
+                     overwrite=False, resume=False, report_interval=10):
+    """Import documents from input files into collection and return
+    the Importer with counts."""
+    collection_dir = os.path.join(db.root_dir, collection)
+    os.makedirs(collection_dir, exist_ok=True)
+    log_path = os.path.join(collection_dir, IMPORT_LOG)
+    if not resume and os.path.exists(log_path):
+        os.remove(log_path)
+    done = read_log(collection_dir) if resume else set()
+    importer = Importer(db, collection, batch_size, overwrite, done)
+    start = last_report = time.time()
+
+    def items():
+        for path in inputs:
+            for document, files in read_input(path):
+                if importer.skip(document):
+                    importer.skipped += 1
+                else:
+                    yield document, files
+
+    try:
+        with Pool(jobs) as pool:
+            for document, files, errors in pool.imap(_check, items(),
+                                                     chunksize=16):
+                importer.add(document, files, errors)
+                if time.time() - last_report > report_interval:
+                    _report(importer, start)
+                    last_report = time.time()
+    finally:
+        importer.close()
+    _report(importer, start)
+    return importer
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Import documents into collection.')
+    ap.add_argument('-b', '--batch', default=100, type=int,
+                    help='documents per write batch')
+    ap.add_argument('-j', '--jobs', default=None, type=int,
+                    help='number of worker processes')
+    ap.add_argument('-o', '--overwrite', default=False, action='store_true',
+                    help='replace existing documents (and their picks)')
+    ap.add_argument('-r', '--resume', default=False, action='store_true',
+                    help='skip documents imported by an earlier run')
+    ap.add_argument('datadir', help='data directory')
+    ap.add_argument('collection', help='collection to import into')
+    ap.add_argument('input', nargs='+', help='tar or JSONL files')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    db = FilesystemData(args.datadir)
+    importer = import_documents(db, args.collection, args.input, args.jobs,
+                                args.batch, args.overwrite, args.resume)
+    return 1 if importer.invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
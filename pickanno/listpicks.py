@@ -20,15 +20,21 @@ def process(fn, options):
     with open(fn, encoding=options.encoding) as f:
         data = json.load(f)
     doc_id = os.path.splitext(os.path.basename(fn))[0]
-    source = data['candidate_source']
-    c_id = data['candidate_id']
-    c_set = data['candidate_set']
+    # multi-candidate format lists candidates, otherwise data is one
+    for candidate in data.get('candidates', [data]):
+        process_candidate(fn, doc_id, data, candidate, options)
+
+
+def process_candidate(fn, doc_id, data, candidate, options):
+    source = candidate.get('candidate_source', data.get('candidate_source'))
+    c_id = candidate['candidate_id']
+    c_set = candidate['candidate_set']
     c_annfn = '{}.{}'.format(os.path.splitext(fn)[0], c_set)
     c_anns = load_standoff(c_annfn, encoding=options.encoding)
-    c_ann = [a for a in c_anns if a.id == c_id][0]
+    c_ann = c_anns.get(c_id)
     c_type = c_ann.type
-    accepted = data.get('accepted', [])
-    rejected = data.get('rejected', [])
+    accepted = candidate.get('accepted', [])
+    rejected = candidate.get('rejected', [])
     if c_set in accepted:
         status = 'accepted'
     elif c_set in rejected:
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+"""Load test replaying annotator sessions.
+
+Each session opens the collection, asks for the next unjudged
+document and then repeatedly opens the candidate view (and its data
+with CLIENT_RENDERING), picks with a hotkey choice (again, once,
+after a version conflict) and follows the link to the next candidate,
+as the client does on Enter. Sessions run concurrently in threads,
+either in-process through the WSGI interface on a copy of a collection
+or against a running server. The report gives throughput, latency
+percentiles and version conflicts for each step, and can be saved as JSON and compared with a report saved earlier, e.g. for
+another commit. Sessions are seeded by their number, so runs with the
+same parameters make the same requests.
+"""
+
+import sys
+import os
+import re
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+
+from html import unescape
+from http.cookiejar import CookieJar
+from urllib.parse import quote, urlencode
+
+from .protocol import PICK_FIRST, PICK_LAST, PICK_ALL, PICK_NONE
+
+
+# Steps of a session, reported separately
+COLLECTION = 'collection'
+NEXT = 'next'
+CANDIDATE = 'candidate'
+DATA = 'data'
+PICK = 'pick'
+
+STEPS = (COLLECTION, NEXT, CANDIDATE, DATA, PICK)
+
+# Pick again after a version conflict, as an annotator who has seen
+# the other picks (see pickanno.js) may, at most this many times
+MAX_PICK_RETRIES = 1
+
+# Choices of the arrow hotkeys (see HOTKEYS in config.py)
+CHOICES = (PICK_FIRST, PICK_LAST, PICK_ALL, PICK_NONE)
+
+PERCENTILES = (50, 95, 99)
+
+# Values set in pickanno.html and visbase.html
+_data_url_re = re.compile(r'const DATA_URL = "([^"]*)";')
+_pick_url_re = re.compile(r'const PICK_ANNO_URL = "([^"]*)";')
+_version_re = re.compile(r'var VERSION = (\d+);')
+_next_url_re = re.compile(r'<a id="nav-next-link" href="([^"]*)">')
+
+
+class WsgiClient(object):
+    """Requests to the app in this process."""
+    def __init__(self, app):
+        self.client = app.test_client()    # keeps cookies
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpClient(object):
+    """Requests to a server."""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def get(self, path):
+        try:
+            with self.opener.open(self.base_url + path) as response:
+                return response.status, response.read().decode('utf-8')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode('utf-8')
+
+
+def _find(regex, html):
+    m = regex.search(html)
+    return unescape(m.group(1)) if m else None
+
+
+def run_session(client, collection, steps, picks, rng, record):
+    """Replay annotator session, calling record(step, seconds, status)
+    for each request."""
+    def get(step, path):
+        start = time.perf_counter()
+        status, body = client.get(path)
+        record(step, time.perf_counter()-start, status)
+        return status, body
+
+    base = '/pickanno/{}/'.format(quote(collection))
+    get(COLLECTION, base)
+    status, body = get(NEXT, base+'_next?format=json')
+    url = json.loads(body)['url'] if status == 200 else None
+    for _ in range(steps):
+        if url is None:
+            break
+        status, page = get(CANDIDATE, url)
+        if status != 200:
+            break
+        data_url = _find(_data_url_re, page)
+        if data_url is not None:
+            get(DATA, data_url)
+        pick_url = _find(_pick_url_re, page)
+        version = _find(_version_re, page)
+        if picks and pick_url is not None:
+            choice = rng.choice(CHOICES)
+            for _ in range(MAX_PICK_RETRIES+1):
+                params = { 'choice': choice }
+                if version is not None:
+                    params['version'] = version
+                separator = '&' if '?' in pick_url else '?'
+                status, body = get(PICK, pick_url + separator +
+                                   urlencode(params))
+                if status != 409:
+                    break
+                # the client shows the other picks with their version
+                version = json.loads(body).get('version')
+        url = _find(_next_url_re, page)
+
+
+def percentile(values, p):
+    """Return nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))    # ceil
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(results, seconds):
+    """Return report for [(step, seconds, status)] taking seconds."""
+    steps = {}
+    for step in STEPS:
+        times = sorted(t for s, t, _ in results if s == step)
+        if not times:
+            continue
+        steps[step] = {
+            'requests': len(times),
+            'errors': sum(1 for s, _, c in results if s == step and c >= 500),
+            'conflicts': sum(1 for s, _, c in results
+                             if s == step and c == 409),
+            'mean': sum(times) / len(times),
+        }
+        for p in PERCENTILES:
+            steps[step]['p{}'.format(p)] = percentile(times, p)
+    return {
+        'seconds': seconds,
+        'requests': len(results),
+        'throughput': len(results) / seconds if seconds else None,
+        'steps': steps,
+    }
+
+
+def load_test(make_client, collection, sessions, concurrency, steps,
+              picks=True):
+    """Run sessions with concurrency threads and return report."""
+    results, lock = [], threading.Lock()
+    numbers = iter(range(sessions))
+
+    def record(step, seconds, status):
+        with lock:
+            results.append((step, seconds, status))
+
+    def worker():
+        while True:
+            with lock:
+                number = next(numbers, None)
+            if number is None:
+                return
+            run_session(make_client(), collection, steps, picks,
+                        random.Random(number), record)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(results, time.time() - start)
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '{:.1f}'.format(seconds*1000)
+
+
+def format_report(report):
+    lines = ['{:<12}{:>9}{:>8}{:>10}{:>9}{:>9}{:>9}{:>9}'.format(
+        'step', 'requests', 'errors', 'conflicts', 'mean', 'p50', 'p95',
+        'p99')]
+    for step, s in report['steps'].items():
+        lines.append('{:<12}{:>9}{:>8}{:>10}{:>9}{:>9}{:>9}{:>9}'.format(
+            step, s['requests'], s['errors'], s.get('conflicts', 0),
+            _ms(s['mean']),
+            *(_ms(s['p{}'.format(p)]) for p in PERCENTILES)))
+    lines.append('{} requests in {:.1f}s, {:.1f} requests/s, times in '
+                 'ms'.format(report['requests'], report['seconds'],
+                             report['throughput'] or 0))
+    return '\n'.join(lines)
+
+
+def format_comparison(old, new):
+    lines = ['{:<12}{:>19}{:>19}{:>19}'.format(
+        'step', *('p{} old/new'.format(p) for p in PERCENTILES))]
+    for step in STEPS:
+        if step not in old['steps'] and step not in new['steps']:
+            continue
+        values = []
+        for p in PERCENTILES:
+            key = 'p{}'.format(p)
+            values.append('{}/{}'.format(
+                _ms(old['steps'].get(step, {}).get(key)),
+                _ms(new['steps'].get(step, {}).get(key))))
+        lines.append('{:<12}{:>19}{:>19}{:>19}'.format(step, *values))
+    lines.append('requests/s {:.1f} ({}) -> {:.1f} ({})'.format(
+        old['throughput'] or 0, old.get('commit'),
+        new['throughput'] or 0, new.get('commit')))
+    if old.get('parameters') != new.get('parameters'):
+        lines.append('warning: parameters differ: {} vs {}'.format(
+            old.get('parameters'), new.get('parameters')))
+    return '\n'.join(lines)
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Load test replaying annotator sessions.')
+    ap.add_argument('-c', '--concurrency', default=8, type=int,
+                    help='number of concurrent sessions')
+    ap.add_argument('-s', '--sessions', default=50, type=int,
+                    help='number of sessions')
+    ap.add_argument('-n', '--steps', default=20, type=int,
+                    help='candidates viewed per session')
+    ap.add_argument('-u', '--url', default=None,
+                    help='server to test (e.g. http://localhost:5000), '
+                    'default in-process on a copy of the collection')
+    ap.add_argument('-d', '--datadir', default='data',
+                    help='data directory for in-process test')
+    ap.add_argument('-P', '--no-picks', default=False, action='store_true',
+                    help='only view, do not pick (for servers with real '
+                    'data)')
+    ap.add_argument('-o', '--output', default=None,
+                    help='save report as JSON')
+    ap.add_argument('-C', '--compare', default=None, metavar='REPORT',
+                    help='compare with report saved earlier')
+    ap.add_argument('collection', help='collection to annotate')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    parameters = {
+        k: getattr(args, k) for k in
+        ('collection', 'concurrency', 'sessions', 'steps', 'url', 'no_picks')
+    }
+
+    def run(make_client):
+        return load_test(make_client, args.collection, args.sessions,
+                         args.concurrency, args.steps, not args.no_picks)
+
+    if args.url is not None:
+        report = run(lambda: HttpClient(args.url))
+    else:
+        import logging
+        from . import create_app
+        tmpdir = tempfile.mkdtemp()
+        try:
+            datadir = os.path.join(tmpdir, 'data')
+            shutil.copytree(os.path.join(args.datadir, args.collection),
+                            os.path.join(datadir, args.collection))
+            app = create_app()
+            app.config.update(DATADIR=datadir,
+                              CACHEDIR=os.path.join(tmpdir, 'cache'))
+            app.logger.setLevel(logging.ERROR)    # e.g. pick conflicts
+            report = run(lambda: WsgiClient(app))
+        finally:
+            shutil.rmtree(tmpdir)
+    report['commit'] = _commit()
+    report['parameters'] = parameters
+    print(format_report(report))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(format_comparison(json.load(f), report))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    errors = sum(s['errors'] for s in report['steps'].values())
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
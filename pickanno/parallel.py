@@ -0,0 +1,40 @@
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pickanno import conf
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_worker_count():
+    workers = conf.get_parallel_workers()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def get_executor():
+    """Return process pool shared by this process, creating it if needed."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(get_worker_count())
+        return _executor
+
+
+def parallel_enabled(annset_count):
+    if get_worker_count() < 2:
+        return False
+    return annset_count >= conf.get_parallel_min_annsets()
+
+
+def starmap(func, args_list, parallel=False):
+    """Return [func(*args) for args in args_list], computed in worker
+    processes if parallel is True."""
+    if not parallel or len(args_list) < 2:
+        return [func(*args) for args in args_list]
+    return list(get_executor().map(func, *zip(*args_list)))
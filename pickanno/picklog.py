@@ -0,0 +1,137 @@
+"""Log of picks in a collection, shared by processes.
+
+Writing picks replaces the metadata file and so changes the
+modification time of the collection directory, which would otherwise
+look like any other change to the collection to processes that keep
+data derived from it (see collectionindex). Each pick is appended to a
+hidden log file in the collection directory under the collection
+lock, with the modification time of the directory before and after
+the write. A process that knows the state of the directory at some
+position in the log reads the entries after it, and if they account
+for all changes to the directory, only updates the documents picked.
+As a change within the timestamp granularity of the last one leaves
+the modification time as it was, the entries of the directory are
+also compared with an earlier scan after picks and while the
+modification time is recent (cf. watch.PollingWatcher).
+"""
+
+import os
+import time
+
+from collections import namedtuple
+
+
+LOG_NAME = '.picks.log'
+
+# Size in bytes after which the log is started over
+MAX_LOG_SIZE = 1024*1024
+
+# Modification times more recent than this may hide further changes
+RACY_SECONDS = 2
+
+Entry = namedtuple('Entry', 'document candidate dir_mtime_before '
+                   'dir_mtime_after')
+
+# Position in log as (inode, offset), changes when the log is started over
+Position = namedtuple('Position', 'inode offset')
+
+
+def log_path(collection_dir):
+    return os.path.join(collection_dir, LOG_NAME)
+
+
+def dir_mtime(collection_dir):
+    return os.stat(collection_dir).st_mtime_ns
+
+
+def is_racy(mtime):
+    """Return True if a change to the directory now could leave its
+    modification time at mtime."""
+    return time.time_ns() - mtime < RACY_SECONDS*10**9
+
+
+def scan(collection_dir):
+    """Return { name: inode } for the files of documents in collection,
+    which changes when files are added, removed or replaced."""
+    with os.scandir(collection_dir) as it:
+        return { e.name: e.inode() for e in it if not e.name.startswith('.') }
+
+
+def unlogged_changes(old, new, documents):
+    """Return True if scans old and new differ by more than the
+    metadata files of documents picked."""
+    picked = set(d + '.json' for d in documents)
+    changed = set(old.items()) ^ set(new.items())
+    return any(name not in picked for name, _ in changed)
+
+
+def append(collection_dir, document, candidate, dir_mtime_before):
+    """Log pick written to collection. Call with the collection locked,
+    after writing the metadata."""
+    path = log_path(collection_dir)
+    try:
+        if os.path.getsize(path) > MAX_LOG_SIZE:
+            os.remove(path)    # readers see a new inode and rebuild
+    except OSError:
+        pass    # no log yet
+    with open(path, 'a', encoding='utf-8') as f:
+        # after creating the log, which changes the directory too
+        line = '{}\t{}\t{}\t{}\n'.format(document, candidate,
+                                         dir_mtime_before,
+                                         dir_mtime(collection_dir))
+        f.write(line)
+
+
+def current_position(collection_dir):
+    """Return Position at the end of the log."""
+    try:
+        st = os.stat(log_path(collection_dir))
+    except OSError:
+        return Position(None, 0)
+    return Position(st.st_ino, st.st_size)
+
+
+def read(collection_dir, position):
+    """Return (entries, position) for the complete entries after
+    position, or (None, None) if the log was started over since."""
+    try:
+        f = open(log_path(collection_dir), 'rb')
+    except OSError:
+        if position.inode is None:
+            return [], position
+        return None, None
+    with f:
+        inode = os.fstat(f.fileno()).st_ino
+        if position.inode is None:
+            offset = 0
+        elif position.inode == inode:
+            offset = position.offset
+        else:
+            return None, None
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1    # partial line still being written
+    entries = []
+    for line in data[:end].decode('utf-8').splitlines():
+        document, candidate, before, after = line.rsplit('\t', 3)
+        entries.append(Entry(document, int(candidate), int(before),
+                             int(after)))
+    return entries, Position(inode, offset+end)
+
+
+def changes_since(collection_dir, position, known_mtime):
+    """Return (documents, position, mtime) for the documents picked
+    since position, if the picks logged account for all changes to the
+    directory since it had modification time known_mtime, otherwise
+    (None, None, None)."""
+    entries, position = read(collection_dir, position)
+    if entries is None:
+        return None, None, None
+    mtime = known_mtime
+    for entry in entries:
+        if entry.dir_mtime_before != mtime:
+            return None, None, None    # something else changed in between
+        mtime = entry.dir_mtime_after
+    if dir_mtime(collection_dir) != mtime:
+        return None, None, None
+    return set(e.document for e in entries), position, mtime
@@ -0,0 +1,189 @@
+"""Profiling of individual requests.
+
+A request is profiled if it carries the PROFILE_TOKEN of the
+configuration in the X-Profile header or the profile query parameter,
+or, if PROFILE_SAMPLE_RATE is N, for one in N requests. The thread
+serving the request is sampled for collapsed stacks (one line per
+stack with frames separated by ';' and the sample count, as read by
+flamegraph.pl and speedscope) and run under cProfile for a summary of
+the functions with the highest cumulative time. Both are written to
+PROFILE_DIR, named by time, process, collection and document, and the
+name is returned in the X-Profile response header.
+"""
+
+import os
+import re
+import sys
+import time
+import hmac
+import cProfile
+import pstats
+import threading
+
+from io import StringIO
+from itertools import count
+from collections import Counter
+from logging import warning
+
+from flask import g, request
+
+from pickanno import conf
+
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAMETER = 'profile'
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.001
+
+# Number of functions in the summary
+TOP_FUNCTIONS = 30
+
+
+class StackSampler(threading.Thread):
+    """Counts stacks of a thread, sampled at intervals."""
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name,
+                    code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(s, c)
+                       for s, c in sorted(self.stacks.items()))
+
+
+class RequestProfile(object):
+    """Profile of the request being served by the current thread."""
+    def __init__(self):
+        self.start = time.time()
+        self.sampler = StackSampler(threading.get_ident())
+        self.profile = cProfile.Profile()
+
+    def enable(self):
+        self.sampler.start()
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            # another profiler active in this thread, stacks only
+            warning('cProfile not available: {}'.format(e))
+            self.profile = None
+
+    def disable(self):
+        if self.profile is not None:
+            self.profile.disable()
+        self.sampler.stop()
+        self.seconds = time.time() - self.start
+
+    def summary(self, top=TOP_FUNCTIONS):
+        if self.profile is None:
+            return ''
+        out = StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(top)
+        return out.getvalue()
+
+
+def _safe_name(s):
+    return re.sub(r'[^A-Za-z0-9._-]', '_', s)
+
+
+_profiles = count()
+
+
+def profile_name(start):
+    """Return base name of profile files for the current request."""
+    args = request.view_args or {}
+    parts = [time.strftime('%Y%m%d-%H%M%S', time.localtime(start)),
+             str(os.getpid()), str(next(_profiles))]
+    if 'collection' in args:
+        parts.append(args['collection'])
+        if 'document' in args:
+            parts.append(args['document'])
+    else:
+        parts.append(request.endpoint or 'none')
+    return _safe_name('-'.join(parts))
+
+
+def write_profile(profile, name, status):
+    directory = conf.get_profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, name)
+    with open(base+'.collapsed', 'w') as f:
+        f.write(profile.sampler.collapsed())
+    with open(base+'.txt', 'w') as f:
+        f.write('{} {}\nstatus {}, {:.3f}s, {} samples\n\n'.format(
+            request.method, request.full_path, status, profile.seconds,
+            sum(profile.sampler.stacks.values())))
+        f.write(profile.summary())
+
+
+_requests = count()
+
+
+def should_profile():
+    token = conf.get_profile_token()
+    if token is not None:
+        given = (request.headers.get(PROFILE_HEADER) or
+                 request.args.get(PROFILE_PARAMETER))
+        if given is not None and hmac.compare_digest(given.encode(),
+                                                     token.encode()):
+            return True
+    rate = conf.get_profile_sample_rate()
+    return bool(rate) and next(_requests) % rate == 0
+
+
+def start_profile():
+    if should_profile():
+        g.profile = RequestProfile()
+        g.profile.enable()
+
+
+def _finish_profile(status):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    profile.disable()
+    name = profile_name(profile.start)
+    try:
+        write_profile(profile, name, status)
+    except OSError as e:
+        warning('failed to write profile {}: {}'.format(name, e))
+        return None
+    return name
+
+
+def finish_profile(response):
+    name = _finish_profile(response.status_code)
+    if name is not None:
+        response.headers[PROFILE_HEADER] = name
+    return response
+
+
+def abort_profile(err=None):
+    # left if the request failed before finish_profile()
+    _finish_profile('error')
+
+
+def init(app):
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(abort_profile)
@@ -5,3 +5,4 @@ PICK_LAST = 'pick-last'
 PICK_ALL = 'pick-all'
 PICK_NONE = 'pick-none'
 CLEAR_PICKS = 'clear-picks'
+PICK_NTH = 'pick-nth-'    # prefix, followed by 1-based index
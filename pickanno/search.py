@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+"""Full-text search over document texts and annotated strings.
+
+Each collection has an SQLite FTS5 index with one entry per document
+text and one per distinct annotated string of each type in each
+annotation set. The index is updated incrementally: documents whose
+text or annotation files changed (by mtime and size) are reindexed,
+removed documents are dropped. The server updates indexes in a
+background thread (see start_update()) and answers searches of a
+collection whose index is still being built with 503; the index can
+also be built beforehand with this script.
+"""
+
+import sys
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from html import escape
+from logging import warning
+
+from .db import get_annset_keys
+from .standoff import load_standoff
+
+
+# Increment when the index schema or content changes
+INDEX_VERSION = 2
+
+FIELD_TEXT = 'text'
+FIELD_ANNOTATION = 'annotation'
+
+# Entry rowids are document id << ENTRY_BITS | entry number, allowing
+# document matches to be counted and grouped from the index alone.
+ENTRY_BITS = 20
+
+# Markers for matches in snippets, replaced with HTML after escaping
+_MATCH_START, _MATCH_END = '\x02', '\x03'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)',
+    'CREATE TABLE IF NOT EXISTS documents ('
+    ' id INTEGER PRIMARY KEY, document TEXT UNIQUE, stamp TEXT)',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5('
+    ' field UNINDEXED, annset UNINDEXED, type UNINDEXED, content)',
+]
+
+
+class IndexNotReady(Exception):
+    """Search index of collection has not been built yet."""
+    def __init__(self, collection_dir):
+        super().__init__('search index for {} is being built'.format(
+            os.path.basename(collection_dir)))
+
+
+class SearchIndex(object):
+    """Search index for the documents in one collection directory."""
+    def __init__(self, collection_dir, index_path):
+        self.collection_dir = collection_dir
+        self.index_path = index_path
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(index_path, timeout=30)
+        if self._get_meta('version') != INDEX_VERSION:
+            with self.db:
+                for table in ('meta', 'documents', 'entries'):
+                    self.db.execute('DROP TABLE IF EXISTS {}'.format(table))
+                for statement in SCHEMA:
+                    self.db.execute(statement)
+                self._set_meta('version', INDEX_VERSION)
+
+    def close(self):
+        self.db.close()
+
+    def _get_meta(self, key):
+        try:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                                  (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None    # no schema
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, value))
+
+    def _scan(self):
+        """Return { document: (paths, stamp) } for current files."""
+        files_by_root = {}
+        with os.scandir(self.collection_dir) as it:
+            for entry in it:
+                root, ext = os.path.splitext(entry.name)
+                if ext and entry.is_file():
+                    files_by_root.setdefault(root, {})[ext[1:]] = entry
+        documents = {}
+        for root, files in files_by_root.items():
+            if 'txt' not in files:
+                continue
+            keys = get_annset_keys(files, {})
+            paths = { k: files[k].path for k in ['txt', 'json'] + keys
+                      if k in files }
+            stamp = []
+            for k in ['txt'] + keys:
+                st = files[k].stat()
+                stamp.append((k, st.st_mtime_ns, st.st_size))
+            documents[root] = (paths, json.dumps(stamp))
+        return documents
+
+    @property
+    def built(self):
+        """True if the index has been built, possibly out of date."""
+        return self._get_meta('last_update') is not None
+
+    def needs_update(self, min_interval=0):
+        """Return False if the collection directory is unchanged since
+        the last update less than min_interval seconds ago."""
+        dir_mtime = os.stat(self.collection_dir).st_mtime_ns
+        last_update = self._get_meta('last_update') or 0
+        return not (self._get_meta('dir_mtime') == dir_mtime and
+                    time.time() - last_update < min_interval)
+
+    def update(self, min_interval=0):
+        """Reindex changed documents and return the number reindexed.
+        Skip checking files unless needs_update(min_interval)."""
+        if not self.needs_update(min_interval):
+            return 0
+        dir_mtime = os.stat(self.collection_dir).st_mtime_ns
+        current = self._scan()
+        indexed = {
+            document: (id_, stamp) for id_, document, stamp in
+            self.db.execute('SELECT id, document, stamp FROM documents')
+        }
+        changed = [d for d, (_, stamp) in current.items()
+                   if d not in indexed or indexed[d][1] != stamp]
+        removed = [d for d in indexed if d not in current]
+        with self.db:
+            for document in removed + changed:
+                if document in indexed:
+                    self._delete(indexed[document][0])
+            for document in sorted(changed):
+                paths, stamp = current[document]
+                id_ = self.db.execute(
+                    'INSERT INTO documents (document, stamp) VALUES (?, ?)',
+                    (document, stamp)).lastrowid
+                entries = document_entries(paths)[:1<<ENTRY_BITS]
+                self.db.executemany(
+                    'INSERT INTO entries (rowid, field, annset, type, content)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    (((id_ << ENTRY_BITS) + i,) + e
+                     for i, e in enumerate(entries)))
+            self._set_meta('dir_mtime', dir_mtime)
+            self._set_meta('last_update', time.time())
+        return len(changed) + len(removed)
+
+    def _delete(self, id_):
+        self.db.execute('DELETE FROM entries WHERE rowid BETWEEN ? AND ?',
+                        _rowid_range(id_))
+        self.db.execute('DELETE FROM documents WHERE id = ?', (id_,))
+
+    def search(self, query, field=None, type_=None, annset=None, page=1,
+               per_page=20):
+        """Return (total, results) for documents matching query, ranked
+        by best matching entry. results is a list of (document, matches)
+        where matches are (field, annset, type, snippet_html)."""
+        match = fts_query(query)
+        if not match:
+            return 0, []
+        where, args = ['entries MATCH ?'], [match]
+        for column, value in (('field', field), ('type', type_),
+                              ('annset', annset)):
+            if value:
+                where.append('{} = ?'.format(column))
+                args.append(value)
+        where = ' AND '.join(where)
+        document_id = 'rowid >> {}'.format(ENTRY_BITS)
+        total = self.db.execute(
+            'SELECT COUNT(DISTINCT {}) FROM entries WHERE {}'.format(
+                document_id, where), args).fetchone()[0]
+        ranked = self.db.execute(
+            'SELECT {} AS id, MIN(rank) AS score FROM entries WHERE {}'
+            ' GROUP BY id ORDER BY score, id LIMIT ? OFFSET ?'.format(
+                document_id, where),
+            args + [per_page, (page-1)*per_page]).fetchall()
+        results = []
+        for id_, _ in ranked:
+            document = self.db.execute(
+                'SELECT document FROM documents WHERE id = ?',
+                (id_,)).fetchone()[0]
+            rows = self.db.execute(
+                'SELECT field, annset, type, snippet(entries, 3, ?, ?,'
+                ' \'…\', 16) FROM entries WHERE {} AND rowid BETWEEN ? AND ?'
+                ' ORDER BY rank'.format(where),
+                [_MATCH_START, _MATCH_END] + args + list(_rowid_range(id_)))
+            matches = [
+                (row_field, row_annset, row_type, snippet_html(snippet))
+                for row_field, row_annset, row_type, snippet in rows
+            ]
+            results.append((document, matches))
+        return total, results
+
+
+_updates = {}    # { index path: updating thread }
+_updates_lock = threading.Lock()
+
+
+def _update(collection_dir, index_path, min_interval):
+    try:
+        index = SearchIndex(collection_dir, index_path)
+        try:
+            index.update(min_interval)
+        finally:
+            index.close()
+    except Exception as e:
+        warning('failed to update search index {}: {}'.format(
+            index_path, e))
+
+
+def start_update(collection_dir, index_path, min_interval=0):
+    """Update index in a background thread unless this process is
+    already updating it."""
+    with _updates_lock:
+        thread = _updates.get(index_path)
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(
+            target=_update, args=(collection_dir, index_path, min_interval),
+            daemon=True)
+        _updates[index_path] = thread
+        thread.start()
+
+
+def _rowid_range(id_):
+    return id_ << ENTRY_BITS, ((id_+1) << ENTRY_BITS) - 1
+
+
+def document_entries(paths):
+    """Return index entries (field, annset, type, content)."""
+    with open(paths['txt'], encoding='utf-8') as f:
+        entries = [(FIELD_TEXT, None, None, f.read())]
+    metadata = {}
+    if 'json' in paths:
+        try:
+            with open(paths['json'], encoding='utf-8') as f:
+                metadata = json.load(f)
+        except ValueError:
+            pass
+    for key in get_annset_keys(paths, metadata):
+        if key not in paths:
+            continue
+        seen = set()
+        for a in load_standoff(paths[key]):
+            if a.text and (a.type, a.text) not in seen:
+                seen.add((a.type, a.text))
+                entries.append((FIELD_ANNOTATION, key, a.type, a.text))
+    return entries
+
+
+def fts_query(query):
+    """Convert user query into FTS5 query of terms that must all match.
+    A term ending in * matches as prefix."""
+    terms = []
+    for term in query.split():
+        prefix = term.endswith('*')
+        term = term.rstrip('*').replace('"', '""')
+        if term:
+            terms.append('"{}"{}'.format(term, '*' if prefix else ''))
+    return ' '.join(terms)
+
+
+def snippet_html(snippet):
+    return escape(snippet).replace(_MATCH_START, '<mark>').replace(
+        _MATCH_END, '</mark>')
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Build or query search index.')
+    ap.add_argument('-f', '--field', choices=[FIELD_TEXT, FIELD_ANNOTATION],
+                    default=None, help='restrict to field')
+    ap.add_argument('-t', '--type', default=None, help='restrict to type')
+    ap.add_argument('-a', '--annset', default=None,
+                    help='restrict to annotation set')
+    ap.add_argument('-n', '--number', default=20, type=int,
+                    help='number of results')
+    ap.add_argument('index', help='index file')
+    ap.add_argument('collection', help='collection directory')
+    ap.add_argument('query', nargs='*', help='query terms')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    index = SearchIndex(args.collection, args.index)
+    start = time.time()
+    updated = index.update()
+    print('updated {} documents in {:.3f}s'.format(
+        updated, time.time()-start), file=sys.stderr)
+    if args.query:
+        start = time.time()
+        total, results = index.search(' '.join(args.query), args.field,
+                                      args.type, args.annset,
+                                      per_page=args.number)
+        print('{} documents in {:.3f}s'.format(total, time.time()-start),
+              file=sys.stderr)
+        for document, matches in results:
+            for field, annset, type_, snippet in matches:
+                print('\t'.join([document, field, annset or '', type_ or '',
+                                 snippet]))
+    index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+"""Cache shared by the processes on a host.
+
+Values are pickled into an SQLite database in CACHEDIR, so that
+parsed documents and rendered HTML are shared between WSGI worker
+processes instead of each keeping and computing its own copies.
+Entries carry a stamp identifying the state of the files they were
+computed from (see db.file_stamp()) and are only returned for the
+same stamp, so a value computed from changed files is never used and
+no invalidation messages between processes are needed. Keys start
+with the path of the document followed by a tab and the kind of the
+value, so that entries can also be removed by path prefix.
+When the total size of values exceeds the maximum, least recently
+used entries are evicted.
+"""
+
+import sys
+import os
+import time
+import pickle
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from collections import Counter
+from logging import warning
+
+from pickanno import conf
+
+
+# Increment when the schema or the pickled classes change
+CACHE_VERSION = 1
+
+# Fraction of the maximum size to evict down to when it is exceeded
+EVICT_TO = 0.9
+
+# Minimum seconds between access time updates of an entry
+TOUCH_INTERVAL = 60
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)',
+    'CREATE TABLE IF NOT EXISTS entries ('
+    ' key TEXT PRIMARY KEY, stamp BLOB, value BLOB, size INTEGER,'
+    ' atime REAL)',
+    'CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)',
+]
+
+
+class SQLiteStore(object):
+    """SQLite database shared between processes, with a connection
+    for each thread."""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads or
+        # between processes after fork()
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db, self.local.pid = db, pid
+        return self.local.db
+
+    @contextmanager
+    def _transaction(self):
+        # explicit BEGIN IMMEDIATE, as sqlite3 would only begin before
+        # the first modification, after reads the modification is based on
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.rollback()
+            raise
+        else:
+            db.commit()
+
+
+class SharedCache(SQLiteStore):
+    """Key-value cache in an SQLite database shared between processes.
+    Keys are strings, stamps and values anything picklable."""
+    def __init__(self, path, max_size):
+        super().__init__(path)
+        self.max_size = max_size
+        # statistics for this process, by kind of value
+        self.hits, self.misses = Counter(), Counter()
+        self.evictions = 0
+        with self._transaction() as db:
+            version = None
+            try:
+                row = db.execute('SELECT value FROM meta WHERE key = ?',
+                                 ('version',)).fetchone()
+                version = row[0] if row else None
+            except sqlite3.OperationalError:
+                pass    # no schema
+            if version != CACHE_VERSION:
+                for table in ('meta', 'entries'):
+                    db.execute('DROP TABLE IF EXISTS {}'.format(table))
+                for statement in SCHEMA:
+                    db.execute(statement)
+                db.execute('INSERT INTO meta VALUES (?, ?)',
+                           ('version', CACHE_VERSION))
+                db.execute('INSERT INTO meta VALUES (?, ?)', ('size', 0))
+
+    def get(self, key, stamp):
+        """Return value cached for key with stamp, None if none."""
+        db = self._connection()
+        row = db.execute('SELECT stamp, value, atime FROM entries'
+                         ' WHERE key = ?', (key,)).fetchone()
+        kind = cache_kind(key)
+        if row is None or pickle.loads(row[0]) != stamp:
+            self.misses[kind] += 1
+            return None
+        try:
+            value = pickle.loads(row[1])
+        except Exception as e:
+            warning('failed to unpickle {}: {}'.format(key, e))
+            self.misses[kind] += 1
+            return None
+        now = time.time()
+        if now - row[2] > TOUCH_INTERVAL:
+            with self._transaction():
+                db.execute('UPDATE entries SET atime = ? WHERE key = ?',
+                           (now, key))
+        self.hits[kind] += 1
+        return value
+
+    def put(self, key, stamp, value):
+        stamp = pickle.dumps(stamp, pickle.HIGHEST_PROTOCOL)
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = len(key) + len(stamp) + len(value)
+        if size > self.max_size:
+            return
+        with self._transaction() as db:
+            row = db.execute('SELECT size FROM entries WHERE key = ?',
+                             (key,)).fetchone()
+            old_size = row[0] if row else 0
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                       (key, stamp, value, size, time.time()))
+            total = self._add_size(db, size - old_size)
+            if total > self.max_size:
+                self._evict(db, total)
+
+    def _add_size(self, db, delta):
+        db.execute('UPDATE meta SET value = value + ? WHERE key = ?',
+                   (delta, 'size'))
+        return db.execute('SELECT value FROM meta WHERE key = ?',
+                          ('size',)).fetchone()[0]
+
+    def _evict(self, db, total):
+        target = self.max_size * EVICT_TO
+        evicted = []
+        for key, size in db.execute('SELECT key, size FROM entries'
+                                    ' ORDER BY atime'):
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= size
+        db.executemany('DELETE FROM entries WHERE key = ?', evicted)
+        db.execute('UPDATE meta SET value = ? WHERE key = ?', (total, 'size'))
+        self.evictions += len(evicted)
+
+    def invalidate(self, prefix):
+        """Remove entries with keys starting with prefix."""
+        with self._transaction() as db:
+            where = 'key >= ? AND key < ?'
+            args = (prefix, prefix + '\U0010ffff')
+            size = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries'
+                              ' WHERE ' + where, args).fetchone()[0]
+            db.execute('DELETE FROM entries WHERE ' + where, args)
+            self._add_size(db, -size)
+
+    def stats(self):
+        """Return statistics of this process and size of the cache."""
+        entries, size = self.size()
+        return {
+            'entries': entries,
+            'size': size,
+            'max_size': self.max_size,
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'evictions': self.evictions,
+        }
+
+    def size(self):
+        """Return (entries, total size)."""
+        db = self._connection()
+        count = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        total = db.execute('SELECT value FROM meta WHERE key = ?',
+                           ('size',)).fetchone()[0]
+        return count, total
+
+
+def cache_key(path, kind, *parts):
+    return '\t'.join((path, kind) + parts)
+
+
+def cache_kind(key):
+    return key.split('\t')[1]
+
+
+_caches = {}
+
+
+def get_shared_cache():
+    """Return shared cache configured for app, or None if disabled."""
+    max_size = conf.get_shared_cache_size()
+    if not max_size:
+        return None
+    path = os.path.join(conf.get_cachedir(), 'shared.sqlite')
+    cache = _caches.get(path)
+    if cache is None:
+        cache = _caches[path] = SharedCache(path, max_size)
+    return cache
+
+
+def _bench_worker(args):
+    datadir, cachedir, size, documents, requests, seed = args
+    import random
+    from pickanno import create_app
+    app = create_app()
+    app.config.update(DATADIR=datadir, CACHEDIR=cachedir,
+                      SHARED_CACHE_SIZE=size, WATCH_MODE=None)
+    app.logger.setLevel('WARNING')
+    client = app.test_client()
+    rng = random.Random(seed)
+    start = time.time()
+    for _ in range(requests):
+        # skewed towards the start of the list, like real traffic
+        index = min(int(rng.expovariate(1) * len(documents) / 4),
+                    len(documents) - 1)
+        response = client.get('/pickanno/{}'.format(documents[index]))
+        assert response.status_code == 200, response.status_code
+    elapsed = time.time() - start
+    # not get_shared_cache() of this module, which may be __main__
+    from pickanno.sharedcache import get_shared_cache as get_cache
+    from pickanno.db import _document_cache
+    with app.app_context():
+        cache = get_cache()
+    stats = Counter(requests=requests, local_hits=_document_cache.hits)
+    if cache is not None:
+        for kind in cache.hits:
+            stats[kind+'_hits'] = cache.hits[kind]
+    return stats, elapsed
+
+
+def benchmark(datadir, collection, workers, requests, size):
+    from multiprocessing import get_context
+    import tempfile
+    names = sorted(os.listdir(os.path.join(datadir, collection)))
+    documents = ['{}/{}'.format(collection, n[:-len('.txt')])
+                 for n in names if n.endswith('.txt')]
+    cachedir = tempfile.mkdtemp()
+    with get_context('spawn').Pool(workers) as pool:
+        results = pool.map(_bench_worker, [
+            (datadir, cachedir, size, documents, requests, seed)
+            for seed in range(workers)
+        ])
+    stats = sum((r[0] for r in results), Counter())
+    elapsed = max(r[1] for r in results)
+    return stats, elapsed
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Benchmark shared cache.')
+    ap.add_argument('-w', '--workers', default=8, type=int,
+                    help='number of worker processes')
+    ap.add_argument('-n', '--requests', default=200, type=int,
+                    help='requests per worker')
+    ap.add_argument('-s', '--size', default=256*1024*1024, type=int,
+                    help='maximum cache size in bytes')
+    ap.add_argument('datadir', help='data directory')
+    ap.add_argument('collection', help='collection to request documents from')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    for label, size in (('per-process', None), ('shared', args.size)):
+        stats, elapsed = benchmark(args.datadir, args.collection,
+                                   args.workers, args.requests, size)
+        requests = stats['requests']
+        # the shared cache is only used on misses in the process cache,
+        # rendered HTML is only cached in the shared cache
+        parsed = requests - stats['local_hits'] - stats['document_hits']
+        rendered = requests - stats['render_hits']
+        print('{}: {} workers, {} requests in {:.1f}s: per-process hits '
+              '{:.1%}, shared hits {:.1%}, parsed {:.1%}, rendered {:.1%}'
+              .format(label, args.workers, requests, elapsed,
+                      stats['local_hits']/requests,
+                      stats['document_hits']/requests,
+                      parsed/requests, rendered/requests))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
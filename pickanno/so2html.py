@@ -6,18 +6,26 @@ __author__ = 'Sampo Pyysalo'
 __license__ = 'MIT'
 
 import sys
+import os
 import re
+import json
+import time
+import tarfile
 import unicodedata
 import urllib.parse
 
 from collections import namedtuple
 from collections import defaultdict
+from collections import OrderedDict
 from itertools import chain
 from logging import warning
-from functools import cmp_to_key
-from cgi import escape
+from functools import cmp_to_key, lru_cache
+from html import escape
+from io import BytesIO
+from multiprocessing import Pool
 
 from .namespace import expand_namespace
+from .standoff import load_standoff
 
 
 def cmp(a, b):
@@ -89,7 +97,7 @@ class Span(object):
     def markup_type(self):
         """Return a coarse variant of the type that can be used as a label in
         HTML markup (tag, CSS class name, etc)."""
-        return html_safe_string(coarse_type(self.type))
+        return markup_type(self.type)
 
     def sort_height(self):
         """Relative height of this tag for sorting purposes."""
@@ -423,6 +431,11 @@ def coarse_type(type_):
     return type_str.strip('/').split('/')[-1]
 
 
+def markup_type(type_):
+    """Return label for type in HTML markup (see Span.markup_type())."""
+    return html_safe_string(coarse_type(type_))
+
+
 def _add_formatting_spans(spans, text):
     """Add formatting spans based on text."""
     # Skip if there are any formatting types in the user-provided data
@@ -453,11 +466,12 @@ def _filter_empty_spans(spans):
     return filtered
 
 
-def _standoff_to_html(text, standoffs, legend, tooltips, links):
+def _standoff_to_html(text, standoffs, legend, tooltips, links, offset=0):
     """standoff_to_html() implementation, don't invoke directly."""
 
-    # Convert standoffs to Span objects.
-    spans = [Span(so.start, so.end, so.type, so.norm) for so in standoffs]
+    # Convert standoffs to Span objects, relative to start of text.
+    spans = [Span(so.start-offset, so.end-offset, so.type, so.norm)
+             for so in standoffs]
 
     # Add formatting such as paragraph breaks if none are provided.
     spans = _add_formatting_spans(spans, text)
@@ -504,7 +518,7 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
     open_span = set()
     while i < len(markers):        
         if o != markers[i].offset:
-            out.append(escape(text[o:markers[i].offset]))
+            out.append(escape(text[o:markers[i].offset], quote=False))
         o = markers[i].offset
         
         # collect markers opening or closing at this position and
@@ -557,7 +571,7 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
             open_span.add(m.span)
                 
         i = last+1
-    out.append(escape(text[o:]))
+    out.append(escape(text[o:], quote=False))
 
     if legend_html:
         out = [legend_html] + out
@@ -809,33 +823,98 @@ def _parse_body(annotation):
     else:
         return [(_to_standoff_type(body), _to_standoff_type(body))]
 
-        
-def oa_to_standoff(annotations, target_key='target'):
-    """Convert OA annotations to Standoff objects."""
-    standoffs = []
+
+
+# Number of distinct OA targets to keep parsed offsets for
+TARGET_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=TARGET_CACHE_SIZE)
+def _parse_target(target):
+    """Return (start, end) from the fragment of OA target."""
+    # assume target is current doc, ignore all but fragment (as
+    # urllib.parse.urldefrag(), without parsing the rest).
+    fragment = target.partition('#')[2]
+    try:
+        start_end = fragment.split('=', 1)[1]
+        start, end = start_end.split(',')
+    except IndexError:
+        warning('failed to parse target %s' % target)
+        start, end = 0, 1
+    return int(start), int(end)
+
+
+def iter_oa_standoffs(annotations, target_key='target'):
+    """Generate Standoff objects for OA annotations."""
     for annotation in annotations:
-        target = annotation[target_key]
-        # assume target is current doc, ignore all but fragment.
-        fragment = urllib.parse.urldefrag(target)[1]
-        try:
-            start_end = fragment.split('=', 1)[1]
-            start, end = start_end.split(',')
-        except IndexError:
-            warning('failed to parse target %s' % target)
-            start, end = 0, 1
+        start, end = _parse_target(annotation[target_key])
         for type_, norm in _parse_body(annotation):
-            standoffs.append(Standoff(int(start), int(end), type_, norm))
-    return standoffs
+            yield Standoff(start, end, type_, norm)
+
+
+def oa_to_standoff(annotations, target_key='target'):
+    """Convert OA annotations to Standoff objects."""
+    return list(iter_oa_standoffs(annotations, target_key))
+
+
+_json_space = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_values(f, chunk_size=65536):
+    """Generate the items of a JSON array, or the values of a sequence
+    of JSON values such as JSON Lines, read incrementally from text
+    file f. Only the current value and chunk are held in memory."""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    in_array = None
+    while True:
+        pos = _json_space.match(buf, pos).end()
+        if pos < len(buf):
+            if in_array is None:
+                in_array = buf[pos] == '['
+                pos += 1 if in_array else 0
+                continue
+            elif in_array and buf[pos] == ']':
+                return
+            elif in_array and buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            # a value at the end of the chunk (e.g. number) may continue
+            if end is not None and (end < len(buf) or eof):
+                yield value
+                pos = end
+                continue
+        elif eof:
+            return
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+
+def read_oa(path, target_key='target', encoding='utf-8'):
+    """Generate Standoff objects for OA annotations in file with a JSON
+    array or JSON Lines, reading it incrementally."""
+    with open(path, encoding=encoding) as f:
+        yield from iter_oa_standoffs(iter_json_values(f), target_key)
 
 
 def standoff_to_html(text, annotations, legend=False, tooltips=False,
                      links=False, complete_page=False, oa_annotations=False,
-                     embeddable=False):
-    """Create HTML representation of given text and annotations."""
+                     embeddable=False, offset=0):
+    """Create HTML representation of given text and annotations. If
+    offset is given, text starts at that offset of the text that the
+    annotation offsets refer to."""
     if oa_annotations:
         annotations = oa_to_standoff(annotations)
 
-    css, body = _standoff_to_html(text, annotations, legend, tooltips, links)
+    css, body = _standoff_to_html(text, annotations, legend, tooltips, links,
+                                  offset)
 
     if not complete_page:
         # Skip header, trailer and CSS for embedding
@@ -851,3 +930,156 @@ def standoff_to_html(text, annotations, legend=False, tooltips=False,
 
     return (_header_html(css, links_string, embeddable) + body +
             _trailer_html(embeddable))
+
+
+def _render_document(args):
+    """Render text file with annotations into a complete page named
+    name, return (name, html, annotation count, read seconds, render
+    seconds)."""
+    text_path, ann_path, name, oa, options = args
+    start = time.time()
+    with open(text_path, encoding='utf-8') as f:
+        text = f.read()
+    if oa:
+        annotations = list(read_oa(ann_path))
+    else:
+        annotations = list(load_standoff(ann_path))
+    read_time = time.time()
+    html = standoff_to_html(text, annotations, complete_page=True, **options)
+    return name, html, len(annotations), read_time-start, time.time()-read_time
+
+
+def _render(args):
+    try:
+        return _render_document(args), None
+    except Exception as e:
+        return None, '{}: {}'.format(args[0], e)
+
+
+def _text_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(os.path.join(path, n) for n in os.listdir(path)
+                              if n.endswith('.txt'))
+        else:
+            yield path
+
+
+def _output_names(text_paths):
+    """Return { text path: output name } with names relative to the
+    closest directory containing all text files, so that files with the
+    same name in different directories don't overwrite each other."""
+    paths = list(OrderedDict.fromkeys(os.path.abspath(p) for p in text_paths))
+    if not paths:
+        return OrderedDict()
+    common = os.path.commonpath([os.path.dirname(p) for p in paths])
+    return OrderedDict(
+        (p, os.path.splitext(os.path.relpath(p, common))[0] + '.html')
+        for p in paths)
+
+
+class _DirectoryOutput(object):
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+    def write(self, name, html):
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(html)
+
+    def close(self):
+        pass
+
+
+class _TarOutput(object):
+    def __init__(self, path, compression):
+        self.tar = tarfile.open(path, 'w|'+compression)
+
+    def write(self, name, html):
+        data = html.encode('utf-8')
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, BytesIO(data))
+
+    def close(self):
+        self.tar.close()
+
+
+_tar_compression = {
+    '.tar': '',
+    '.tar.gz': 'gz',
+    '.tgz': 'gz',
+    '.tar.bz2': 'bz2',
+    '.tar.xz': 'xz',
+}
+
+
+def open_output(path):
+    """Return writer of pages to tar archive if path has a tar suffix,
+    otherwise to directory."""
+    for suffix, compression in _tar_compression.items():
+        if path.endswith(suffix):
+            return _TarOutput(path, compression)
+    return _DirectoryOutput(path)
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Convert text and annotations to HTML.',
+                        epilog='Prints name, number of annotations and '
+                        'seconds to read and to render each document.')
+    ap.add_argument('-j', '--jobs', default=None, type=int,
+                    help='number of worker processes')
+    ap.add_argument('-s', '--suffix', default=None,
+                    help='suffix of annotation files replacing .txt '
+                    '(default .ann, or .jsonl with --oa)')
+    ap.add_argument('--oa', default=False, action='store_true',
+                    help='annotations are OA (JSON array or JSON Lines)')
+    ap.add_argument('-l', '--legend', default=False, action='store_true',
+                    help='include legend')
+    ap.add_argument('-t', '--tooltips', default=False, action='store_true',
+                    help='include tooltips (requires hint.css)')
+    ap.add_argument('--links', default=False, action='store_true',
+                    help='link annotations with URL norms')
+    ap.add_argument('-o', '--output', required=True,
+                    help='output directory or tar archive (.tar, .tgz, ...)')
+    ap.add_argument('files', nargs='+', metavar='FILE',
+                    help='text file (.txt) or directory of text files')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    suffix = args.suffix or ('.jsonl' if args.oa else '.ann')
+    options = dict(legend=args.legend, tooltips=args.tooltips,
+                   links=args.links)
+    tasks = [(p, os.path.splitext(p)[0]+suffix, n, args.oa, options)
+             for p, n in _output_names(_text_paths(args.files)).items()]
+    output = open_output(args.output)
+    start, rendered, errors = time.time(), 0, 0
+    try:
+        with Pool(args.jobs) as pool:
+            # unordered and one at a time, slow documents don't hold
+            # back output
+            for result, error in pool.imap_unordered(_render, tasks):
+                if error is not None:
+                    print(error, file=sys.stderr)
+                    errors += 1
+                    continue
+                name, html, count, read_time, render_time = result
+                output.write(name, html)
+                print('{}	{}	{:.3f}	{:.3f}'.format(
+                    name, count, read_time, render_time))
+                rendered += 1
+    finally:
+        output.close()
+    print('{} rendered, {} errors, {:.1f}s'.format(
+        rendered, errors, time.time()-start), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
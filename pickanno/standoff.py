@@ -1,4 +1,5 @@
-from flask import current_app as app
+from bisect import bisect_left, bisect_right
+from logging import warning
 
 
 def load_standoff(filename, encoding='utf-8'):
@@ -19,7 +20,140 @@ def parse_standoff(standoff, source='<INPUT>'):
             annotations.append(Textbound.from_standoff_line(line, ln, source))
         else:
             pass    # TODO
-    return annotations
+    return AnnotationSet(annotations)
+
+
+class AnnotationSet(object):
+    """Annotations from one source, with lookup by id and by span.
+
+    The id map and interval index are built on first use and kept
+    with the set, which should not be modified after creation.
+    """
+    def __init__(self, annotations):
+        self.annotations = list(annotations)
+        self._by_id = None
+        self._index = None
+
+    def __iter__(self):
+        return iter(self.annotations)
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def __getitem__(self, idx):
+        return self.annotations[idx]
+
+    def __repr__(self):
+        return 'AnnotationSet({})'.format(self.annotations)
+
+    def __reduce__(self):
+        # omit id map and index, rebuilt on use
+        return (AnnotationSet, (self.annotations,))
+
+    @property
+    def by_id(self):
+        if self._by_id is None:
+            by_id = {}
+            for a in self.annotations:
+                by_id.setdefault(a.id, []).append(a)
+            self._by_id = by_id
+        return self._by_id
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = IntervalIndex(self.annotations)
+        return self._index
+
+    def get(self, id_):
+        """Return identified annotation."""
+        matching = self.by_id.get(id_)
+        if not matching:
+            raise KeyError('annotation {} not found'.format(id_))
+        if len(matching) > 1:
+            raise ValueError('duplicate annoation id {}'.format(id_))
+        return matching[0]
+
+    def overlapping(self, start, end):
+        """Return annotations overlapping span, in original order."""
+        return self._select(self.index.overlapping(start, end))
+
+    def containing(self, start, end):
+        """Return annotations containing span, in original order."""
+        return self._select(self.index.containing(start, end))
+
+    def contained(self, start, end):
+        """Return annotations contained in span, in original order."""
+        return self._select(self.index.contained(start, end))
+
+    def span(self):
+        """Return (start, end) covering all annotations, None if empty."""
+        return self.index.span()
+
+    def _select(self, positions):
+        return [self.annotations[i] for i in sorted(positions)]
+
+
+class IntervalIndex(object):
+    """Static index for overlap and containment queries.
+
+    Intervals are sorted by start and an implicit binary tree over
+    the sorted order stores the maximum end in each subtree, allowing
+    subtrees without matches to be skipped. Queries return positions
+    of matching intervals in the original sequence.
+    """
+    def __init__(self, intervals):
+        order = sorted(range(len(intervals)),
+                       key=lambda i: (intervals[i].start, intervals[i].end))
+        self.order = order
+        self.starts = [intervals[i].start for i in order]
+        self.ends = [intervals[i].end for i in order]
+        size = 1
+        while size < len(order):
+            size *= 2
+        max_end = [-1] * (2*size)
+        max_end[size:size+len(order)] = self.ends
+        for i in range(size-1, 0, -1):
+            max_end[i] = max(max_end[2*i], max_end[2*i+1])
+        self.size = size
+        self.max_end = max_end
+
+    def _search(self, limit, min_end, strict):
+        """Return positions of intervals among the first limit in start
+        order with end > min_end (strict) or end >= min_end."""
+        found = []
+        max_end, size = self.max_end, self.size
+        stack = [(1, 0, size)]
+        while stack:
+            node, lo, hi = stack.pop()
+            if lo >= limit:
+                continue
+            node_end = max_end[node]
+            if node_end < min_end or (strict and node_end == min_end):
+                continue
+            if node >= size:
+                found.append(self.order[lo])
+            else:
+                mid = (lo + hi) // 2
+                stack.append((2*node+1, mid, hi))
+                stack.append((2*node, lo, mid))
+        return found
+
+    def overlapping(self, start, end):
+        return self._search(bisect_left(self.starts, end), start, True)
+
+    def containing(self, start, end):
+        return self._search(bisect_right(self.starts, start), end, False)
+
+    def contained(self, start, end):
+        lo = bisect_left(self.starts, start)
+        hi = bisect_right(self.starts, end)
+        return [self.order[i] for i in range(lo, hi) if self.ends[i] <= end]
+
+    def span(self):
+        if not self.order:
+            return None
+        return self.starts[0], self.max_end[1]
 
 
 class Textbound(object):
@@ -62,6 +196,11 @@ class Textbound(object):
         else:
             return self.type < other.type
 
+    def __reduce__(self):
+        # compact pickling for transfer between processes
+        return (_make_textbound, (self.id, self.type, self.start, self.end,
+                                  self.text, self.norm))
+
     def __repr__(self):
         return 'Textbound({}, {}, {}, {}, {})'.format(
             self.id, self.type, self.start, self.end, self.text)
@@ -82,9 +221,15 @@ class Textbound(object):
         min_start = min(s[0] for s in spans)
         max_end = max(s[1] for s in spans)
         if len(spans) > 1:
-            app.logger.warning('replacing fragmented span {} with {} {}'.format(
+            warning('replacing fragmented span {} with {} {}'.format(
                 span_str, min_start, max_end))
-        return cls(id_, type_, start, end, text)
+        return cls(id_, type_, min_start, max_end, text)
+
+
+def _make_textbound(id_, type_, start, end, text, norm):
+    textbound = Textbound(id_, type_, start, end, text)
+    textbound.norm = norm
+    return textbound
 
 
 class Normalization(object):
@@ -65,16 +65,152 @@ function makeUrl(url, params) {
 
 async function pickCandidate(pick) {
     spinUp();
-    var url = makeUrl(PICK_ANNO_URL, { "choice":  pick });
-    var response = await fetch(url);
-    var data = await response.json();
+    // VERSION is that of the picks of this candidate
+    let url = makeUrl(PICK_ANNO_URL, { "choice": pick, "version": VERSION });
+    let response = await fetch(url);
+    let data = await response.json();
+    // on conflict (409) the data are the picks of someone else, shown
+    // instead of overwriting them; picking again is based on them
+    VERSION = data['version'];
     METADATA['accepted'] = data['accepted'];
     METADATA['rejected'] = data['rejected'];
-    updatePicks(data.picked);
+    document.getElementById("pa-conflict").hidden = (response.status != 409);
+    updatePicks();
     spinDown();
     return data;
 }
 
+/* context outside of the initial window, loaded on scroll */
+
+var loadingContext = {};
+
+function isVisible(element) {
+    let rect = element.getBoundingClientRect();
+    return rect.bottom >= 0 && rect.top <= window.innerHeight;
+}
+
+async function loadContext(sentinel) {
+    let direction = sentinel.dataset.direction;
+    if (loadingContext[direction]) {
+	return;
+    }
+    loadingContext[direction] = true;
+    spinUp();
+    var url = makeUrl(CONTEXT_URL, {
+	"direction": direction,
+	"offset": sentinel.dataset.offset
+    });
+    var response = await fetch(url);
+    var data = await response.json();
+    let chunk = document.createElement("div");
+    chunk.className = "pa-context-chunk";
+    chunk.innerHTML = data.html;
+    if (direction == "above") {
+	// keep the visible part of the page in place
+	let height = document.documentElement.scrollHeight;
+	sentinel.after(chunk);
+	window.scrollBy(0, document.documentElement.scrollHeight - height);
+    } else {
+	sentinel.before(chunk);
+    }
+    if (data.offset === null) {
+	sentinel.remove();
+    } else {
+	sentinel.dataset.offset = data.offset;
+    }
+    loadingContext[direction] = false;
+    spinDown();
+    // the observer only fires on changes, continue if still in view
+    if (data.offset !== null && isVisible(sentinel)) {
+	loadContext(sentinel);
+    }
+}
+
+function observeContext() {
+    var observer = new IntersectionObserver(function(entries) {
+	entries.forEach(entry => {
+	    if (entry.isIntersecting) {
+		loadContext(entry.target);
+	    }
+	});
+    });
+    var sentinels = document.getElementsByClassName("pa-more");
+    for (let i=0; i<sentinels.length; i++) {
+	observer.observe(sentinels[i]);
+    }
+}
+
+/* client rendering (CLIENT_RENDERING in config.py) */
+
+// key prefix of prefetched document data in sessionStorage
+const PREFETCH_PREFIX = "pa-data:";
+
+async function fetchDocumentData(url) {
+    let key = PREFETCH_PREFIX + url;
+    let stored = sessionStorage.getItem(key);
+    if (stored !== null) {
+	sessionStorage.removeItem(key);
+	return JSON.parse(stored);
+    }
+    let response = await fetch(url);
+    return await response.json();
+}
+
+async function prefetchDocumentData(url) {
+    try {
+	let response = await fetch(url);
+	if (!response.ok) {
+	    return;
+	}
+	let text = await response.text();
+	// keep only the next document
+	for (let i=sessionStorage.length-1; i>=0; i--) {
+	    let key = sessionStorage.key(i);
+	    if (key.startsWith(PREFETCH_PREFIX)) {
+		sessionStorage.removeItem(key);
+	    }
+	}
+	sessionStorage.setItem(PREFETCH_PREFIX + url, text);
+    } catch (error) {
+	// e.g. storage full, the next page fetches the data itself
+	console.log("prefetch failed: " + error);
+    }
+}
+
+function moreSentinel(direction, offset) {
+    if (offset === null) {
+	return "";
+    }
+    return '<div id="pa-more-' + direction + '" class="pa-more" ' +
+	'data-direction="' + direction + '" data-offset="' + offset +
+	'"></div>';
+}
+
+async function renderDocument(url) {
+    spinUp();
+    let data = await fetchDocumentData(url);
+    // same structure as rendered on the server in pickanno.html
+    let content = visualizeCandidates(data);
+    let candidates = data.keys.map(
+	k => '<div id="candidate-' + escapeHtml(k) + '" class="pa-candidate">' +
+	    content.spans[k] + '</div>'
+    );
+    document.getElementById("pa-client-view").innerHTML = (
+	'<div class="pa-above">' + moreSentinel("above", content.above_offset) +
+	    content.above + '</div>' +
+	'<div class="pa-mid-row">' +
+	    '<div class="pa-mid-left">' + content.left + '</div>' +
+	    '<div class="pa-mid-centre">' + candidates.join('') + '</div>' +
+	    '<div class="pa-mid-right">' + content.right + '</div>' +
+	'</div>' +
+	'<div class="pa-below">' + content.below +
+	    moreSentinel("below", content.below_offset) + '</div>'
+    );
+    document.getElementsByClassName("legend-wrapper")[0].innerHTML =
+	data.legend;
+    spinDown();
+}
+
 /* set up events */
 
 document.addEventListener('keydown', function(event) {
@@ -102,7 +238,10 @@ document.addEventListener('keydown', function(event) {
     }
 });
 
-function load() {
+async function load() {
+    if (typeof DATA_URL !== "undefined") {
+	await renderDocument(DATA_URL);
+    }
     var candidates = document.getElementsByClassName("pa-candidate");
     for (let i=0; i<candidates.length; i++) {
 	let element = candidates[i];
@@ -112,4 +251,8 @@ function load() {
 	};
     }
     updatePicks();
+    observeContext();
+    if (typeof NEXT_DATA_URL !== "undefined" && NEXT_DATA_URL !== null) {
+	prefetchDocumentData(NEXT_DATA_URL);
+    }
 }
@@ -0,0 +1,287 @@
+/* Rendering of text and annotations into HTML in the browser, giving
+   the same markup as so2html.py for the candidate view (annotation
+   and formatting spans only: no links, tooltips or legend). Offsets
+   are in characters (code points) as on the server. */
+
+// the tag to use to mark annotated spans
+const TAG = 'span';
+
+// tags of formatting spans added for newlines and highlights
+const SECTION_TAG = 'section';
+const HIGHLIGHT_TAG = 'u';
+
+// "effectively zero" height for formatting tags
+const EPSILON = 0.0001;
+
+function cmp(a, b) {
+    return (a > b) - (a < b);
+}
+
+class Span {
+    // markup is the type label for annotations and the tag for
+    // formatting spans
+    constructor(start, end, markup, formatting) {
+	this.start = start;
+	this.end = end;
+	this.markup = markup;
+	this.formatting = formatting;
+	this.nested = new Set();
+	this._height = null;
+	this.startMarker = null;
+    }
+
+    tag() {
+	return this.formatting ? this.markup : TAG;
+    }
+
+    sortHeight() {
+	// see so2html.Span.sort_height()
+	if (!this.formatting) {
+	    return this.height();
+	} else {
+	    return this.height() + 1 + EPSILON;
+	}
+    }
+
+    height() {
+	let ownh = this.formatting ? 0 : 1;
+	if (this._height === null) {
+	    if (this.nested.size == 0) {
+		this._height = 0;
+	    } else {
+		let max = -Infinity;
+		for (const n of this.nested) {
+		    max = Math.max(max, n.height());
+		}
+		this._height = max + ownh;
+	    }
+	}
+	return this._height;
+    }
+}
+
+class Marker {
+    constructor(span, offset, isEnd, contLeft=false, contRight=false) {
+	this.span = span;
+	this.offset = offset;
+	this.isEnd = isEnd;
+	this.contLeft = contLeft;
+	this.contRight = contRight;
+	this.coveredLeft = false;
+	this.coveredRight = false;
+	// at identical offsets, ending markers sort highest-last,
+	// starting markers highest-first.
+	this.sortIdx = span.sortHeight() * (isEnd ? 1 : -1);
+	if (!isEnd) {
+	    span.startMarker = this;
+	}
+    }
+
+    toString() {
+	if (this.isEnd) {
+	    return '</' + this.span.tag() + '>';
+	} else if (this.span.formatting) {
+	    return '<' + this.span.tag() + '>';
+	}
+	let classes = ['ann', 'ann-h' + this.span.height(),
+		       'ann-t' + this.span.markup];
+	if (this.contLeft) {
+	    classes.push('ann-contleft');
+	}
+	if (this.contRight) {
+	    classes.push('ann-conright');    // sic, as in so2html.py
+	}
+	if (this.coveredLeft) {
+	    classes.push('ann-openleft');
+	}
+	if (this.coveredRight) {
+	    classes.push('ann-openright');
+	}
+	return '<' + this.span.tag() + ' class="' + classes.join(' ') + '">';
+    }
+}
+
+function markerSort(a, b) {
+    return cmp(a.offset, b.offset) || cmp(a.sortIdx, b.sortIdx);
+}
+
+function leftmostSort(a, b) {
+    return cmp(a.start, b.start) || cmp(b.end-b.start, a.end-a.start);
+}
+
+function longestSort(a, b) {
+    return cmp(b.end-b.start, a.end-a.start) || cmp(a.start, b.start);
+}
+
+function resolveHeights(spans) {
+    // see so2html.resolve_heights()
+    let openSpan = [];
+    for (const s of spans.slice().sort(leftmostSort)) {
+	openSpan = openSpan.filter(o => o.end > s.start);
+	openSpan.push(s);
+	openSpan.sort(longestSort);
+	for (let i=0; i<openSpan.length; i++) {
+	    for (let j=i+1; j<openSpan.length; j++) {
+		openSpan[i].nested.add(openSpan[j]);
+	    }
+	}
+    }
+}
+
+function isSpace(s) {
+    return /^\s+$/.test(s);
+}
+
+function addFormattingSpans(spans, text) {
+    // as so2html._add_formatting_spans(), sections for lines unless
+    // there are other formatting spans
+    if (spans.some(s => s.formatting)) {
+	return spans;
+    }
+    let offset = 0;
+    let whole = text.trim();
+    for (const s of text.split(/(\n)/)) {
+	let length = Array.from(s).length;
+	if (s && !isSpace(s) && s.trim() != whole) {
+	    spans.push(new Span(offset, offset+length, SECTION_TAG, true));
+	}
+	offset += length;
+    }
+    return spans;
+}
+
+function escapeHtml(s) {
+    return s.replace(/&/g, '&amp;').replace(/</g, '&lt;')
+	.replace(/>/g, '&gt;');
+}
+
+function spansToHtml(text, spans) {
+    /* Return HTML for text with spans, see so2html._standoff_to_html() */
+    let chars = Array.from(text);
+    spans = addFormattingSpans(spans, text).filter(s => s.start != s.end);
+    resolveHeights(spans);
+
+    let markers = [];
+    for (const s of spans) {
+	markers.push(new Marker(s, s.start, false));
+	markers.push(new Marker(s, s.end, true));
+    }
+    markers.sort(markerSort);
+
+    // add start and end markers where spans would cross
+    let i = 0, o = 0, out = [];
+    let openSpan = new Set();
+    while (i < markers.length) {
+	if (o != markers[i].offset) {
+	    out.push(escapeHtml(chars.slice(o, markers[i].offset).join('')));
+	}
+	o = markers[i].offset;
+
+	let toOpen = [], toClose = [];
+	let maxChangeHeight = -1;
+	let last = null;
+	for (let j=i; j<markers.length; j++) {
+	    if (markers[j].offset != o) {
+		break;
+	    }
+	    if (markers[j].isEnd) {
+		toClose.push(markers[j]);
+	    } else {
+		toOpen.push(markers[j]);
+	    }
+	    maxChangeHeight = Math.max(maxChangeHeight,
+				       markers[j].span.height());
+	    last = j;
+	}
+
+	let minCoverHeight = Infinity;
+	for (const s of openSpan) {
+	    if (s.height() < maxChangeHeight && s.end != o) {
+		s.startMarker.contRight = true;
+		toOpen.push(new Marker(s, o, false, true));
+		toClose.push(new Marker(s, o, true));
+		minCoverHeight = Math.min(minCoverHeight, s.height());
+	    }
+	}
+
+	for (const m of toOpen) {
+	    if (m.span.height() > minCoverHeight) {
+		m.coveredLeft = true;
+	    }
+	}
+	for (const m of toClose) {
+	    if (m.span.height() > minCoverHeight) {
+		m.span.startMarker.coveredRight = true;
+	    }
+	}
+
+	toOpen.sort(markerSort);
+	toClose.sort(markerSort);
+
+	for (const m of toClose) {
+	    out.push(m);
+	    openSpan.delete(m.span);
+	}
+	for (const m of toOpen) {
+	    out.push(m);
+	    openSpan.add(m.span);
+	}
+	i = last+1;
+    }
+    out.push(escapeHtml(chars.slice(o).join('')));
+
+    return out.map(String).join('');
+}
+
+/* candidate view from document data (see visualize.candidate_view_data) */
+
+function annotationSpans(data, key, offset) {
+    let annset = data.annsets[key];
+    let spans = [];
+    for (let i=0; i<annset.starts.length; i++) {
+	let type = annset.types[i];
+	spans.push(new Span(annset.starts[i]-offset, annset.ends[i]-offset,
+			    data.markup[type], data.formatting[type]));
+    }
+    return spans;
+}
+
+function highlightSpans(data, start, end) {
+    let highlights = data.highlights;
+    let spans = [];
+    for (let i=0; i<highlights.starts.length; i++) {
+	if (highlights.starts[i] >= start && highlights.ends[i] <= end) {
+	    spans.push(new Span(highlights.starts[i]-start,
+				highlights.ends[i]-start, HIGHLIGHT_TAG, true));
+	}
+    }
+    return spans;
+}
+
+function visualizeCandidates(data) {
+    /* Return object with the parts of the candidate view as HTML, as
+       visualize.visualize_candidates() */
+    let chars = Array.from(data.text);
+    let [aboveStart, leftStart, spanStart, spanEnd, rightEnd, belowEnd] =
+	data.boundaries;
+    let part = function(start, end) {
+	return chars.slice(start-aboveStart, end-aboveStart).join('');
+    };
+    let context = function(start, end) {
+	return spansToHtml(part(start, end), highlightSpans(data, start, end));
+    };
+    let spans = {};
+    for (const key of data.keys) {
+	spans[key] = spansToHtml(part(spanStart, spanEnd),
+				 annotationSpans(data, key, spanStart));
+    }
+    return {
+	'above': context(aboveStart, leftStart),
+	'left': context(leftStart, spanStart),
+	'spans': spans,
+	'right': context(spanEnd, rightEnd),
+	'below': context(rightEnd, belowEnd),
+	'above_offset': aboveStart > 0 ? aboveStart : null,
+	'below_offset': belowEnd < data.length ? belowEnd : null,
+    };
+}
@@ -0,0 +1,102 @@
+"""Judgment statistics of collections.
+
+Counts of accepted, rejected and unjudged candidates by candidate type
+and candidate_source (cf. listpicks) are kept for each collection and
+updated on picks and change events, so that they are served without
+reading the collection. Counts are built from the files on first use
+and rebuilt when the collection changes in ways not covered by the
+updates (see collectionindex), or on request.
+"""
+
+import os
+
+from collections import Counter
+
+from .db import get_candidates, get_picks
+from .collectionindex import CollectionIndex, get_index
+from .workqueue import read_annotation_type
+
+
+ACCEPTED = 'accepted'
+REJECTED = 'rejected'
+UNJUDGED = 'unjudged'
+
+STATUSES = (ACCEPTED, REJECTED, UNJUDGED)
+
+
+def candidate_status(candidate):
+    """Return judgment of the set of the candidate annotation."""
+    if candidate['candidate_set'] in get_picks(candidate, 'accepted'):
+        return ACCEPTED
+    elif candidate['candidate_set'] in get_picks(candidate, 'rejected'):
+        return REJECTED
+    else:
+        return UNJUDGED
+
+
+class CollectionStats(CollectionIndex):
+    """Judgment counts for one collection."""
+    def _build(self):
+        self.counts = Counter()    # { (type, source, status): count }
+        self.rows = {}             # { document: [(type, source, status)] }
+        for document, _, metadata in self.db.iter_documents(self.collection):
+            if metadata is not None:    # skip documents with errors
+                self._set_rows(document, self._read_rows(document, metadata))
+
+    def _read_rows(self, document, metadata):
+        rows = []
+        for candidate in get_candidates(metadata):
+            path = os.path.join(self.collection_dir, '{}.{}'.format(
+                document, candidate['candidate_set']))
+            type_ = read_annotation_type(path, candidate['candidate_id'])
+            source = candidate.get('candidate_source',
+                                   metadata.get('candidate_source'))
+            rows.append((type_, source, candidate_status(candidate)))
+        return rows
+
+    def _set_rows(self, document, rows):
+        self.counts.subtract(self.rows.pop(document, []))
+        if rows is not None:
+            self.rows[document] = rows
+            self.counts.update(rows)
+
+    def _update_document(self, document):
+        entry = self.db.get_document_entry(self.collection, document)
+        if entry is None or entry[2] is None:
+            self._set_rows(document, None)    # removed or broken
+        else:
+            self._set_rows(document, self._read_rows(document, entry[2]))
+
+    def _update_pick(self, document, candidate, candidate_data):
+        if document not in self.rows:
+            return
+        rows = list(self.rows[document])
+        if candidate >= len(rows):
+            return
+        type_, source, _ = rows[candidate]
+        rows[candidate] = (type_, source, candidate_status(candidate_data))
+        self._set_rows(document, rows)
+
+    def summary(self, rebuild=False):
+        """Return (rows, total, documents), where rows are (type, source,
+        { status: count }) sorted by type and source and total has the
+        counts for all types and sources."""
+        with self.lock:
+            if rebuild:
+                self.stale = True
+            self._check_current()
+            counts = dict(self.counts)
+            documents = len(self.rows)
+        by_key, total = {}, Counter()
+        for (type_, source, status), count in counts.items():
+            if count:
+                by_key.setdefault((type_, source), Counter())[status] += count
+                total[status] += count
+        rows = [(t, s, by_key[(t, s)]) for t, s in
+                sorted(by_key, key=lambda k: tuple(v or '' for v in k))]
+        return rows, total, documents
+
+
+def get_stats(root_dir, collection):
+    """Return statistics for collection, shared by this process."""
+    return get_index(CollectionStats, root_dir, collection)
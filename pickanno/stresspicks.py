@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""Stress test for concurrent picks.
+
+Runs writer processes that set random picks on the documents of a
+copy of a collection at the same time, based on the version each has
+read and retrying on version conflicts. Then verifies that no pick
+was lost: the version of each candidate must equal the number of
+writes to it, and its picks must be those of its last write.
+"""
+
+import sys
+import os
+import time
+import random
+import shutil
+import tempfile
+
+from multiprocessing import Pool
+
+from .db import FilesystemData, VersionConflict, get_candidates, get_version
+
+
+def _writer(args):
+    root_dir, collection, documents, writes, seed = args
+    db = FilesystemData(root_dir)
+    rng = random.Random(seed)
+    log, conflicts = [], 0
+    for _ in range(writes):
+        document, annset_keys = rng.choice(documents)
+        while True:
+            metadata = db.get_document_metadata(collection, document)
+            candidates = get_candidates(metadata)
+            candidate = rng.randrange(len(candidates))
+            accepted = [k for k in annset_keys if rng.random() < 0.5]
+            rejected = [k for k in annset_keys if k not in accepted]
+            try:
+                _, version = db.set_document_picks(
+                    collection, document, accepted, rejected, candidate,
+                    get_version(candidates[candidate]))
+            except VersionConflict:
+                conflicts += 1
+                continue
+            log.append((document, candidate, version, accepted, rejected))
+            break
+    return log, conflicts
+
+
+def stress(root_dir, collection, writers, writes, documents=None):
+    """Run writers and return (writes, conflicts, errors, seconds)."""
+    db = FilesystemData(root_dir)
+    docs = [(d, keys) for d, keys, metadata in db.iter_documents(collection)
+            if metadata is not None]
+    if documents is not None:
+        docs = docs[:documents]
+    initial = {
+        d: [get_version(c) for c in
+            get_candidates(db.get_document_metadata(collection, d))]
+        for d, _ in docs
+    }
+    start = time.time()
+    with Pool(writers) as pool:
+        results = pool.map(_writer, [
+            (root_dir, collection, docs, writes, seed)
+            for seed in range(writers)
+        ])
+    seconds = time.time() - start
+
+    log = [entry for entries, _ in results for entry in entries]
+    conflicts = sum(c for _, c in results)
+    errors = []
+    for document, _ in docs:
+        metadata = db.get_document_metadata(collection, document)
+        candidates = get_candidates(metadata)
+        for candidate, c in enumerate(candidates):
+            entries = sorted(
+                (e for e in log if e[:2] == (document, candidate)),
+                key=lambda e: e[2])
+            expected = initial[document][candidate] + len(entries)
+            if get_version(c) != expected:
+                errors.append('{}[{}]: version {}, expected {}'.format(
+                    document, candidate, get_version(c), expected))
+            if entries:
+                accepted, rejected = entries[-1][3:]
+                if ((c.get('accepted'), c.get('rejected')) !=
+                    (accepted, rejected)):
+                    errors.append('{}[{}]: lost pick'.format(document,
+                                                              candidate))
+    return len(log), conflicts, errors, seconds
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Stress test concurrent picks.')
+    ap.add_argument('-w', '--writers', default=16, type=int,
+                    help='number of writer processes')
+    ap.add_argument('-n', '--writes', default=200, type=int,
+                    help='picks per writer')
+    ap.add_argument('-d', '--documents', default=5, type=int,
+                    help='number of documents to write (fewer for more '
+                    'contention)')
+    ap.add_argument('collection', help='collection directory (copied)')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        collection = os.path.basename(os.path.normpath(args.collection))
+        shutil.copytree(args.collection, os.path.join(tmpdir, collection))
+        writes, conflicts, errors, seconds = stress(
+            tmpdir, collection, args.writers, args.writes, args.documents)
+    finally:
+        shutil.rmtree(tmpdir)
+    for error in errors:
+        print(error, file=sys.stderr)
+    print('{} writes, {} conflicts retried, {} errors in {:.1f}s'.format(
+        writes, conflicts, len(errors), seconds))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
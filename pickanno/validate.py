@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+"""Validation of collection documents.
+
+Checks that annotation offsets are within the text and match the
+annotated text, that annotation ids are unique within each set, that
+candidates exist and that metadata has the expected structure. A
+collection is checked in parallel and the errors are saved as a
+report in the collection directory with the state of the files of
+each invalid document. The server reads the report and treats listed
+documents as errors without parsing them until their files change.
+Malformed picks are only reported as warnings, as the server counts
+them as not judged (see db.get_picks()) and the next pick rewrites
+them.
+"""
+
+import sys
+import os
+import json
+import time
+
+from glob import iglob
+from multiprocessing import Pool
+from logging import warning
+
+from .standoff import parse_standoff
+
+
+# Report of invalid documents in collection directory
+REPORT_NAME = '.validation.json'
+
+# Increment when checks or the report format change
+REPORT_VERSION = 2
+
+# Kinds of errors
+FILES = 'files'            # missing or unreadable files
+SCHEMA = 'schema'          # metadata structure
+PARSE = 'parse'            # annotation set can't be parsed
+OFFSETS = 'offsets'        # span outside text
+TEXT = 'text'              # annotation text differs from text at span
+DUPLICATE = 'duplicate'    # annotation id not unique in set
+CANDIDATE = 'candidate'    # candidate not found
+PICKS = 'picks'            # malformed accepted or rejected, warning only
+
+# Kinds that don't make a document invalid
+WARNING_KINDS = (PICKS,)
+
+
+class InvalidDocument(Exception):
+    """Document known to be invalid from the validation report."""
+    def __init__(self, document, errors):
+        super().__init__('invalid document {}: {}'.format(
+            document, '; '.join(format_error(e) for e in errors)))
+        self.document = document
+        self.errors = errors
+
+
+def error(kind, message, annset=None, id_=None):
+    e = { 'kind': kind, 'message': message }
+    if annset is not None:
+        e['annset'] = annset
+    if id_ is not None:
+        e['id'] = id_
+    return e
+
+
+def format_error(e):
+    where = ' '.join(e[k] for k in ('annset', 'id') if k in e)
+    return '{}{}: {}'.format(e['kind'], ' '+where if where else '',
+                             e['message'])
+
+
+def split_warnings(errors):
+    """Return (errors, warnings) for errors of check_document()."""
+    return ([e for e in errors if e['kind'] not in WARNING_KINDS],
+            [e for e in errors if e['kind'] in WARNING_KINDS])
+
+
+def _is_str_list(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+def check_metadata(metadata, annset_keys):
+    """Return errors in document metadata structure."""
+    from .db import get_candidates
+    if not isinstance(metadata, dict):
+        return [error(SCHEMA, 'metadata is not an object')]
+    errors = []
+    if 'annsets' in metadata and not _is_str_list(metadata['annsets']):
+        errors.append(error(SCHEMA, 'annsets is not a list of strings'))
+    candidates = get_candidates(metadata)
+    if not isinstance(candidates, list) or not candidates:
+        return errors + [error(SCHEMA, 'no candidates')]
+    for i, candidate in enumerate(candidates):
+        prefix = 'candidate {}: '.format(i)
+        if not isinstance(candidate, dict):
+            errors.append(error(SCHEMA, prefix+'not an object'))
+            continue
+        for key in ('candidate_set', 'candidate_id'):
+            if not isinstance(candidate.get(key), str):
+                errors.append(error(SCHEMA, prefix+'missing '+key))
+        version = candidate.get('version', 0)
+        if not isinstance(version, int) or version < 0:
+            errors.append(error(SCHEMA, prefix+'invalid version {!r}'.format(
+                version)))
+        candidate_set = candidate.get('candidate_set')
+        if (isinstance(candidate_set, str) and
+            candidate_set not in annset_keys):
+            errors.append(error(SCHEMA, prefix+'unknown candidate_set'))
+        for key in ('accepted', 'rejected'):
+            value = candidate.get(key, [])
+            if not _is_str_list(value):
+                errors.append(error(PICKS, prefix+key+' is not a list '
+                                    'of strings'))
+            elif any(v not in annset_keys for v in value):
+                errors.append(error(PICKS, prefix+key+' has unknown set'))
+    return errors
+
+
+def check_annset(annset_key, annset, text):
+    """Return errors in parsed annotation set for text."""
+    errors, seen = [], set()
+    for a in annset:
+        if a.id in seen:
+            errors.append(error(DUPLICATE, 'duplicate id', annset_key, a.id))
+        seen.add(a.id)
+        if not 0 <= a.start <= a.end <= len(text):
+            errors.append(error(OFFSETS, 'span {}-{} outside text of '
+                                'length {}'.format(a.start, a.end, len(text)),
+                                annset_key, a.id))
+        elif text[a.start:a.end] != a.text:
+            errors.append(error(TEXT, '{!r} does not match text {!r}'.format(
+                a.text, text[a.start:a.end]), annset_key, a.id))
+    return errors
+
+
+def check_document(files):
+    """Return errors in document given as { extension: data }, empty
+    if the document is valid."""
+    from .db import get_annset_keys, get_candidates
+    errors = [error(FILES, 'missing '+ext)
+              for ext in ('txt', 'json') if ext not in files]
+    if errors:
+        return errors
+    try:
+        metadata = json.loads(files['json'])
+    except ValueError as e:
+        return [error(SCHEMA, 'invalid JSON: {}'.format(e))]
+    try:
+        annset_keys = get_annset_keys(files, metadata)
+    except Exception as e:
+        return [error(SCHEMA, 'invalid annsets: {}'.format(e))]
+    if not annset_keys:
+        return [error(FILES, 'no annotation sets')]
+    errors.extend(error(FILES, 'missing '+key)
+                  for key in annset_keys if key not in files)
+    errors.extend(check_metadata(metadata, annset_keys))
+    text = files['txt']
+    annsets = {}
+    for key in annset_keys:
+        if key not in files:
+            continue
+        try:
+            annsets[key] = parse_standoff(files[key], key)
+        except Exception as e:
+            errors.append(error(PARSE, str(e), key))
+            continue
+        errors.extend(check_annset(key, annsets[key], text))
+    if any(e['kind'] == SCHEMA for e in errors):
+        return errors    # candidates can't be checked
+    for candidate in get_candidates(metadata):
+        key, id_ = candidate['candidate_set'], candidate['candidate_id']
+        if key in annsets and id_ not in annsets[key].by_id:
+            errors.append(error(CANDIDATE, 'not found', key, id_))
+    return errors
+
+
+def document_stamp(paths):
+    """Return value identifying the state of document files, as stored
+    in the report."""
+    stamp = []
+    for path in sorted(paths):
+        st = os.stat(path)
+        stamp.append([os.path.basename(path), st.st_ino, st.st_mtime_ns,
+                      st.st_size])
+    return stamp
+
+
+def _document_paths(collection_dir, document, extensions=None):
+    if extensions is None:
+        return list(iglob(os.path.join(collection_dir, document+'.*')))
+    return [os.path.join(collection_dir, '{}.{}'.format(document, ext))
+            for ext in extensions]
+
+
+def document_extensions(collection_dir):
+    """Return { document: extensions } for documents in collection."""
+    extensions = {}
+    with os.scandir(collection_dir) as it:
+        for entry in it:
+            root, ext = os.path.splitext(entry.name)
+            if ext and not entry.name.startswith('.') and entry.is_file():
+                extensions.setdefault(root, []).append(ext[1:])
+    return { d: e for d, e in extensions.items() if 'txt' in e }
+
+
+def validate_document(collection_dir, document, extensions=None):
+    """Return (document, stamp, errors) for document in collection."""
+    paths = _document_paths(collection_dir, document, extensions)
+    # stamp before reading, a change while reading invalidates it
+    stamp = document_stamp(paths)
+    files = {}
+    try:
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                files[os.path.splitext(path)[1][1:]] = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        return document, stamp, [error(FILES, str(e))]
+    return document, stamp, check_document(files)
+
+
+def _validate(args):
+    return validate_document(*args)
+
+
+def validate_collection(collection_dir, jobs=None):
+    """Check all documents in collection and return report."""
+    start = time.time()
+    extensions = document_extensions(collection_dir)
+    documents = sorted(extensions)
+    invalid, warnings = {}, {}
+    with Pool(jobs) as pool:
+        for document, stamp, errors in pool.imap(
+                _validate, [(collection_dir, d, extensions[d])
+                            for d in documents], chunksize=16):
+            errors, document_warnings = split_warnings(errors)
+            if errors:
+                invalid[document] = { 'stamp': stamp, 'errors': errors }
+            if document_warnings:
+                warnings[document] = document_warnings
+    return {
+        'version': REPORT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seconds': round(time.time() - start, 3),
+        'documents': len(documents),
+        'invalid': invalid,
+        'warnings': warnings,
+    }
+
+
+def report_path(collection_dir):
+    return os.path.join(collection_dir, REPORT_NAME)
+
+
+def save_report(collection_dir, report):
+    from .db import FilesystemData
+    FilesystemData.safe_write_file(report_path(collection_dir),
+                                   json.dumps(report, indent=1))
+
+
+def report_stamp(collection_dir):
+    """Return value that changes when the report changes, None if
+    there is no report."""
+    try:
+        st = os.stat(report_path(collection_dir))
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+_reports = {}    # { collection_dir: (report stamp, invalid) }
+
+
+def get_invalid(collection_dir):
+    """Return { document: { 'stamp': ..., 'errors': ... } } from the
+    report for collection, empty if there is none."""
+    stamp = report_stamp(collection_dir)
+    cached = _reports.get(collection_dir)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    invalid = {}
+    if stamp is not None:
+        try:
+            with open(report_path(collection_dir)) as f:
+                report = json.load(f)
+            if report.get('version') == REPORT_VERSION:
+                invalid = report['invalid']
+        except (OSError, ValueError, KeyError) as e:
+            warning('failed to read {}: {}'.format(
+                report_path(collection_dir), e))
+    _reports[collection_dir] = (stamp, invalid)
+    return invalid
+
+
+def known_errors(invalid, collection_dir, document, extensions=None):
+    """Return errors for document from report if its files haven't
+    changed since validation, None otherwise."""
+    entry = invalid.get(document)
+    if entry is None:
+        return None
+    paths = _document_paths(collection_dir, document, extensions)
+    try:
+        if document_stamp(paths) != entry['stamp']:
+            return None
+    except OSError:
+        return None
+    return entry['errors']
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Validate collection documents.')
+    ap.add_argument('-j', '--jobs', default=None, type=int,
+                    help='number of worker processes')
+    ap.add_argument('-n', '--no-save', default=False, action='store_true',
+                    help='only print errors, do not save report')
+    ap.add_argument('datadir', help='data directory')
+    ap.add_argument('collection', help='collection to validate')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    collection_dir = os.path.join(args.datadir, args.collection)
+    report = validate_collection(collection_dir, args.jobs)
+    for document, entry in sorted(report['invalid'].items()):
+        for e in entry['errors']:
+            print('{}\t{}'.format(document, format_error(e)))
+    for document, warnings in sorted(report['warnings'].items()):
+        for e in warnings:
+            print('{}\twarning: {}'.format(document, format_error(e)))
+    if not args.no_save:
+        save_report(collection_dir, report)
+    print('{} documents, {} invalid, {} with warnings, {:.1f}s'.format(
+        report['documents'], len(report['invalid']),
+        len(report['warnings']), report['seconds']), file=sys.stderr)
+    return 1 if report['invalid'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,15 +1,49 @@
-from flask import Blueprint
-from flask import request, url_for, render_template, jsonify
+import os
+
+from uuid import uuid4
+
+from flask import Blueprint, Response, stream_with_context
+from flask import request, url_for, render_template, jsonify, redirect
+from flask import abort
 from flask import current_app as app
 
-from .db import get_db
+from pickanno import conf
+from .db import get_db, get_version, get_picks
+from .db import VersionConflict, NoSuchCandidate
+from .db import document_cache_stats
+from .sharedcache import get_shared_cache
+from .validate import InvalidDocument
+from .search import IndexNotReady
+from .workqueue import next_item, POLICY_ORDER, POLICIES
+from .stats import get_stats, STATUSES
+from .warmup import get_warmup
+from .agreement import summarize
 from .visualize import visualize_candidates, visualize_annotation_sets
-from .visualize import visualize_legend
+from .visualize import visualize_legend, visualize_context_chunk
+from .visualize import cached_visualization, candidate_view_data
 from .protocol import PICK_FIRST, PICK_LAST, PICK_ALL, PICK_NONE, CLEAR_PICKS
+from .protocol import PICK_NTH
 
 bp = Blueprint('view', __name__, static_folder='static', url_prefix='/pickanno')
 
 
+@bp.errorhandler(InvalidDocument)
+def invalid_document(e):
+    # known from the validation report, see validate
+    return Response(str(e)+'\n', status=500, mimetype='text/plain')
+
+
+@bp.errorhandler(IndexNotReady)
+def index_not_ready(e):
+    return Response(str(e)+', try again shortly\n', status=503,
+                    mimetype='text/plain', headers={ 'Retry-After': '10' })
+
+
+@bp.errorhandler(NoSuchCandidate)
+def no_such_candidate(e):
+    return Response(str(e)+'\n', status=404, mimetype='text/plain')
+
+
 @bp.route('/')
 def root():
     return show_collections()
@@ -22,13 +56,174 @@ def show_collections():
     return render_template('collections.html', collections=collections)
 
 
+@bp.route('/metrics')
+def show_metrics():
+    """Cache statistics of the process serving the request."""
+    shared = get_shared_cache()
+    return jsonify({
+        'pid': os.getpid(),
+        'document_cache': document_cache_stats(),
+        'shared_cache': shared.stats() if shared is not None else None,
+    })
+
+
+@bp.route('/ready')
+def show_ready():
+    """Warm-up progress of the process serving the request, 503 until
+    finished."""
+    warmup = get_warmup(app)
+    if warmup is None:
+        return jsonify({ 'ready': True })
+    ready = warmup.finished
+    return jsonify(dict(warmup.progress(), ready=ready)), 200 if ready else 503
+
+
 @bp.route('/<collection>/')
 def show_collection(collection):
     db = get_db()
-    documents, statuses = db.get_documents(collection, include_status=True)
+    prefix = request.args.get('prefix') or None
+    status = request.args.get('status') or None
+    # computed once, rows add the document name
+    document_url = _document_url_prefix(collection)
+    if request.args.get('all'):
+        # everything, sent as it is read
+        rows = db.iter_document_statuses(collection, prefix, status)
+        stream = _stream_template('documents.html', **locals())
+        return Response(stream_with_context(stream))
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = conf.get_listing_page_size()
+    rows, more, total = db.get_document_page(
+        collection, prefix, status, (page-1)*per_page, per_page)
+    args = { k: v for k, v in (('prefix', prefix), ('status', status)) if v }
+    prev_url = (url_for('view.show_collection', collection=collection,
+                        page=page-1, **args) if page > 1 else None)
+    next_url = (url_for('view.show_collection', collection=collection,
+                        page=page+1, **args) if more else None)
+    all_url = url_for('view.show_collection', collection=collection, all=1,
+                      **args)
     return render_template('documents.html', **locals())
 
 
+def _document_url_prefix(collection):
+    placeholder = 'DOCUMENT'
+    url = url_for('view.show_alternative_annotations', collection=collection,
+                  document=placeholder)
+    return url[:-len(placeholder)]
+
+
+def _stream_template(template_name, **context):
+    # https://flask.palletsprojects.com/en/1.1.x/patterns/streaming/
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(100)
+    return stream
+
+
+# Collection-level pages are prefixed with "_" so that they don't
+# shadow documents of the same name
+
+@bp.route('/<collection>/_agreement')
+def show_agreement(collection):
+    db = get_db()
+    sets = request.args.get('sets', 'ann1,ann2').split(',')
+    if (len(sets) != 2 or sets[0] == sets[1] or
+        any(s not in db.get_annset_extensions(collection) for s in sets)):
+        abort(400, 'sets must name two annotation sets of the collection')
+    documents, total = db.get_agreement(collection, sets)
+    summary = summarize(total)
+    document_summaries = [
+        (d, summarize(counts)[-1][1]) for d, counts in documents.items()
+    ]
+    return render_template('agreement.html', **locals())
+
+
+@bp.route('/<collection>/_stats')
+def show_stats(collection):
+    stats = get_stats(conf.get_datadir(), collection)
+    rows, total, documents = stats.summary(bool(request.args.get('rebuild')))
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'documents': documents,
+            'total': { s: total[s] for s in STATUSES },
+            'counts': [
+                dict(type=t, source=s, **{ k: c[k] for k in STATUSES })
+                for t, s, c in rows
+            ],
+        })
+    statuses = STATUSES
+    return render_template('stats.html', **locals())
+
+
+@bp.route('/<collection>/_search')
+def search_collection(collection):
+    db = get_db()
+    query = request.args.get('q', '')
+    field = request.args.get('field') or None
+    type_ = request.args.get('type') or None
+    annset = request.args.get('annset') or None
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = max(1, min(100, request.args.get('per_page', 20, type=int)))
+    total, results = db.search(collection, query, field, type_, annset,
+                               page, per_page)
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'total': total,
+            'page': page,
+            'results': [
+                {
+                    'document': d,
+                    'matches': [
+                        dict(zip(('field', 'annset', 'type', 'snippet'), m))
+                        for m in matches
+                    ]
+                }
+                for d, matches in results
+            ],
+        })
+    # only the search parameters, other query keys could clash with
+    # the arguments of url_for()
+    args = { k: v for k, v in (('q', query), ('field', field),
+                               ('type', type_), ('annset', annset),
+                               ('per_page', per_page)) if v }
+    prev_url = (url_for('view.search_collection', collection=collection,
+                        page=page-1, **args) if page > 1 else None)
+    next_url = (url_for('view.search_collection', collection=collection,
+                        page=page+1, **args)
+                if page*per_page < total else None)
+    return render_template('search.html', **locals())
+
+
+@bp.route('/<collection>/_next')
+def next_unjudged(collection):
+    # Annotators are told apart by cookie for leasing documents
+    annotator = request.cookies.get('annotator') or uuid4().hex
+    policy = request.args.get('policy', POLICY_ORDER)
+    if policy not in POLICIES:
+        abort(400, 'policy must be one of {}'.format(', '.join(POLICIES)))
+    item = next_item(conf.get_datadir(), collection, annotator, policy,
+                     request.args.get('type'), request.args.get('after'))
+    if item is None:
+        url = None
+    else:
+        document, candidate = item
+        url = url_for('view.show_alternative_annotations',
+                      collection=collection, document=document,
+                      candidate=candidate or None)
+    if request.args.get('format') == 'json':
+        response = jsonify({
+            'document': item and item[0],
+            'candidate': item and item[1],
+            'url': url,
+        })
+    else:
+        # nothing left, back to the listing
+        response = redirect(url or url_for('view.show_collection',
+                                           collection=collection))
+    if request.cookies.get('annotator') != annotator:
+        response.set_cookie('annotator', annotator, max_age=365*24*3600)
+    return response
+
+
 @bp.route('/<collection>/<document>.txt')
 def show_text(collection, document):
     db = get_db()
@@ -59,11 +254,39 @@ def _prev_and_next_url(endpoint, collection, document):
     return prev_url, next_url
 
 
+def _prev_and_next_candidate_url(collection, document_data, document,
+                                 endpoint='view.show_alternative_annotations'):
+    # navigation helper, visits candidates in document before moving on
+    index = document_data.candidate_index
+    last = len(document_data.candidates) - 1
+    db = get_db()
+    prev_doc, next_doc = db.get_neighbouring_documents(collection, document)
+    if index > 0:
+        prev_url = url_for(endpoint, collection=collection, document=document,
+                           candidate=index-1 if index > 1 else None)
+    elif prev_doc is not None:
+        # -1 for last candidate of previous document
+        prev_url = url_for(endpoint, collection=collection, document=prev_doc,
+                           candidate=-1)
+    else:
+        prev_url = None
+    if index < last:
+        next_url = url_for(endpoint, collection=collection, document=document,
+                           candidate=index+1)
+    elif next_doc is not None:
+        next_url = url_for(endpoint, collection=collection, document=next_doc)
+    else:
+        next_url = None
+    return prev_url, next_url
+
+
 @bp.route('/<collection>/<document>.all')
 def show_all_annotations(collection, document):
     db = get_db()
     document_data = db.get_document_data(collection, document)
-    content = visualize_annotation_sets(document_data)
+    content = cached_visualization(
+        visualize_annotation_sets, document_data,
+        db.get_document_path(collection, document))
     legend = visualize_legend(document_data)
     prev_url, next_url = _prev_and_next_url(
         request.endpoint, collection, document)
@@ -73,22 +296,78 @@ def show_all_annotations(collection, document):
 @bp.route('/<collection>/<document>')
 def show_alternative_annotations(collection, document):
     db = get_db()
-    document_data = db.get_document_data(collection, document)
+    candidate = request.args.get('candidate', 0, type=int)
+    document_data = db.get_document_data(collection, document, candidate)
+    candidate = document_data.candidate_index
+    candidates_judged = document_data.candidates_judged()
     # Filter to avoid irrelevant types in legend
-    document_data.filter_to_candidate()
-    metadata = document_data.metadata
-    content = visualize_candidates(document_data)
-    legend = visualize_legend(document_data)
+    document_data = document_data.filtered_to_candidate()
+    metadata = document_data.candidate_metadata
+    version = document_data.version
     annotated_strings = document_data.annotated_strings()
-    prev_url, next_url = _prev_and_next_url(
-        request.endpoint, collection, document)
+    prev_url, next_url = _prev_and_next_candidate_url(
+        collection, document_data, document)
+    client_rendering = conf.get_client_rendering()
+    if client_rendering:
+        # rendered by the browser from show_document_data()
+        data_url = url_for('view.show_document_data', collection=collection,
+                           document=document, candidate=candidate or None)
+        _, next_data_url = _prev_and_next_candidate_url(
+            collection, document_data, document, 'view.show_document_data')
+        return render_template('pickanno.html', **locals())
+    content = cached_visualization(
+        visualize_candidates, document_data,
+        db.get_document_path(collection, document),
+        metadata['candidate_set'], metadata['candidate_id'])
+    legend = visualize_legend(document_data)
     return render_template('pickanno.html', **locals())
 
 
+@bp.route('/<collection>/<document>/data')
+def show_document_data(collection, document):
+    db = get_db()
+    candidate = request.args.get('candidate', 0, type=int)
+    document_data = db.get_document_data(collection, document, candidate)
+    metadata = document_data.candidate_metadata
+    data = cached_visualization(
+        candidate_view_data, document_data,
+        db.get_document_path(collection, document),
+        metadata['candidate_set'], metadata['candidate_id'])
+    return jsonify(dict(
+        data,
+        document=document,
+        candidate=document_data.candidate_index,
+        candidates=len(document_data.candidates),
+        metadata=metadata,
+        version=document_data.version,
+    ))
+
+
+@bp.route('/<collection>/<document>/context')
+def show_context_chunk(collection, document):
+    db = get_db()
+    candidate = request.args.get('candidate', 0, type=int)
+    document_data = db.get_document_data(collection, document, candidate)
+    direction = request.args.get('direction')
+    offset = request.args.get('offset', type=int)
+    if direction not in ('above', 'below'):
+        abort(400, 'direction must be above or below')
+    if offset is None or not 0 <= offset <= len(document_data.text):
+        abort(400, 'offset must be an integer within the text')
+    html, next_offset = visualize_context_chunk(
+        document_data, direction, offset)
+    return jsonify({
+        'html': html,
+        'offset': next_offset,
+    })
+
+
 @bp.route('/<collection>/<document>/pick')
 def pick_annotation(collection, document):
     db = get_db()
-    document_data = db.get_document_data(collection, document)
+    candidate = request.args.get('candidate', 0, type=int)
+    document_data = db.get_document_data(collection, document, candidate)
+    candidate = document_data.candidate_index
     keys = list(document_data.annsets.keys())
     choice = request.args.get('choice')
     if choice == PICK_NONE:
@@ -103,17 +382,34 @@ def pick_annotation(collection, document):
         accepted, rejected = [], []
     elif choice in keys:
         accepted, rejected = [choice], [k for k in keys if k != choice]
+    elif (choice is not None and choice.startswith(PICK_NTH) and
+          choice[len(PICK_NTH):].isdigit() and
+          0 < int(choice[len(PICK_NTH):]) <= len(keys)):
+        picked = keys[int(choice[len(PICK_NTH):])-1]
+        accepted, rejected = [picked], [k for k in keys if k != picked]
     else:
         app.logger.error('invalid choice {}'.format(choice))
+        abort(400, 'invalid choice {}'.format(choice))
 
-    app.logger.info('{}/{}: accepted {}, rejected {}'.format(
-        collection, document, accepted, rejected))
-    db.set_document_picks(collection, document, accepted, rejected)
-
-    # Make sure the DB agrees
-    data = db.get_document_metadata(collection, document)
+    # picks are based on the version the client has seen, if given
+    version = request.args.get('version', type=int)
+    app.logger.info('{}/{}[{}]: accepted {}, rejected {}'.format(
+        collection, document, candidate, accepted, rejected))
+    try:
+        data, version = db.set_document_picks(
+            collection, document, accepted, rejected, candidate, version)
+    except VersionConflict as e:
+        # picked by someone else, client shows their picks
+        app.logger.warning('{}/{}[{}]: {}'.format(
+            collection, document, candidate, e))
+        return jsonify({
+            'accepted': get_picks(e.candidate, 'accepted'),
+            'rejected': get_picks(e.candidate, 'rejected'),
+            'version': get_version(e.candidate),
+        }), 409
 
     return jsonify({
         'accepted': data['accepted'],
         'rejected': data['rejected'],
+        'version': version,
     })
@@ -1,21 +1,17 @@
 import os
-import sys
 import re
 
 from itertools import chain
+from collections import OrderedDict
 
 from flask import current_app as app
 
 from pickanno import conf
 from .so2html import standoff_to_html, generate_legend
-
-
-try:
-    from fontTools.ttLib import TTFont
-except ImportError:
-    print('Failed `import fontTools`, try `pip3 install fonttools`',
-          file=sys.stderr)
-    raise
+from .so2html import is_formatting_type, type_to_formatting_tag, markup_type
+from .fontmetrics import load_font_metrics
+from .parallel import parallel_enabled, starmap
+from .sharedcache import get_shared_cache, cache_key
 
 
 def visualize_legend(document_data):
@@ -28,15 +24,53 @@ def visualize_annotation_sets(document_data):
     """Generate visualization of several annotation sets for the same text."""
     text = document_data.text
     annsets = document_data.annsets
-    return [(k, standoff_to_html(text, a)) for k, a in annsets.items()]
+    keys = list(annsets.keys())
+    htmls = starmap(standoff_to_html, [(text, annsets[k]) for k in keys],
+                    _parallel_render(annsets))
+    return list(zip(keys, htmls))
+
+
+def cached_visualization(visualize, document_data, path, *parts):
+    """Return visualize(document_data), from the cache shared by
+    processes if available. path and parts identify the document and
+    any other input (e.g. candidate) affecting the result."""
+    shared = get_shared_cache()
+    if shared is None or document_data.stamp is None:
+        return visualize(document_data)
+    key = cache_key(path, 'render', visualize.__name__, *parts)
+    stamp = (document_data.stamp, render_settings())
+    value = shared.get(key, stamp)
+    if value is None:
+        value = visualize(document_data)
+        shared.put(key, stamp, value)
+    return value
+
+
+def render_settings():
+    """Return configuration values affecting visualizations."""
+    return (
+        conf.get_font_size(),
+        conf.get_font_file(),
+        conf.get_line_width(),
+        conf.get_context_window(),
+        conf.get_context_window_unit(),
+        app.config['HIGHLIGHT_CONTEXT_MENTIONS'],
+    )
+
+
+def _parallel_render(annsets):
+    """Return True if rendering of annsets should be fanned out."""
+    return (parallel_enabled(len(annsets)) and
+            sum(len(a) for a in annsets.values()) >=
+            conf.get_parallel_min_render_annotations())
 
 
 def _find_covering_span(text, annsets, word_boundary=True):
     """Find text span covering giving annotation sets, optionally
     extending it to word boundaries."""
-    flattened = [a for anns in annsets.values() for a in anns]
-    start = min(a.start for a in flattened)
-    end = max(a.end for a in flattened)
+    spans = [s for s in (a.span() for a in annsets.values()) if s]
+    start = min(s[0] for s in spans)
+    end = max(s[1] for s in spans)
     if word_boundary and text[start].isalnum():
         while start > 0 and text[start-1].isalnum():
             start -= 1
@@ -46,14 +80,15 @@ def _find_covering_span(text, annsets, word_boundary=True):
     return start, end
 
 
-def visualize_candidates(document_data):
-    """Generate visualization of alternative annotation candidates."""
+def _candidate_layout(document_data):
+    """Return (annsets, boundaries) for the candidate view, where
+    annsets are filtered to the candidate and boundaries are the
+    offsets (above_start, left_start, span_start, span_end, right_end,
+    below_end) of the parts of the text rendered in the view."""
     text = document_data.text
-    data = document_data.metadata
 
-    # Filter all annotation sets to overlapping (note: destructive)
-    document_data.filter_to_candidate()
-    annsets = document_data.annsets
+    # Filter all annotation sets to overlapping
+    annsets = document_data.filtered_to_candidate().annsets
 
     # Identify span to center in the visualization
     span_start, span_end = _find_covering_span(text, annsets)
@@ -61,28 +96,168 @@ def visualize_candidates(document_data):
     # Split text to segments around centered span
     above, left, span, right, below = _split_text(text, span_start, span_end)
 
-    # Adjust offsets for filtered annotations to zero at centered span start
-    annsets = _adjust_offsets(annsets, span_start)
-
-    if not app.config['HIGHLIGHT_CONTEXT_MENTIONS']:
-        above_ann, left_ann, right_ann, below_ann = [], [], [], []
+    # Restrict above and below to context window, the rest is
+    # rendered on demand by visualize_context_chunk()
+    above_end = len(above)
+    below_start = len(text) - len(below)
+    size, unit = conf.get_context_window(), conf.get_context_window_unit()
+    if size is None:
+        above_start, below_end = 0, len(text)
     else:
-        # TODO annotations spanning boundaries (e.g. above-left)
-        above_ann, left_ann, right_ann, below_ann = (
-            _add_highlight_annotations(t, annsets)
-            for t in (above, left, right, below)
-        )
+        above_start = _window_start(text, above_end, size, unit)
+        below_end = _window_end(text, below_start, size, unit)
+    return annsets, (above_start, above_end, span_start, span_end,
+                     below_start, below_end)
+
+
+def _highlight_annotations(text, annsets, boundaries):
+    """Return highlights for the above, left, right and below parts."""
+    above_start, left_start, span_start, span_end, right_end, below_end = \
+        boundaries
+    parts = ((above_start, left_start), (left_start, span_start),
+             (span_end, right_end), (right_end, below_end))
+    if not app.config['HIGHLIGHT_CONTEXT_MENTIONS']:
+        return [[] for _ in parts]
+    # TODO annotations spanning boundaries (e.g. above-left)
+    return [_add_highlight_annotations(text[s:e], annsets) for s, e in parts]
+
+
+def visualize_candidates(document_data):
+    """Generate visualization of alternative annotation candidates."""
+    text = document_data.text
+    annsets, boundaries = _candidate_layout(document_data)
+    above_start, left_start, span_start, span_end, right_end, below_end = \
+        boundaries
+    above = text[above_start:left_start]
+    left = text[left_start:span_start]
+    span = text[span_start:span_end]
+    right = text[span_end:right_end]
+    below = text[right_end:below_end]
+    above_ann, left_ann, right_ann, below_ann = _highlight_annotations(
+        text, annsets, boundaries)
 
     so2html = standoff_to_html
+    keys = list(annsets.keys())
+    # Annotation offsets are relative to the whole text
+    spans = starmap(_render_span, [(span, annsets[k], span_start)
+                                   for k in keys], _parallel_render(annsets))
     return {
         'above': so2html(above, above_ann),
         'left': so2html(left, left_ann),
-        'spans': { k: so2html(span, a) for k, a in annsets.items() },
+        'spans': OrderedDict(zip(keys, spans)),
         'right': so2html(right, right_ann),
         'below': so2html(below, below_ann),
+        'above_offset': above_start if above_start > 0 else None,
+        'below_offset': below_end if below_end < len(text) else None,
     }
 
 
+def candidate_view_data(document_data):
+    """Return the candidate view as data for rendering in the browser
+    (see static/js/so2html.js). The text is restricted to the context
+    window, offsets are relative to the whole text and annotations
+    are in columns with types as indices to the type table."""
+    text = document_data.text
+    annsets, boundaries = _candidate_layout(document_data)
+    above_start, below_end = boundaries[0], boundaries[-1]
+
+    types, type_index = [], {}
+    def index(type_):
+        i = type_index.get(type_)
+        if i is None:
+            i = type_index[type_] = len(types)
+            types.append(type_)
+        return i
+
+    columns = OrderedDict()
+    for key, annset in annsets.items():
+        columns[key] = {
+            'ids': [a.id for a in annset],
+            'starts': [a.start for a in annset],
+            'ends': [a.end for a in annset],
+            'types': [index(a.type) for a in annset],
+        }
+
+    # highlights are relative to their part, as rendered on the server
+    offsets = (boundaries[0], boundaries[1], boundaries[3], boundaries[4])
+    highlights = { 'starts': [], 'ends': [] }
+    for offset, standoffs in zip(offsets, _highlight_annotations(
+            text, annsets, boundaries)):
+        highlights['starts'].extend(offset + s.start for s in standoffs)
+        highlights['ends'].extend(offset + s.end for s in standoffs)
+
+    return {
+        'text': text[above_start:below_end],
+        'length': len(text),
+        'boundaries': boundaries,
+        'keys': list(columns),    # JSON objects are not ordered
+        'annsets': columns,
+        'types': types,
+        'markup': [type_to_formatting_tag(t) if is_formatting_type(t)
+                   else markup_type(t) for t in types],
+        'formatting': [is_formatting_type(t) for t in types],
+        'highlights': highlights,
+        'legend': visualize_legend(document_data.filtered_to_candidate()),
+    }
+
+
+def visualize_context_chunk(document_data, direction, offset):
+    """Generate visualization of context above or below the candidate
+    view, ending or starting at offset. Return (html, offset) where
+    offset is where the next chunk in the same direction starts or
+    ends, or None if the chunk reaches the start or end of the text."""
+    text = document_data.text
+    annsets = document_data.filtered_to_candidate().annsets
+    size, unit = conf.get_context_chunk_size(), conf.get_context_window_unit()
+    if direction == 'above':
+        start, end = _window_start(text, offset, size, unit), offset
+        next_offset = start if start > 0 else None
+    elif direction == 'below':
+        start, end = offset, _window_end(text, offset, size, unit)
+        next_offset = end if end < len(text) else None
+    else:
+        raise ValueError('invalid direction {}'.format(direction))
+    chunk = text[start:end]
+    if not app.config['HIGHLIGHT_CONTEXT_MENTIONS']:
+        chunk_ann = []
+    else:
+        chunk_ann = _add_highlight_annotations(chunk, annsets)
+    return standoff_to_html(chunk, chunk_ann), next_offset
+
+
+def _window_start(text, end, size, unit):
+    """Return start of window of size lines or characters ending at end."""
+    if unit == 'chars':
+        # extend to word boundary
+        start = max(0, end - size)
+        while start > 0 and not text[start-1].isspace():
+            start -= 1
+        return start
+    start = end
+    for i in range(size+1):
+        start = text.rfind('\n', 0, start)
+        if start == -1:
+            return 0
+    return start + 1
+
+
+def _window_end(text, start, size, unit):
+    """Return end of window of size lines or characters starting at start."""
+    if unit == 'chars':
+        # extend to word boundary
+        end = min(len(text), start + size)
+        while end < len(text) and not text[end].isspace():
+            end += 1
+        return end
+    end = start
+    for i in range(size+1):
+        end = text.find('\n', end)
+        if end == -1:
+            return len(text)
+        end += 1
+    return end
+
+
 def _add_highlight_annotations(text, annsets):
     from .so2html import Standoff, FORMATTING_TYPE_TAG_MAP
     underline = [k for k, v in FORMATTING_TYPE_TAG_MAP.items() if v == 'u'][0]
@@ -97,22 +272,57 @@ def _add_highlight_annotations(text, annsets):
     return spans
 
 
-def _adjust_offsets(annsets, offset):
-    # TODO consider making copies instead of modifying annotations in place
-    for key, annset in annsets.items():
-        for a in annset:
-            a.adjust_offsets(offset)
-    return annsets
+def _render_span(text, annotations, offset):
+    return standoff_to_html(text, annotations, offset=offset)
+
+
+def _tokenize(text):
+    return [t for t in re.split(r'(\s+)', text) if t]
+
 
+# Initial number of characters scanned for context on each side of a
+# span, doubled while the line continues and more could fit
+CONTEXT_CHARS = 256
 
-def _tokenize(text, reverse=False):
-    if not reverse:
-        tokens = re.split(r'(\s+)', text)
+_space_re = re.compile(r'\s*')
+
+
+def _line_bounds(text, start, end):
+    """Return (line_start, line_end) of the context available for span
+    (start, end): the text on the same line, excluding any whitespace
+    around the newlines."""
+    newline = text.rfind('\n', 0, start)
+    if newline == -1:
+        line_start = 0
+    else:
+        line_start = _space_re.match(text, newline+1, start).end()
+    newline = text.find('\n', end)
+    if newline == -1:
+        line_end = len(text)
     else:
-        text = text[::-1]
-        rev_tokens = re.split(r'(\s+)', text)
-        tokens = [t[::-1] for t in rev_tokens]
-    return [t for t in tokens if t]
+        line_end = newline
+        while line_end > end and text[line_end-1].isspace():
+            line_end -= 1
+    return line_start, line_end
+
+
+def _context_tokens(text, start, end, line_start, line_end, chars):
+    """Return tokens within chars of span (start, end) on its line, left
+    tokens in text order and right tokens in reverse order, and whether
+    each side was cut short of the line. Tokens possibly cut in the
+    middle are left out."""
+    window_start = max(line_start, start-chars)
+    window_end = min(line_end, end+chars)
+    left_tokens = _tokenize(text[window_start:start])
+    right_tokens = _tokenize(text[end:window_end])
+    left_cut = window_start > line_start
+    right_cut = window_end < line_end
+    if left_cut:
+        left_tokens = left_tokens[1:]
+    if right_cut:
+        right_tokens = right_tokens[:-1]
+    right_tokens.reverse()
+    return left_tokens, right_tokens, left_cut, right_cut
 
 
 def _split_text(text, start, end, line_width=None):
@@ -127,22 +337,35 @@ def _split_text(text, start, end, line_width=None):
     span_text = text[start:end]
     span_width = _text_width(span_text)
 
-    # add words to left and right until line width would be exceeded
-    left_tokens = _tokenize(text[:start])
-    right_tokens = _tokenize(text[end:], reverse=True)
-
-    # trim candidate tokens to avoid including newlines in span
-    def trim_tokens(tokens, filter_chars='\n'):
-        trimmed = []
-        for t in tokens:
-            if any(c for c in filter_chars if c in t):
-                trimmed = []
-            else:
-                trimmed.append(t)
-        return trimmed
-    right_tokens = trim_tokens(right_tokens)
-    left_tokens = trim_tokens(left_tokens)
-    
+    # add words to left and right until line width would be exceeded,
+    # scanning only as much of the line as may fit
+    line_start, line_end = _line_bounds(text, start, end)
+    chars = CONTEXT_CHARS
+    while True:
+        left_text, right_text = _fit_context(
+            *_context_tokens(text, start, end, line_start, line_end, chars),
+            span_width, line_width)
+        if left_text is not None:
+            break
+        chars *= 2
+
+    above_text = text[:start-len(left_text)]
+    below_text = text[end+len(right_text):]
+
+    # logging
+    lw, sw, rw = (_text_width(t) for t in (left_text, span_text, right_text))
+    tw = lw + sw + rw
+    app.logger.info('_split_text(): split line "{}"---"{}"---"{}",'
+                    'widths {}+{}+{}={}'.format(left_text, span_text,
+                                                right_text, lw, sw, rw, tw))
+
+    return above_text, left_text, span_text, right_text, below_text
+
+
+def _fit_context(left_tokens, right_tokens, left_cut, right_cut, span_width,
+                 line_width):
+    """Return (left, right) context fitting line_width with span, or
+    (None, None) if the tokens of a side that was cut short ran out."""
     left_text, right_text = '', ''
     left_width, right_width = 0, 0
     while True:
@@ -164,42 +387,24 @@ def _split_text(text, start, end, line_width=None):
                 continue
         break
 
-    above_text = text[:start-len(left_text)]
-    below_text = text[end+len(right_text):]
+    if (left_cut and not left_tokens) or (right_cut and not right_tokens):
+        return None, None
+    return left_text, right_text
 
-    assert above_text+left_text+span_text+right_text+below_text == text
 
-    # logging
-    lw, sw, rw = (_text_width(t) for t in (left_text, span_text, right_text))
-    tw = lw + sw + rw
-    app.logger.info('_split_text(): split line "{}"---"{}"---"{}",'
-                    'widths {}+{}+{}={}'.format(left_text, span_text,
-                                                right_text, lw, sw, rw, tw))
-
-    return above_text, left_text, span_text, right_text, below_text
+def get_font_metrics(font_file=None):
+    """Return metrics of font, loaded on first use."""
+    if font_file is None:
+        font_file = conf.get_font_file()
+    if font_file not in get_font_metrics.cache:
+        font_path = os.path.join(app.root_path, 'static', 'fonts', font_file)
+        get_font_metrics.cache[font_file] = load_font_metrics(font_path)
+    return get_font_metrics.cache[font_file]
+get_font_metrics.cache = {}
 
 
 def _text_width(text, point_size=None, font_file=None):
     """Return width of text in given point size and font."""
     if point_size is None:
         point_size = conf.get_font_size()
-    if font_file is None:
-        font_file = conf.get_font_file()
-    if font_file not in _text_width.cache:
-        font_path = os.path.join(app.root_path, 'static', 'fonts', font_file)
-        _text_width.cache[font_file] = TTFont(font_path)
-    ttfont = _text_width.cache[font_file]
-    # Following https://stackoverflow.com/a/48357457
-    cmap = ttfont['cmap']
-    tcmap = cmap.getcmap(3,1).cmap
-    glyphset = ttfont.getGlyphSet()
-    units_per_em = ttfont['head'].unitsPerEm
-    total = 0
-    for c in text:
-        if ord(c) in tcmap and tcmap[ord(c)] in glyphset:
-            total += glyphset[tcmap[ord(c)]].width
-        else:
-            total += glyphset['.notdef'].width
-    total_points = total * point_size / units_per_em
-    return total_points
-_text_width.cache = {}
+    return get_font_metrics(font_file).text_width(text, point_size)
@@ -0,0 +1,139 @@
+"""Warm-up of a new app process.
+
+With WARMUP enabled, the first request to a process starts a
+background thread that loads the font metrics, builds the document
+listings and work queues of all collections and parses the
+WARMUP_DOCUMENTS most recently modified (i.e. picked) documents, so
+that the first annotators after a restart don't pay for cold caches.
+The warm-up is started per process and not in create_app(), as
+threads don't survive fork() into the workers of a server that loads
+the app before forking (e.g. gunicorn --preload). The progress is
+served at /pickanno/ready, which answers 503 until the warm-up of the
+process has finished.
+"""
+
+import os
+import time
+import threading
+
+from logging import warning
+
+from pickanno import conf
+
+
+# Stages in order
+FONT = 'font'
+LISTINGS = 'listings'
+DOCUMENTS = 'documents'
+DONE = 'done'
+
+
+class Warmup(threading.Thread):
+    """Background warm-up of the caches of this process."""
+    def __init__(self, app):
+        super().__init__(daemon=True)
+        self.app = app
+        self.pid = os.getpid()
+        self.stage = None
+        self.collections = 0
+        self.documents = 0
+        self.documents_total = None
+        self.errors = 0
+        self.start_time = None
+        self.seconds = None
+
+    def run(self):
+        self.start_time = time.time()
+        with self.app.app_context():
+            try:
+                self._warm_up()
+            except Exception as e:
+                # serve cold rather than not at all
+                warning('warm-up failed: {}'.format(e))
+                self.errors += 1
+        self.seconds = time.time() - self.start_time
+        self.stage = DONE
+
+    def _warm_up(self):
+        from .db import get_db
+        from .workqueue import get_queue
+        from .visualize import get_font_metrics
+        self.stage = FONT
+        get_font_metrics()
+        self.stage = LISTINGS
+        db = get_db()
+        collections = db.get_collections()
+        for collection in collections:
+            for _ in db.iter_document_statuses(collection):
+                pass
+            len(get_queue(db.root_dir, collection))
+            self.collections += 1
+        self.stage = DOCUMENTS
+        recent = recent_documents(db.root_dir, collections,
+                                  conf.get_warmup_documents())
+        self.documents_total = len(recent)
+        for collection, document in recent:
+            try:
+                db.get_document_data(collection, document)
+            except Exception:
+                self.errors += 1    # reported when requested
+            self.documents += 1
+
+    @property
+    def finished(self):
+        return self.stage == DONE
+
+    def progress(self):
+        seconds = self.seconds
+        if seconds is None and self.start_time is not None:
+            seconds = time.time() - self.start_time
+        return {
+            'stage': self.stage,
+            'collections': self.collections,
+            'documents': self.documents,
+            'documents_total': self.documents_total,
+            'errors': self.errors,
+            'seconds': seconds,
+        }
+
+
+def recent_documents(root_dir, collections, count):
+    """Return (collection, document) for the count documents with the
+    most recently modified metadata, most recent first."""
+    entries = []
+    for collection in collections:
+        with os.scandir(os.path.join(root_dir, collection)) as it:
+            for entry in it:
+                if (entry.name.endswith('.json') and
+                    not entry.name.startswith('.') and entry.is_file()):
+                    entries.append((entry.stat().st_mtime, collection,
+                                    entry.name[:-len('.json')]))
+    entries.sort(reverse=True)
+    return [(c, d) for _, c, d in entries[:count]]
+
+
+_warmup_lock = threading.Lock()
+
+
+def get_warmup(app):
+    """Return warm-up of app in this process, None if not started."""
+    warmup = app.extensions.get('pickanno.warmup')
+    if warmup is None or warmup.pid != os.getpid():
+        return None    # started before fork(), not running here
+    return warmup
+
+
+def start_warmup(app):
+    warmup = app.extensions['pickanno.warmup'] = Warmup(app)
+    warmup.start()
+    return warmup
+
+
+def init(app):
+    @app.before_request
+    def start_process_warmup():
+        if get_warmup(app) is not None or not conf.get_warmup():
+            return
+        with _warmup_lock:
+            if get_warmup(app) is None:
+                start_warmup(app)
@@ -0,0 +1,393 @@
+"""Change notification for the data directory.
+
+A Watcher follows changes to the collections and documents under a
+data directory and publishes invalidation events to subscribers as
+(root_dir, collection, document), where document is None if the
+whole collection may have changed and collection is None if
+anything may have changed. Caches subscribe with subscribe() and can
+then trust their entries until invalidated instead of checking files
+on every request.
+
+Changes are detected with inotify on Linux, or by polling the
+modification times of the data and collection directories, which
+change when files are added, removed or replaced by rename (as by
+atomic writes and rsync). In-place modifications of files are only
+seen by inotify (see sees_modifications), so entries cached while
+polling are still checked against their files, at most once per poll
+interval. Inotify does not see changes made on other hosts to network
+filesystems, where the auto mode polls instead. In manual mode there
+is no background thread and changes are only published when check()
+is called, for driving the watcher deterministically in tests.
+"""
+
+import os
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+from logging import warning
+
+from pickanno import conf
+
+
+MODE_AUTO = 'auto'         # inotify if available, else polling
+MODE_INOTIFY = 'inotify'
+MODE_POLL = 'poll'
+MODE_MANUAL = 'manual'     # polling only on check(), for tests
+
+MODES = (MODE_AUTO, MODE_INOTIFY, MODE_POLL, MODE_MANUAL)
+
+
+_subscribers = []
+
+
+def subscribe(func):
+    """Call func(root_dir, collection, document) on changes."""
+    _subscribers.append(func)
+
+
+def publish(root_dir, events):
+    for collection, document in sorted(events, key=_event_key):
+        for func in _subscribers:
+            func(root_dir, collection, document)
+
+
+def _event_key(event):
+    return tuple('' if v is None else v for v in event)
+
+
+def _document_name(filename):
+    """Return document for file in collection, or None for files that
+    are not part of documents (e.g. temporary files)."""
+    if filename.startswith('.'):
+        return None
+    root, ext = os.path.splitext(filename)
+    return root if ext else None
+
+
+class PollingWatcher(object):
+    """Watcher comparing directory modification times. With an
+    interval, the files are first scanned in the background thread and
+    the watcher is ready when done."""
+    sees_modifications = False
+
+    def __init__(self, root_dir, interval=None):
+        self.root_dir = root_dir
+        self.interval = interval
+        self.pid = os.getpid()
+        self.dir_mtimes = {}    # { collection or None: mtime }
+        self.documents = {}     # { collection: { document: stamp } }
+        self.racy = set()       # directories to rescan regardless of mtime
+        self.ready = False
+        self.thread = None
+        if interval is None:
+            self._initial_scan()
+            self.ready = True
+        else:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _initial_scan(self):
+        for collection in self._scan_root():
+            self.documents[collection] = self._scan_collection(collection)
+
+    def _run(self):
+        while not self.ready:
+            try:
+                self._initial_scan()
+            except Exception as e:
+                warning('watcher for {}: {}'.format(self.root_dir, e))
+                time.sleep(self.interval)
+                continue
+            self.ready = True
+            # caches filled before the scan were not watched
+            publish(self.root_dir, [(None, None)])
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                warning('watcher for {}: {}'.format(self.root_dir, e))
+
+    def _stat_dir(self, collection):
+        path = self.root_dir
+        if collection is not None:
+            path = os.path.join(path, collection)
+        mtime = os.stat(path).st_mtime_ns
+        # A change within the timestamp granularity after this may not
+        # alter the mtime, so rescan on next check (cf. git "racy" files)
+        if time.time_ns() - mtime < 2*10**9:
+            self.racy.add(collection)
+        else:
+            self.racy.discard(collection)
+        return mtime
+
+    def _scan_root(self):
+        self.dir_mtimes[None] = self._stat_dir(None)
+        collections = set()
+        with os.scandir(self.root_dir) as it:
+            for entry in it:
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    collections.add(entry.name)
+        return collections
+
+    def _scan_collection(self, collection):
+        self.dir_mtimes[collection] = self._stat_dir(collection)
+        files = {}
+        with os.scandir(os.path.join(self.root_dir, collection)) as it:
+            for entry in it:
+                document = _document_name(entry.name)
+                if document is not None and entry.is_file():
+                    st = entry.stat()
+                    files.setdefault(document, []).append(
+                        (entry.name, st.st_ino, st.st_mtime_ns, st.st_size))
+        return { d: tuple(sorted(s)) for d, s in files.items() }
+
+    def check(self):
+        """Publish changes since last check and return them as a list
+        of (collection, document)."""
+        events = []
+        known = set(self.documents)
+        if (None in self.racy or
+            self.dir_mtimes.get(None) != os.stat(self.root_dir).st_mtime_ns):
+            collections = self._scan_root()
+        else:
+            collections = known
+        for collection in sorted(known - collections):
+            del self.documents[collection]
+            self.dir_mtimes.pop(collection, None)
+            events.append((collection, None))
+        for collection in sorted(collections):
+            if collection not in known:
+                try:
+                    self.documents[collection] = self._scan_collection(
+                        collection)
+                except OSError:
+                    continue
+                events.append((collection, None))
+                continue
+            path = os.path.join(self.root_dir, collection)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue    # removed, seen on next check
+            if (collection not in self.racy and
+                mtime == self.dir_mtimes.get(collection)):
+                continue
+            previous = self.documents[collection]
+            current = self._scan_collection(collection)
+            self.documents[collection] = current
+            for document in sorted(set(previous) | set(current)):
+                if previous.get(document) != current.get(document):
+                    events.append((collection, document))
+        if events:
+            publish(self.root_dir, events)
+        return events
+
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+IN_DIR_CHANGES = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+IN_FILE_CHANGES = IN_DIR_CHANGES | IN_CLOSE_WRITE | IN_ATTRIB
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+# f_type of network filesystems from statfs(2)
+NETWORK_FILESYSTEMS = {
+    0x6969: 'nfs',
+    0x517b: 'smb',
+    0xff534d42: 'cifs',
+    0xfe534d42: 'smb2',
+    0x73757245: 'coda',
+    0x5346414f: 'afs',
+    0x00c36400: 'ceph',
+    0x01021997: '9p',
+    0x0bd00bd0: 'lustre',
+    0x47504653: 'gpfs',
+    0x65735546: 'fuse',    # e.g. sshfs
+}
+
+
+def network_filesystem(path):
+    """Return name of network filesystem of path, None if local or not
+    known."""
+    try:
+        libc = _load_libc()
+        buf = ctypes.create_string_buffer(256)    # > sizeof(struct statfs)
+        if libc.statfs(os.fsencode(path), buf) != 0:
+            return None
+    except (OSError, AttributeError):
+        return None
+    f_type = ctypes.c_long.from_buffer(buf).value & 0xffffffff
+    return NETWORK_FILESYSTEMS.get(f_type)
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    libc.inotify_init1    # raises AttributeError if not available
+    return libc
+
+
+class InotifyWatcher(object):
+    """Watcher using Linux inotify, with a watch for the data directory
+    and one for each collection."""
+    sees_modifications = True
+    ready = True
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.pid = os.getpid()
+        self.libc = _load_libc()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.collections = {}    # { watch descriptor: collection or None }
+        self._add_watch(None)
+        with os.scandir(root_dir) as it:
+            for entry in it:
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    self._add_watch(entry.name)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _add_watch(self, collection):
+        if collection is None:
+            path, mask = self.root_dir, IN_DIR_CHANGES
+        else:
+            path = os.path.join(self.root_dir, collection)
+            mask = IN_FILE_CHANGES
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                warning('inotify watch limit reached, see '
+                        '/proc/sys/fs/inotify/max_user_watches')
+            raise OSError(error, 'inotify_add_watch failed', path)
+        self.collections[wd] = collection
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+                publish(self.root_dir, self._parse(data))
+            except Exception as e:
+                warning('watcher for {}: {}'.format(self.root_dir, e))
+
+    def _parse(self, data):
+        events = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            name = os.fsdecode(name)
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.add((None, None))
+                continue
+            collection = self.collections.get(wd)
+            if mask & IN_IGNORED:
+                self.collections.pop(wd, None)
+            elif wd not in self.collections:
+                continue
+            elif collection is None:
+                # subdirectory of the data directory
+                if not (mask & IN_ISDIR) or name.startswith('.'):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._add_watch(name)
+                    except OSError as e:
+                        warning('failed to watch {}: {}'.format(name, e))
+                events.add((name, None))
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                events.add((collection, None))
+            else:
+                document = _document_name(name)
+                if document is not None:
+                    events.add((collection, document))
+        return events
+
+    def check(self):
+        return []    # events are published as they arrive
+
+    def close(self):
+        os.close(self.fd)
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def _close_inherited():
+    # The watchers of the parent don't run in a forked child, and the
+    # child must not keep the inotify descriptors of the parent open
+    global _watchers_lock
+    _watchers_lock = threading.Lock()
+    for watcher in _watchers.values():
+        if isinstance(watcher, InotifyWatcher):
+            try:
+                watcher.close()
+            except OSError:
+                pass
+    _watchers.clear()
+
+
+os.register_at_fork(after_in_child=_close_inherited)
+
+
+def create_watcher(root_dir, mode, interval):
+    if mode == MODE_AUTO:
+        filesystem = network_filesystem(root_dir)
+        if filesystem is not None:
+            # inotify only sees changes made on this host
+            warning('{} is on {}, polling'.format(root_dir, filesystem))
+            mode = MODE_POLL
+    if mode in (MODE_AUTO, MODE_INOTIFY):
+        try:
+            return InotifyWatcher(root_dir)
+        except (OSError, AttributeError) as e:
+            if mode == MODE_INOTIFY:
+                raise
+            warning('inotify not available ({}), polling {}'.format(
+                e, root_dir))
+    if mode == MODE_MANUAL:
+        interval = None
+    return PollingWatcher(root_dir, interval)
+
+
+def get_watcher(root_dir):
+    """Return watcher for data directory in this process, starting it
+    if needed, or None if watching is disabled or the watcher is not
+    ready yet."""
+    mode = conf.get_watch_mode()
+    if mode is None:
+        return None
+    pid = os.getpid()
+    with _watchers_lock:
+        watcher = _watchers.get(root_dir)
+        if watcher is None or watcher.pid != pid:
+            # threads don't survive fork(), start a new one per process
+            watcher = create_watcher(root_dir, mode,
+                                     conf.get_watch_poll_interval())
+            _watchers[root_dir] = watcher
+    return watcher if watcher.ready else None
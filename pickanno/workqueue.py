@@ -0,0 +1,271 @@
+"""Queue of unjudged candidates for handing out work to annotators.
+
+Each collection has a queue of (document, candidate) items in
+collection order. Positions of items not yet judged are kept in a
+sorted list, so the next unjudged item from any position is found by
+bisection, and the list is updated on every pick instead of scanning
+the collection. The queue is built from metadata without parsing and
+rebuilt when the collection changes in other ways (see
+collectionindex).
+Items handed out are leased to the annotator for a short time so that
+annotators working at the same time get different items; leases are
+kept in an SQLite database in CACHEDIR shared by the processes.
+"""
+
+import os
+import time
+import random
+import threading
+
+from bisect import bisect_left
+
+from pickanno import conf
+from .db import get_candidates, candidate_judged
+from .collectionindex import CollectionIndex, get_index
+from .sharedcache import SQLiteStore
+
+
+POLICY_ORDER = 'order'     # next in collection order
+POLICY_RANDOM = 'random'   # random unjudged item
+POLICY_TYPE = 'type'       # next with candidate of given type
+
+POLICIES = (POLICY_ORDER, POLICY_RANDOM, POLICY_TYPE)
+
+# Random picks to try before falling back to order
+RANDOM_TRIES = 10
+
+LEASE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS leases ('
+    ' collection TEXT, document TEXT, candidate INTEGER, annotator TEXT,'
+    ' expiry REAL, PRIMARY KEY (collection, document, candidate))',
+    'CREATE INDEX IF NOT EXISTS leases_annotator'
+    ' ON leases (collection, annotator)',
+    'CREATE INDEX IF NOT EXISTS leases_expiry ON leases (expiry)',
+]
+
+
+class LeaseTable(SQLiteStore):
+    """Leases of work queue items to annotators, shared by the
+    processes on a host."""
+    def __init__(self, path):
+        super().__init__(path)
+        with self._transaction() as db:
+            for statement in LEASE_SCHEMA:
+                db.execute(statement)
+
+    def lease(self, collection_dir, annotator, items, seconds):
+        """Lease the first of the (document, candidate) items that is
+        not leased to another annotator to annotator for seconds and
+        return it, or None if all are. Earlier leases of annotator in
+        the collection are released."""
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('DELETE FROM leases WHERE expiry <= ?', (now,))
+            db.execute('DELETE FROM leases WHERE collection = ? AND'
+                       ' annotator = ?', (collection_dir, annotator))
+            for document, candidate in items:
+                key = (collection_dir, document, candidate)
+                if db.execute('SELECT 1 FROM leases WHERE collection = ? AND'
+                              ' document = ? AND candidate = ?',
+                              key).fetchone() is None:
+                    db.execute('INSERT INTO leases VALUES (?, ?, ?, ?, ?)',
+                               key + (annotator, now + seconds))
+                    return document, candidate
+        return None
+
+
+class WorkQueue(CollectionIndex):
+    """Unjudged candidates of one collection."""
+    def _build(self):
+        self.items = []        # (document, candidate index) by position
+        self.position = {}     # { item: position }
+        self.annset_keys = {}  # { document: annset_keys }
+        self.incomplete = []   # sorted positions of unjudged items
+        self.by_type = None    # { type: sorted positions }, on first use
+        self.types = None      # { position: type }
+        for document, annset_keys, metadata in self.db.iter_documents(
+                self.collection):
+            if metadata is None:
+                continue    # skip documents with errors
+            self.annset_keys[document] = annset_keys
+            for i, candidate in enumerate(get_candidates(metadata)):
+                item = (document, i)
+                self.position[item] = len(self.items)
+                if not candidate_judged(candidate, annset_keys):
+                    self.incomplete.append(len(self.items))
+                self.items.append(item)
+
+    def _update_document(self, document):
+        if document not in self.annset_keys:
+            self.stale = True    # new, positions of items change
+            return
+        entry = self.db.get_document_entry(self.collection, document)
+        if entry is None or entry[2] is None:
+            self.stale = True    # removed or broken
+            return
+        _, annset_keys, metadata = entry
+        candidates = get_candidates(metadata)
+        if (annset_keys != self.annset_keys[document] or
+            (document, len(candidates)) in self.position or
+            (document, len(candidates)-1) not in self.position):
+            self.stale = True    # different sets or candidates
+            return
+        for i, candidate in enumerate(candidates):
+            self._set_judged(self.position[(document, i)],
+                             candidate_judged(candidate, annset_keys))
+
+    def _build_types(self):
+        # Types are only needed for POLICY_TYPE and require reading the
+        # annotation files, so this is done on first use.
+        self.types, self.by_type = {}, {}
+        for position, (document, i) in enumerate(self.items):
+            metadata = self.db.get_document_metadata(self.collection,
+                                                     document)
+            candidate = get_candidates(metadata)[i]
+            path = os.path.join(self.collection_dir, '{}.{}'.format(
+                document, candidate['candidate_set']))
+            self.types[position] = read_annotation_type(
+                path, candidate['candidate_id'])
+        for position in self.incomplete:
+            type_ = self.types[position]
+            self.by_type.setdefault(type_, []).append(position)
+
+    def __len__(self):
+        with self.lock:
+            self._check_current()
+            return len(self.incomplete)
+
+    def _update_pick(self, document, candidate, candidate_data):
+        position = self.position.get((document, candidate))
+        if position is None:
+            return
+        keys = self.annset_keys[document]
+        self._set_judged(position, candidate_judged(candidate_data, keys))
+
+    def _set_judged(self, position, judged):
+        lists = [self.incomplete]
+        if self.by_type is not None:
+            lists.append(self.by_type.setdefault(self.types[position], []))
+        for positions in lists:
+            i = bisect_left(positions, position)
+            found = i < len(positions) and positions[i] == position
+            if judged and found:
+                del positions[i]
+            elif not judged and not found:
+                positions.insert(i, position)
+
+    def _is_judged(self, position):
+        # Check from file in case another process judged the item.
+        document, i = self.items[position]
+        try:
+            metadata = self.db.get_document_metadata(self.collection,
+                                                     document)
+            candidate = get_candidates(metadata)[i]
+            judged = candidate_judged(candidate, self.annset_keys[document])
+        except Exception:
+            judged = True    # broken since build, don't hand out
+        if judged:
+            self._set_judged(position, True)
+        return judged
+
+    def _unjudged(self, positions, start, end=None):
+        """Generate unjudged positions from start to end, dropping those
+        found judged since."""
+        i = bisect_left(positions, start)
+        while i < len(positions) and (end is None or positions[i] < end):
+            position = positions[i]
+            if not self._is_judged(position):
+                yield position
+            if i < len(positions) and positions[i] == position:
+                i += 1    # not removed by _is_judged()
+
+    def _preferred(self, positions, policy, after):
+        """Generate unjudged positions in order of preference."""
+        if policy == POLICY_RANDOM:
+            for _ in range(RANDOM_TRIES):
+                if not positions:
+                    break
+                position = random.choice(positions)
+                if not self._is_judged(position):
+                    yield position
+        start = self._start_position(after)
+        yield from self._unjudged(positions, start)
+        yield from self._unjudged(positions, 0, start)
+
+    def next(self, annotator, leases, policy=POLICY_ORDER, type_=None,
+             after=None, lease_seconds=60):
+        """Return next (document, candidate) item for annotator and
+        lease it in LeaseTable leases, or None if no unjudged items are
+        available. Items leased to other annotators are skipped. With
+        POLICY_ORDER and POLICY_TYPE, search starts after the given
+        document, wrapping around to the beginning of the collection."""
+        if policy not in POLICIES:
+            raise ValueError('unknown policy {}'.format(policy))
+        with self.lock:
+            self._check_current()
+            if policy == POLICY_TYPE:
+                if self.by_type is None:
+                    self._build_types()
+                positions = self.by_type.get(type_, [])
+            else:
+                positions = self.incomplete
+            items = (self.items[p] for p in
+                     self._preferred(positions, policy, after))
+            return leases.lease(self.collection_dir, annotator, items,
+                                lease_seconds)
+
+    def _start_position(self, after):
+        if after is None:
+            return 0
+        position = self.position.get((after, 0))
+        if position is None:
+            return 0
+        # skip all candidates of the document
+        document = after
+        while (position < len(self.items) and
+               self.items[position][0] == document):
+            position += 1
+        return position
+
+
+def read_annotation_type(path, id_):
+    """Return type of identified annotation in standoff file without
+    parsing other lines, or None if not found."""
+    prefix = id_ + '\t'
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.startswith(prefix):
+                    return line.split('\t')[1].split(' ')[0]
+    except OSError:
+        pass
+    return None
+
+
+def get_queue(root_dir, collection):
+    """Return work queue for collection, shared by this process."""
+    return get_index(WorkQueue, root_dir, collection)
+
+
+_lease_tables = {}
+_lease_tables_lock = threading.Lock()
+
+
+def get_leases():
+    """Return lease table in CACHEDIR."""
+    path = os.path.join(conf.get_cachedir(), 'leases.sqlite')
+    with _lease_tables_lock:
+        leases = _lease_tables.get(path)
+        if leases is None:
+            leases = _lease_tables[path] = LeaseTable(path)
+        return leases
+
+
+def next_item(root_dir, collection, annotator, policy=POLICY_ORDER,
+              type_=None, after=None):
+    """Return next unjudged (document, candidate) for annotator, or
+    None if all are judged or leased."""
+    queue = get_queue(root_dir, collection)
+    return queue.next(annotator, get_leases(), policy, type_, after,
+                      conf.get_workqueue_lease_seconds())
+